@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import asyncio
+import platform
+import subprocess
+import sys
+
+from arsoft.utils import _command_args, _command_env
+
+_default_encoding = 'CP1252' if platform.system() == 'Windows' else 'utf-8'
+
+class AsyncProcess(object):
+    """
+    Asyncio counterpart of runcmdAndGetData for a single process. The
+    command line arguments have the same meaning as for runcmdAndGetData,
+    env_update is merged into a copy of env (or os.environ) for this process
+    only. Output is streamed through a bounded queue: if the consumer falls
+    behind, the readers stop reading and the process blocks on its pipe
+    instead of the output piling up in memory.
+    """
+    STDOUT = 1
+    STDERR = 2
+
+    def __init__(self, args=[], script=None, verbose=False,
+                 executable=None, shell='/bin/sh',
+                 stdin=None, stdout=None, stderr=None, stderr_to_stdout=False, input=None, cwd=None, env=None,
+                 runAsUser=None, su='/bin/su', env_update=None, max_pending=64, limit=64*1024):
+        (self._args, self._script_tmpfile) = _command_args(args, script=script, shell=shell, runAsUser=runAsUser, su=su)
+        self._verbose = verbose
+        self._executable = executable
+        self._input = input
+        self._cwd = cwd
+        self._env = _command_env(env, env_update)
+        self._max_pending = max_pending
+        self._limit = limit
+
+        if input is not None:
+            self._stdin_param = subprocess.PIPE
+        else:
+            self._stdin_param = stdin if stdin is not None else subprocess.PIPE
+        self._stdout_param = stdout if stdout is not None else subprocess.PIPE
+        if stderr_to_stdout:
+            self._stderr_param = subprocess.STDOUT
+        elif stderr is not None:
+            self._stderr_param = stderr
+        else:
+            self._stderr_param = stdout if stdout is not None else subprocess.PIPE
+
+        self.process = None
+        self._queue = None
+        self._tasks = []
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else None
+
+    @property
+    def returncode(self):
+        return self.process.returncode if self.process is not None else None
+
+    async def start(self):
+        if self._verbose:
+            print("runcmd " + ' '.join(self._args) +
+                    ' 0<%s 1>%s 2>%s' % (self._stdin_param, self._stdout_param, self._stderr_param)
+                        )
+        self.process = await asyncio.create_subprocess_exec(*self._args, executable=self._executable,
+                                                            stdin=self._stdin_param, stdout=self._stdout_param, stderr=self._stderr_param,
+                                                            cwd=self._cwd, env=self._env, limit=self._limit)
+        self._queue = asyncio.Queue(self._max_pending)
+        if self.process.stdin is not None:
+            self._tasks.append(asyncio.ensure_future(self._write_input()))
+        for (fd, stream) in [ (self.STDOUT, self.process.stdout), (self.STDERR, self.process.stderr) ]:
+            if stream is not None:
+                self._tasks.append(asyncio.ensure_future(self._read_stream(fd, stream)))
+        return self
+
+    async def _write_input(self):
+        try:
+            if self._input:
+                self.process.stdin.write(self._input.encode() if isinstance(self._input, str) else self._input)
+                await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.process.stdin.close()
+
+    async def _read_stream(self, fd, stream):
+        # lines longer than the limit are passed on in pieces
+        buf = b''
+        while True:
+            data = await stream.read(self._limit)
+            if not data:
+                if buf:
+                    await self._queue.put( (fd, buf) )
+                break
+            buf += data
+            start = 0
+            while True:
+                idx = buf.find(b'\n', start)
+                if idx < 0:
+                    break
+                await self._queue.put( (fd, buf[start:idx + 1]) )
+                start = idx + 1
+            buf = buf[start:]
+            if len(buf) >= self._limit:
+                await self._queue.put( (fd, buf) )
+                buf = b''
+        await self._queue.put( (fd, None) )
+
+    def _num_streams(self):
+        return (1 if self.process.stdout is not None else 0) + (1 if self.process.stderr is not None else 0)
+
+    async def output(self):
+        """
+        Yields (fd, line) tuples with fd being STDOUT or STDERR and line the
+        raw bytes including the line terminator, until both pipes are closed.
+        """
+        open_streams = self._num_streams()
+        while open_streams:
+            (fd, line) = await self._queue.get()
+            if line is None:
+                open_streams -= 1
+            else:
+                yield (fd, line)
+
+    async def lines(self, encoding=_default_encoding):
+        """Yields the decoded lines written to stdout without line terminator."""
+        async for (fd, line) in self.output():
+            if fd == self.STDOUT:
+                try:
+                    yield line.decode(encoding).rstrip('\n\r')
+                except UnicodeDecodeError:
+                    pass
+
+    async def communicate(self):
+        """Reads all output and waits for the process, like Popen.communicate."""
+        stdoutdata = b'' if self.process.stdout is not None else None
+        stderrdata = b'' if self.process.stderr is not None else None
+        chunks = { self.STDOUT: [], self.STDERR: [] }
+        async for (fd, line) in self.output():
+            chunks[fd].append(line)
+        if stdoutdata is not None:
+            stdoutdata = b''.join(chunks[self.STDOUT])
+        if stderrdata is not None:
+            stderrdata = b''.join(chunks[self.STDERR])
+        sts = await self.wait()
+        return (sts, stdoutdata, stderrdata)
+
+    async def wait(self, timeout=None):
+        if timeout is None:
+            sts = await self.process.wait()
+        else:
+            sts = await asyncio.wait_for(self.process.wait(), timeout)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+        return sts
+
+    def kill(self):
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
+    async def close(self):
+        """Kills the process if it is still running and releases all resources."""
+        self.kill()
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+        if self.process is not None:
+            # the process only counts as finished once its pipes are closed,
+            # so drain whatever the killed process left behind
+            for stream in [ self.process.stdout, self.process.stderr ]:
+                if stream is not None:
+                    while await stream.read(self._limit):
+                        pass
+            await self.process.wait()
+        if self._script_tmpfile is not None:
+            self._script_tmpfile.close()
+            self._script_tmpfile = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+async def runcmdAndGetDataAsync(args=[], script=None, verbose=False, outputStdErr=False, outputStdOut=False,
+                                executable=None, shell='/bin/sh',
+                                stdin=None, stdout=None, stderr=None, stderr_to_stdout=False, input=None, cwd=None, env=None,
+                                runAsUser=None, su='/bin/su', env_update=None, timeout=None):
+    """
+    Same as runcmdAndGetData, but the caller does not block while the
+    process runs. If stdout is a callable (or coroutine function) it is
+    called for each line of output. When timeout expires or the calling
+    task is cancelled, the process is killed and asyncio.TimeoutError or
+    asyncio.CancelledError is raised.
+    """
+    callback = stdout if stdout is not None and hasattr(stdout, '__call__') else None
+    proc = AsyncProcess(args, script=script, verbose=verbose, executable=executable, shell=shell,
+                        stdin=stdin, stdout=None if callback else stdout, stderr=stderr,
+                        stderr_to_stdout=stderr_to_stdout, input=input, cwd=cwd, env=env,
+                        runAsUser=runAsUser, su=su, env_update=env_update)
+
+    async def _run():
+        if callback is not None:
+            async for line in proc.lines():
+                ret = callback(line)
+                if asyncio.iscoroutine(ret):
+                    await ret
+            return (await proc.wait(), None, None)
+        return await proc.communicate()
+
+    async with proc:
+        if timeout is None:
+            (sts, stdoutdata, stderrdata) = await _run()
+        else:
+            (sts, stdoutdata, stderrdata) = await asyncio.wait_for(_run(), timeout)
+
+    if stdoutdata is not None and outputStdOut:
+        sys.stdout.buffer.write(stdoutdata)
+        sys.stdout.buffer.flush()
+    if stderrdata is not None and outputStdErr:
+        sys.stderr.buffer.write(stderrdata)
+        sys.stderr.buffer.flush()
+    return (sts, stdoutdata, stderrdata)
+
+async def runcmdsAndGetDataAsync(commands, limit=None, **kwargs):
+    """
+    Runs all given commands concurrently, at most limit at a time, and
+    returns their (sts, stdoutdata, stderrdata) in the same order. Each
+    command is either a list of arguments or a dict of keyword arguments
+    for runcmdAndGetDataAsync, which override the shared kwargs.
+    """
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def _run(command):
+        params = dict(kwargs)
+        if isinstance(command, dict):
+            params.update(command)
+        else:
+            params['args'] = command
+        if semaphore is None:
+            return await runcmdAndGetDataAsync(**params)
+        async with semaphore:
+            return await runcmdAndGetDataAsync(**params)
+
+    return await asyncio.gather(*[ _run(command) for command in commands ])
+
+def runcmds(commands, limit=None, **kwargs):
+    """Blocking wrapper around runcmdsAndGetDataAsync for code without an event loop."""
+    return asyncio.run(runcmdsAndGetDataAsync(commands, limit=limit, **kwargs))
+
+if __name__ == '__main__':
+    # benchmark: spawn throughput of runcmdAndGetData against the asyncio runner
+    import os
+    import time
+    from arsoft.utils import runcmdAndGetData
+
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1) * 4
+    # a small delay stands in for the latency of ssh, rsync or a database
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    if delay > 0:
+        args = [ '/bin/sh', '-c', 'sleep %f; echo hello' % delay ]
+    else:
+        args = [ '/bin/echo', 'hello' ]
+
+    start = time.time()
+    for i in range(num):
+        (sts, stdoutdata, stderrdata) = runcmdAndGetData(args)
+    duration = time.time() - start
+    print('runcmdAndGetData: %i processes in %.2fs (%.0f/s)' % (num, duration, num / duration))
+
+    start = time.time()
+    results = runcmds([ args ] * num, limit=limit)
+    duration = time.time() - start
+    assert all([ r == (0, b'hello\n', b'') for r in results ])
+    print('runcmdsAndGetDataAsync (limit %i): %i processes in %.2fs (%.0f/s)' % (limit, num, duration, num / duration))
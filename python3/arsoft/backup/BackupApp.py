@@ -5,7 +5,7 @@
 from arsoft.filelist import *
 from arsoft.rsync import Rsync
 from arsoft.sshutils import *
-from arsoft.utils import rmtree, isRoot
+from arsoft.utils import rmtree_fast, set_process_priority, isRoot, IOPRIO_CLASS_NAMES
 from arsoft.socket_utils import gethostname_tuple
 from arsoft.sshutils import *
 from .BackupConfig import *
@@ -15,7 +15,18 @@ from .diskmgr import *
 import sys, stat
 import shlex
 import traceback
-    
+import threading
+import time
+import concurrent.futures
+
+def _retention_worker_init(nice, io_class):
+    set_process_priority(nice=nice, io_class=io_class)
+
+def _retention_remove_dir(fullpath):
+    start = time.time()
+    num_inodes = rmtree_fast(fullpath)
+    return (num_inodes, start, time.time() - start)
+
 class BackupList(object):
 
     class BackupItem(object):
@@ -102,12 +113,12 @@ class BackupList(object):
             raise ValueError('min_count=%i must be greater than max_count=%i' % (min_count, max_count))
 
         #print('hist=%i min_count=%i max_count=%i' % (len(self._items), min_count, max_count))
+        num_to_delete = 0
         if len(self._items) > max_count:
             num_to_delete = len(self._items) - max_count
             #print('numbers to delete %i' % num_to_delete)
             for i in range(0, num_to_delete):
-                self.app.session.writelog('Remove backup %s because more than %i backups found' % (self._items[0].fullpath, max_count) )
-                self.__delitem__(0)
+                self.app.session.writelog('Remove backup %s because more than %i backups found' % (self._items[i].fullpath, max_count) )
 
         if isinstance(max_age, datetime.datetime):
             max_rentention_time = max_age
@@ -118,14 +129,102 @@ class BackupList(object):
             now = datetime.datetime.utcnow()
             max_rentention_time = now - datetime.timedelta(seconds=max_age)
 
-        while len(self._items) > 0 and len(self._items) <= min_count:
-            if self._items[0].timestamp < max_rentention_time:
-                self.app.session.writelog('Remove backup %s because backup exceeds retention time of %s' % (self._items[0].fullpath, max_rentention_time) )
-                self.__delitem__(0)
+        while len(self._items) - num_to_delete > 0 and len(self._items) - num_to_delete <= min_count:
+            if self._items[num_to_delete].timestamp < max_rentention_time:
+                self.app.session.writelog('Remove backup %s because backup exceeds retention time of %s' % (self._items[num_to_delete].fullpath, max_rentention_time) )
+                num_to_delete += 1
             else:
                 break
+        if num_to_delete > 0:
+            self.__delitem__(slice(0, num_to_delete))
         return True
 
+    def _remote_rsync_path(self):
+        # run the remote rsync with the configured priority as well
+        prefix = []
+        if self.config.retention_nice is not None:
+            prefix.extend(['nice', '-n', str(self.config.retention_nice)])
+        if self.config.retention_io_class is not None:
+            prefix.extend(['ionice', '-c', str(IOPRIO_CLASS_NAMES.get(self.config.retention_io_class, self.config.retention_io_class))])
+        return ' '.join(prefix + ['rsync']) if prefix else None
+
+    def _remove_backups(self, items):
+        local_items = []
+        remote_groups = {}
+        for item in items:
+            if Rsync.is_rsync_url(item.fullpath):
+                parent_dir = os.path.dirname(item.fullpath.rstrip('/'))
+                if parent_dir in remote_groups:
+                    remote_groups[parent_dir].append(item)
+                else:
+                    remote_groups[parent_dir] = [item]
+            else:
+                local_items.append(item)
+
+        start = time.time()
+        total_inodes = 0
+        num_workers = max(1, self.config.retention_workers if self.config.retention_workers else 1)
+        use_pool = num_workers > 1 or self.config.retention_nice is not None or self.config.retention_io_class is not None
+        executor = None
+        futures = {}
+        if local_items and use_pool:
+            # use processes so the priority of the main process remains unchanged
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_retention_worker_init,
+                                                              initargs=(self.config.retention_nice, self.config.retention_io_class))
+
+        try:
+            if executor is not None:
+                for item in local_items:
+                    futures[executor.submit(_retention_remove_dir, item.fullpath)] = item
+
+            # remove all remote backups in the same directory with a single rsync run
+            for parent_dir, group in remote_groups.items():
+                group_start = time.time()
+                (result, num_inodes) = Rsync.rmdirs([item.fullpath for item in group], force=True,
+                                                    use_ssh=True, ssh_key=self.config.ssh_identity_file,
+                                                    rsync_path=self._remote_rsync_path(),
+                                                    verbose=self.app.verbose)
+                total_inodes += num_inodes
+                self.app.session.add_timing('retention', parent_dir, group_start, time.time() - group_start, size=num_inodes, success=result)
+                if not result:
+                    for item in group:
+                        self.app.session.writelog('Failed to remove backup %s (Error %s)\n' % (item.fullpath, 'unknown'))
+
+            if executor is None:
+                results = []
+                for item in local_items:
+                    try:
+                        results.append( (item, _retention_remove_dir(item.fullpath), None) )
+                    except (IOError, OSError) as e:
+                        results.append( (item, None, e) )
+            else:
+                results = []
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        results.append( (futures[future], future.result(), None) )
+                    except (IOError, OSError) as e:
+                        results.append( (futures[future], None, e) )
+        finally:
+            # also when a remote removal or the pool itself failed
+            if executor is not None:
+                executor.shutdown()
+
+        for (item, result, error) in results:
+            if result is None:
+                self.app.session.writelog('Failed to remove backup %s (Error %s)\n' % (item.fullpath, str(error)))
+                self.app.session.add_timing('retention', item.fullpath, start, time.time() - start, success=False)
+            else:
+                (num_inodes, item_start, item_duration) = result
+                total_inodes += num_inodes
+                self.app.session.add_timing('retention', item.fullpath, item_start, item_duration, size=num_inodes)
+
+        self.app.job_state.remove_statistics([ item.fullpath for item in items ])
+
+        duration = time.time() - start
+        self.app.session.writelog('Removed %i backups with %i inodes in %.1fs (%.0f inodes/s)' % (
+            len(items), total_inodes, duration, (total_inodes / duration) if duration > 0 else 0))
+        return total_inodes
+
     def __iter__(self):
         return iter(self._items)
     
@@ -136,23 +235,11 @@ class BackupList(object):
         return self._items[index]
 
     def __delitem__(self, index):
-        error_msg = None
-        item = self._items[index]
-        if Rsync.is_rsync_url(item.fullpath):
-            url = Rsync.parse_url(item.fullpath)
-            result = Rsync.rmdir(item.fullpath, recursive=True,
-                                 use_ssh=True, ssh_key=self.config.ssh_identity_file,
-                                 verbose=self.app.verbose)
+        if isinstance(index, slice):
+            items = self._items[index]
         else:
-            result = False
-            try:
-                rmtree(item.fullpath)
-                result = True
-            except IOError as e:
-                error_msg = str(e)
-
-        if not result:
-            self.app.session.writelog('Failed to remove backup %s (Error %s)\n' % (item.fullpath, error_msg if not None else 'unknown'))
+            items = [ self._items[index] ]
+        self._remove_backups(items)
         del self._items[index]
 
     @property
@@ -209,6 +296,7 @@ class BackupApp(object):
         self.root_dir = None
         self.fqdn = None
         self.hostname = None
+        self._filelist_lock = threading.Lock()
 
     @property
     def verbose(self):
@@ -516,11 +604,20 @@ class BackupApp(object):
                 if func:
                     func(**kwargs)
 
+    def _call_plugins_concurrent(self, cmd, **kwargs):
+        scheduler = BackupPluginScheduler(self.plugins, max_workers=self.config.plugin_workers, session=self.session)
+        tasks = scheduler.run(cmd, **kwargs)
+        if self._verbose:
+            for task in tasks:
+                print('plugin %s %s took %.3fs' % (task.name, cmd, task.duration))
+
     def append_to_filelist(self, filelist_item, exclude=False):
-        if exclude:
-            self.filelist_exclude.append(filelist_item)
-        else:
-            self.filelist_include.append(filelist_item)
+        # plugins may run concurrently
+        with self._filelist_lock:
+            if exclude:
+                self.filelist_exclude.append(filelist_item)
+            else:
+                self.filelist_include.append(filelist_item)
 
     def create_link(self, source, link, hardlink=False, symlink=False, overwrite=True, relative_to=None, use_relative_path=True):
         if not hardlink and not symlink:
@@ -586,11 +683,11 @@ class BackupApp(object):
         self._call_plugins('rsync_complete')
 
     def plugin_notify_start_backup(self):
-        self._call_plugins('start_backup')
+        self._call_plugins_concurrent('start_backup')
     def plugin_notify_perform_backup(self):
-        self._call_plugins('perform_backup')
+        self._call_plugins_concurrent('perform_backup')
     def plugin_notify_backup_complete(self):
-        self._call_plugins('backup_complete')
+        self._call_plugins_concurrent('backup_complete')
 
     def plugin_notify_start_manage_retention(self):
         self._call_plugins('start_manage_retention')
@@ -36,6 +36,10 @@ class BackupConfigDefaults(object):
     USE_DISK_MANAGER = False
     DISK_TAG = None
     DISK_TIMEOUT = 60.0
+    PLUGIN_WORKERS = 1
+    RETENTION_WORKERS = 1
+    RETENTION_NICE = None
+    RETENTION_IO_CLASS = None
 
 class BackupConfig(object):
 
@@ -133,6 +137,10 @@ class BackupConfig(object):
                  use_disk_manager=BackupConfigDefaults.USE_DISK_MANAGER,
                  disk_tag=BackupConfigDefaults.DISK_TAG,
                  disk_timeout=BackupConfigDefaults.DISK_TIMEOUT,
+                 plugin_workers=BackupConfigDefaults.PLUGIN_WORKERS,
+                 retention_workers=BackupConfigDefaults.RETENTION_WORKERS,
+                 retention_nice=BackupConfigDefaults.RETENTION_NICE,
+                 retention_io_class=BackupConfigDefaults.RETENTION_IO_CLASS,
                  filelist_include=None, 
                  filelist_exclude=None):
         self.instance = instance
@@ -162,6 +170,10 @@ class BackupConfig(object):
         self.use_disk_manager = use_disk_manager
         self.disk_tag = disk_tag
         self.disk_timeout = disk_timeout
+        self.plugin_workers = plugin_workers
+        self.retention_workers = retention_workers
+        self.retention_nice = retention_nice
+        self.retention_io_class = retention_io_class
         self._remote_servers = []
 
     def clear(self):
@@ -192,6 +204,10 @@ class BackupConfig(object):
         self.use_disk_manager = BackupConfigDefaults.USE_DISK_MANAGER
         self.disk_tag = BackupConfigDefaults.DISK_TAG
         self.disk_timeout = BackupConfigDefaults.DISK_TIMEOUT
+        self.plugin_workers = BackupConfigDefaults.PLUGIN_WORKERS
+        self.retention_workers = BackupConfigDefaults.RETENTION_WORKERS
+        self.retention_nice = BackupConfigDefaults.RETENTION_NICE
+        self.retention_io_class = BackupConfigDefaults.RETENTION_IO_CLASS
         self._remote_servers = []
 
     @property
@@ -416,6 +432,10 @@ class BackupConfig(object):
         self.use_disk_manager = inifile.getAsBoolean(None, 'UseDiskManager', BackupConfigDefaults.USE_DISK_MANAGER)
         self.disk_tag = inifile.get(None, 'DiskTag', BackupConfigDefaults.DISK_TAG)
         self.disk_timeout = inifile.get(None, 'DiskTimeout', BackupConfigDefaults.DISK_TIMEOUT)
+        self.plugin_workers = inifile.getAsInteger(None, 'PluginWorkers', BackupConfigDefaults.PLUGIN_WORKERS)
+        self.retention_workers = inifile.getAsInteger(None, 'RetentionWorkers', BackupConfigDefaults.RETENTION_WORKERS)
+        self.retention_nice = inifile.getAsInteger(None, 'RetentionNice', BackupConfigDefaults.RETENTION_NICE)
+        self.retention_io_class = inifile.get(None, 'RetentionIOClass', BackupConfigDefaults.RETENTION_IO_CLASS)
         return ret
 
     def _write_main_conf(self, filename):
@@ -445,6 +465,10 @@ class BackupConfig(object):
         inifile.set(None, 'UseDiskManager', self.use_disk_manager)
         inifile.set(None, 'DiskTag', self.disk_tag)
         inifile.set(None, 'DiskTimeout', self.disk_timeout)
+        inifile.setAsInteger(None, 'PluginWorkers', self.plugin_workers)
+        inifile.setAsInteger(None, 'RetentionWorkers', self.retention_workers)
+        inifile.setAsInteger(None, 'RetentionNice', self.retention_nice)
+        inifile.set(None, 'RetentionIOClass', self.retention_io_class)
 
         ret = inifile.save(filename)
         return ret
@@ -494,6 +518,10 @@ class BackupConfig(object):
         ret = ret + 'use disk manager: ' + str(self.use_disk_manager) + '\n'
         ret = ret + 'disk tag: ' + str(self.disk_tag) + '\n'
         ret = ret + 'disk timeout: ' + str(self.disk_timeout) + '\n'
+        ret = ret + 'plugin workers: ' + str(self.plugin_workers) + '\n'
+        ret = ret + 'retention workers: ' + str(self.retention_workers) + '\n'
+        ret = ret + 'retention nice: ' + str(self.retention_nice) + '\n'
+        ret = ret + 'retention io class: ' + str(self.retention_io_class) + '\n'
         ret = ret + 'servers:\n'
         for inst in self._remote_servers:
             ret = ret + '  %s\n' % str(inst)
@@ -504,13 +532,19 @@ class BackupPluginConfig(object):
                  backup_app, 
                  plugin_name=None,
                  retention_time=None,
-                 retention_count=None
+                 retention_count=None,
+                 depends_on=None,
+                 max_concurrency=None,
+                 deduplicate=False
                  ):
         self.backup_app = backup_app
         self.parent = backup_app.config
         self.plugin_name = plugin_name
         self._retention_time = retention_time
         self._retention_count= retention_count
+        self.depends_on = depends_on
+        self.max_concurrency = max_concurrency
+        self.deduplicate = deduplicate
 
     @property
     def retention_time(self):
@@ -555,6 +589,10 @@ class BackupPluginConfig(object):
     @property
     def base_directory(self):
         return self.parent.intermediate_backup_directory
+
+    @property
+    def chunk_store_directory(self):
+        return os.path.join(self.intermediate_backup_directory, '.chunkstore')
     
     def _read_conf(self, inifile):
         return True
@@ -568,6 +606,9 @@ class BackupPluginConfig(object):
         ret = inifile.open(filename)
         self.retention_time = inifile.get(None, 'RetentionTime', None)
         self.retention_count = inifile.get(None, 'RetentionCount', None)
+        self.depends_on = inifile.getAsArray(None, 'DependsOn', None)
+        self.max_concurrency = inifile.getAsInteger(None, 'MaxConcurrency', None)
+        self.deduplicate = inifile.getAsBoolean(None, 'Deduplicate', False)
         ret = self._read_conf(inifile)
         return ret
         
@@ -585,6 +626,15 @@ class BackupPluginConfig(object):
             inifile.remove(None, 'RetentionCount')
         else:
             inifile.set(None, 'RetentionCount', self.retention_count)
+        if self.depends_on is None:
+            inifile.remove(None, 'DependsOn')
+        else:
+            inifile.set(None, 'DependsOn', self.depends_on)
+        if self.max_concurrency is None:
+            inifile.remove(None, 'MaxConcurrency')
+        else:
+            inifile.setAsInteger(None, 'MaxConcurrency', self.max_concurrency)
+        inifile.setAsBoolean(None, 'Deduplicate', self.deduplicate)
         ret = self._write_conf(inifile)
         ret = inifile.save(filename)
         return ret
@@ -594,4 +644,7 @@ class BackupPluginConfig(object):
         ret = ret + 'plugin name: ' + str(self.plugin_name) + '\n'
         ret = ret + 'retention time: ' + str(self._retention_time) + '\n'
         ret = ret + 'retention count: ' + str(self._retention_count) + '\n'
+        ret = ret + 'depends on: ' + str(self.depends_on) + '\n'
+        ret = ret + 'max concurrency: ' + str(self.max_concurrency) + '\n'
+        ret = ret + 'deduplicate: ' + str(self.deduplicate) + '\n'
         return ret
@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+import sys
+import zlib
+import hashlib
+import tempfile
+
+class ContentDefinedChunker(object):
+    """
+    Splits a stream into chunks whose boundaries only depend on the content
+    around them, so inserting or removing data only changes the chunks next
+    to the modification. Boundary candidates are the ends of lines (any
+    anchor byte); a candidate becomes a boundary if the checksum of the
+    preceding WINDOW_SIZE bytes matches the mask. A chunk reaching max_size
+    is cut at its last candidate, or at max_size if there is none.
+    """
+    WINDOW_SIZE = 48
+
+    def __init__(self, min_size=16*1024, max_size=1024*1024, mask_bits=8, anchor=b'\n'):
+        self.min_size = max(min_size, self.WINDOW_SIZE)
+        self.max_size = max(max_size, self.min_size)
+        self.mask = (1 << mask_bits) - 1
+        self.anchor = anchor
+        self._buffer = bytearray()
+        self._scan_pos = self.min_size - 1
+        self._last_candidate = None
+
+    def _find_boundary(self, final):
+        buf = self._buffer
+        limit = min(len(buf), self.max_size)
+        while True:
+            idx = buf.find(self.anchor, self._scan_pos, limit)
+            if idx < 0:
+                self._scan_pos = max(self._scan_pos, limit)
+                break
+            end = idx + 1
+            if zlib.crc32(buf[end - self.WINDOW_SIZE:end]) & self.mask == 0:
+                return end
+            self._last_candidate = end
+            self._scan_pos = end
+        if len(buf) >= self.max_size:
+            return self._last_candidate if self._last_candidate is not None else self.max_size
+        if final and buf:
+            return len(buf)
+        return None
+
+    def _split(self, final):
+        while True:
+            end = self._find_boundary(final)
+            if end is None:
+                break
+            chunk = bytes(self._buffer[:end])
+            del self._buffer[:end]
+            self._scan_pos = self.min_size - 1
+            self._last_candidate = None
+            yield chunk
+
+    def feed(self, data):
+        """Returns an iterator over the chunks completed by the given data."""
+        self._buffer += data
+        return self._split(final=False)
+
+    def flush(self):
+        """Returns an iterator over the remaining chunks."""
+        return self._split(final=True)
+
+class ChunkStoreWriter(object):
+    """
+    Writes a stream into the chunk store. On commit the manifest listing
+    the chunks is replaced, but only if it differs from the existing one,
+    so an unchanged dump keeps its manifest untouched.
+    """
+    def __init__(self, store, manifest_file):
+        self.store = store
+        self.manifest_file = manifest_file
+        self.size = 0
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self._chunks = []
+        self._chunker = store.create_chunker()
+
+    def _add_chunks(self, chunks):
+        for chunk in chunks:
+            (digest, is_new) = self.store.put_chunk(chunk)
+            self._chunks.append( (digest, len(chunk)) )
+            if is_new:
+                self.new_chunks += 1
+                self.new_bytes += len(chunk)
+
+    def write(self, data):
+        self.size += len(data)
+        self._add_chunks(self._chunker.feed(data))
+
+    def abort(self):
+        # chunks already written stay until the next garbage collection
+        self._chunks = []
+
+    def commit(self):
+        """
+        Returns True if the manifest has been replaced and False if the
+        content is unchanged.
+        """
+        self._add_chunks(self._chunker.flush())
+        content = self.store.format_manifest(self._chunks, self.size)
+        try:
+            with open(self.manifest_file, 'r') as f:
+                if f.read() == content:
+                    return False
+        except IOError:
+            pass
+        tmpfile = self.manifest_file + '.tmp'
+        with open(tmpfile, 'w') as f:
+            os.fchmod(f.fileno(), 0o600)
+            f.write(content)
+        os.rename(tmpfile, self.manifest_file)
+        return True
+
+class ChunkStore(object):
+    """
+    Content addressed store of chunks produced by the
+    ContentDefinedChunker. Every chunk is stored once in a file named by its
+    hash, and each dump is represented by a small manifest with the list of
+    its chunks. Chunk files never change once written, so rsync only
+    transfers new chunks and manifests.
+    """
+    MANIFEST_EXTENSION = '.chunks'
+    MANIFEST_HEADER = 'arsoft-chunk-manifest 1'
+
+    def __init__(self, directory, hash_name='sha256', min_size=16*1024, max_size=1024*1024, mask_bits=8):
+        self.directory = directory
+        self.hash_name = hash_name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask_bits = mask_bits
+        self._known_chunks = set()
+
+    def create_chunker(self):
+        return ContentDefinedChunker(min_size=self.min_size, max_size=self.max_size, mask_bits=self.mask_bits)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.directory, digest[0:2], digest)
+
+    def has_chunk(self, digest):
+        if digest in self._known_chunks:
+            return True
+        if os.path.isfile(self.chunk_path(digest)):
+            self._known_chunks.add(digest)
+            return True
+        return False
+
+    def put_chunk(self, data):
+        """Stores the chunk unless it exists and returns its hash and if it is new."""
+        digest = hashlib.new(self.hash_name, data).hexdigest()
+        if self.has_chunk(digest):
+            return (digest, False)
+        path = self.chunk_path(digest)
+        chunk_dir = os.path.dirname(path)
+        if not os.path.isdir(chunk_dir):
+            os.makedirs(chunk_dir, exist_ok=True)
+        # chunks may be written concurrently, so use a unique temporary name
+        (fd, tmpfile) = tempfile.mkstemp(prefix='.' + digest, dir=chunk_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmpfile, path)
+        except:
+            os.unlink(tmpfile)
+            raise
+        self._known_chunks.add(digest)
+        return (digest, True)
+
+    def get_chunk(self, digest):
+        with open(self.chunk_path(digest), 'rb') as f:
+            return f.read()
+
+    def writer(self, manifest_file):
+        return ChunkStoreWriter(self, manifest_file)
+
+    def store_file(self, filename, manifest_file):
+        writer = self.writer(manifest_file)
+        with open(filename, 'rb') as f:
+            while True:
+                data = f.read(self.max_size)
+                if not data:
+                    break
+                writer.write(data)
+        writer.commit()
+        return writer
+
+    def format_manifest(self, chunks, size):
+        lines = [ '%s %s %i %i' % (self.MANIFEST_HEADER, self.hash_name, size, len(chunks)) ]
+        for (digest, chunk_size) in chunks:
+            lines.append('%s %i' % (digest, chunk_size))
+        return '\n'.join(lines) + '\n'
+
+    def read_manifest(self, manifest_file):
+        """Returns the list of (hash, size) of all chunks of the given manifest."""
+        ret = []
+        with open(manifest_file, 'r') as f:
+            header = f.readline()
+            if not header.startswith(self.MANIFEST_HEADER + ' '):
+                raise IOError('%s is not a chunk manifest' % manifest_file)
+            for line in f:
+                elems = line.split()
+                if len(elems) == 2:
+                    ret.append( (elems[0], int(elems[1])) )
+        return ret
+
+    def restore(self, manifest_file, fobj):
+        """Writes the content described by the manifest to the given file object."""
+        size = 0
+        for (digest, chunk_size) in self.read_manifest(manifest_file):
+            data = self.get_chunk(digest)
+            if len(data) != chunk_size:
+                raise IOError('chunk %s of %s is corrupt' % (digest, manifest_file))
+            fobj.write(data)
+            size += chunk_size
+        return size
+
+    def remove_unreferenced(self, manifest_directory):
+        """
+        Removes all chunks which are not referenced by any manifest in the
+        given directory and returns the number of removed chunks.
+        """
+        referenced = set()
+        for name in os.listdir(manifest_directory):
+            if name.endswith(self.MANIFEST_EXTENSION):
+                try:
+                    for (digest, chunk_size) in self.read_manifest(os.path.join(manifest_directory, name)):
+                        referenced.add(digest)
+                except IOError:
+                    pass
+        ret = 0
+        if not os.path.isdir(self.directory):
+            return ret
+        for subdir in os.listdir(self.directory):
+            subdir_path = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for name in os.listdir(subdir_path):
+                if name not in referenced:
+                    try:
+                        os.unlink(os.path.join(subdir_path, name))
+                        self._known_chunks.discard(name)
+                        ret += 1
+                    except OSError:
+                        pass
+        return ret
+
+if __name__ == '__main__':
+    # benchmark: a synthetic SQL-like dump which changes slightly every day
+    import random
+    import shutil
+    import time
+
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    num_days = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    mutations_per_day = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    rnd = random.Random(42)
+    rows = [ 'INSERT INTO `t` VALUES (%i,\'%s\',%i);\n' % (i, '%032x' % rnd.getrandbits(128), rnd.randint(0, 1 << 30)) for i in range(num_rows) ]
+    next_id = num_rows
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = ChunkStore(os.path.join(tmpdir, 'store'))
+        manifest = os.path.join(tmpdir, 'db.mysql' + ChunkStore.MANIFEST_EXTENSION)
+        total_size = 0
+        total_written = 0
+        for day in range(num_days):
+            if day > 0:
+                for i in range(mutations_per_day):
+                    op = rnd.randint(0, 2)
+                    pos = rnd.randint(0, len(rows) - 1)
+                    if op == 0:
+                        rows[pos] = 'INSERT INTO `t` VALUES (%i,\'%s\',%i);\n' % (pos, 'changed%025x' % rnd.getrandbits(100), day)
+                    elif op == 1:
+                        rows.insert(pos, 'INSERT INTO `t` VALUES (%i,\'%s\',%i);\n' % (next_id, 'new%029x' % rnd.getrandbits(116), day))
+                        next_id += 1
+                    else:
+                        del rows[pos]
+            data = ''.join(rows).encode()
+            start = time.time()
+            writer = store.writer(manifest)
+            for offset in range(0, len(data), 256 * 1024):
+                writer.write(data[offset:offset + 256 * 1024])
+            writer.commit()
+            duration = time.time() - start
+            total_size += len(data)
+            total_written += writer.new_bytes
+            print('day %i: dump %i bytes, %i chunks, %i new chunks, %i bytes written (%.1f%%), %.1f MB/s' % (
+                day, len(data), len(writer._chunks), writer.new_chunks, writer.new_bytes,
+                100.0 * writer.new_bytes / len(data), len(data) / duration / (1024 * 1024)))
+        print('total: %i bytes dumped, %i bytes written (%.1f%%)' % (total_size, total_written, 100.0 * total_written / total_size))
+    finally:
+        shutil.rmtree(tmpdir)
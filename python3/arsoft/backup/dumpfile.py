@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+import hashlib
+import subprocess
+from arsoft.utils import which
+
+# name -> (executable, arguments, file extension)
+COMPRESSORS = {
+    'none': (None, [], ''),
+    'bzip2': ('bzip2', ['-c'], '.bz2'),
+    'gzip': ('gzip', ['-n', '-c'], '.gz'),
+    'pigz': ('pigz', ['-n', '-c'], '.gz'),
+    'xz': ('xz', ['-T0', '-c'], '.xz'),
+    'zstd': ('zstd', ['-T0', '-q', '-c'], '.zst'),
+    }
+
+def get_compressor(name):
+    """
+    Returns the command line and the file extension for the given
+    compressor. The command line is None if no compression is requested and
+    the function returns None if the compressor is unknown or unavailable.
+    """
+    if name is None:
+        name = 'none'
+    entry = COMPRESSORS.get(name)
+    if entry is None:
+        return None
+    (exe_name, args, extension) = entry
+    if exe_name is None:
+        return (None, extension)
+    exe = which(exe_name, only_first=True)
+    if exe is None:
+        return None
+    return ([exe] + args, extension)
+
+def read_checksum_file(filename):
+    ret = None
+    try:
+        with open(filename, 'r') as f:
+            # either plain checksum or md5sum output format
+            elems = f.readline().split()
+            if elems:
+                ret = elems[0]
+    except IOError:
+        pass
+    return ret
+
+class DumpFileWriter(object):
+    """
+    Writes a dump into a temporary file next to the final dump file while
+    computing its checksum. On commit the temporary file replaces the dump
+    file by an atomic rename, but only if the checksum differs from the one
+    of the previous dump. With a chunk store the dump is written into the
+    store instead and only its manifest is placed next to the checksum file.
+    """
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, dumpfile, checksum_file=None, hash_name='md5', checksum_format='%s', mode=0o600, chunk_store=None):
+        self.dumpfile = dumpfile
+        self.checksum_file = checksum_file if checksum_file is not None else dumpfile + '.' + hash_name
+        self.checksum_format = checksum_format
+        self.tmpfile = dumpfile + '.tmp'
+        self.size = 0
+        self._hash = hashlib.new(hash_name)
+        if chunk_store is not None:
+            self.output_file = dumpfile + chunk_store.MANIFEST_EXTENSION
+            self._fobj = None
+            self._chunk_writer = chunk_store.writer(self.output_file)
+        else:
+            self.output_file = dumpfile
+            self._chunk_writer = None
+            self._fobj = open(self.tmpfile, 'wb')
+            # protect the file content (may include passwords and other sensitive
+            # information) from the rest of the world.
+            os.fchmod(self._fobj.fileno(), mode)
+
+    @property
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    @property
+    def files(self):
+        return [self.output_file, self.checksum_file]
+
+    def write(self, data):
+        self._hash.update(data)
+        if self._chunk_writer is not None:
+            self._chunk_writer.write(data)
+        else:
+            self._fobj.write(data)
+        self.size += len(data)
+
+    def copy_from(self, fobj):
+        # fobj is expected to be an unbuffered pipe or file
+        if hasattr(fobj, 'fileno'):
+            fd = fobj.fileno()
+            while True:
+                data = os.read(fd, self.CHUNK_SIZE)
+                if not data:
+                    break
+                self.write(data)
+        else:
+            while True:
+                data = fobj.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                self.write(data)
+
+    def abort(self):
+        if self._chunk_writer is not None:
+            self._chunk_writer.abort()
+            return
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
+        try:
+            os.remove(self.tmpfile)
+        except OSError:
+            pass
+
+    def commit(self):
+        """
+        Returns True if the dump file has been replaced and False if the
+        dump is unchanged.
+        """
+        new_checksum = self.hexdigest
+        unchanged = os.path.isfile(self.output_file) and read_checksum_file(self.checksum_file) == new_checksum
+        if self._chunk_writer is not None:
+            if unchanged:
+                return False
+            self._chunk_writer.commit()
+        else:
+            self._fobj.close()
+            self._fobj = None
+            if unchanged:
+                os.remove(self.tmpfile)
+                return False
+            os.rename(self.tmpfile, self.dumpfile)
+        checksum_tmpfile = self.checksum_file + '.tmp'
+        with open(checksum_tmpfile, 'w') as f:
+            os.fchmod(f.fileno(), 0o600)
+            f.write(self.checksum_format % new_checksum)
+        os.rename(checksum_tmpfile, self.checksum_file)
+        return True
+
+def compress_stream(compressor_args, stdin):
+    """
+    Starts the compressor reading from the given pipe or file and returns
+    the process whose stdout provides the compressed data.
+    """
+    p = subprocess.Popen(compressor_args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return p
+
+def dump_command_output(args, writer, compressor_args=None, stderr=None):
+    """
+    Runs the given command and writes its output, optionally compressed, to
+    the given DumpFileWriter. Returns the exit status of the command or the
+    one of the compressor if the command succeeded. If running the command
+    or writing the dump fails, the writer is aborted and the error raised.
+    """
+    p = None
+    zp = None
+    try:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr, stdin=subprocess.DEVNULL)
+        if compressor_args:
+            zp = compress_stream(compressor_args, p.stdout)
+            # only the compressor reads the output now
+            p.stdout.close()
+            writer.copy_from(zp.stdout)
+            zp.stdout.close()
+            zip_sts = zp.wait()
+        else:
+            writer.copy_from(p.stdout)
+            p.stdout.close()
+            zip_sts = 0
+        sts = p.wait()
+    except BaseException:
+        writer.abort()
+        for proc in [zp, p]:
+            if proc is not None:
+                proc.kill()
+                proc.stdout.close()
+                proc.wait()
+        raise
+    if sts == 0:
+        sts = zip_sts
+    return sts
@@ -2,9 +2,21 @@
 # -*- coding: utf-8 -*-
 # kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
 
+import os
+import sys
+import time
+import threading
 from .BackupConfig import BackupPluginConfig
+from .chunkstore import ChunkStore
 
 class BackupPlugin(object):
+    # names of the plugins which must finish a hook before this plugin
+    # executes the same hook
+    depends_on = []
+    # maximum number of plugins (including this one) which may run at the
+    # same time as this plugin; None means no limit, 1 runs it exclusively.
+    max_concurrency = None
+
     def __init__(self, backup_app, name):
         self.name = name
         self.backup_app = backup_app
@@ -12,14 +24,171 @@ class BackupPlugin(object):
             self.config = BackupPluginConfig(backup_app=backup_app.config, plugin_name=self.name)
         # load the configuration of this plugin on start
         self.config.load()
+        self._chunk_store = None
 
     def _mkdir(self, dirname):
         # forward request to app
         return self.backup_app._mkdir(dirname)
 
+    @property
+    def dependencies(self):
+        if self.config.depends_on is not None:
+            return self.config.depends_on
+        return self.depends_on
+
+    @property
+    def concurrency_limit(self):
+        if self.config.max_concurrency is not None:
+            return self.config.max_concurrency
+        return self.max_concurrency
+
     @property
     def logfile_proxy(self):
         return self.backup_app.session.logfile_proxy
 
     def writelog(self, msg):
         return self.backup_app.session.writelog(msg, plugin=self.name)
+
+    @property
+    def chunk_store(self):
+        # dumps are only written into the chunk store if deduplication is enabled
+        if not self.config.deduplicate:
+            return None
+        if self._chunk_store is None:
+            self._chunk_store = ChunkStore(self.config.chunk_store_directory)
+        return self._chunk_store
+
+    def _append_chunk_store(self, filelist):
+        # drop the chunks no longer used by any dump and back up the rest
+        store = self.chunk_store
+        if store is not None and os.path.isdir(store.directory):
+            num_removed = store.remove_unreferenced(self.config.intermediate_backup_directory)
+            if num_removed:
+                self.writelog('removed %i unused chunks' % num_removed)
+            filelist.append(store.directory)
+
+class BackupPluginScheduler(object):
+    """
+    Runs a hook of all loaded plugins using a bounded number of worker
+    threads. A plugin is started once all plugins it depends on have
+    completed the hook and the concurrency limits of the plugin itself and
+    of all running plugins permit it. A failing plugin does not stop the
+    others, but all plugins depending on it are skipped and the first
+    failure is raised once all plugins have finished.
+    """
+    class Task(object):
+        def __init__(self, plugin, func):
+            self.plugin = plugin
+            self.func = func
+            self.dependencies = set(plugin.impl.dependencies or []) - set([plugin.name])
+            self.limit = plugin.impl.concurrency_limit
+            self.start = None
+            self.duration = None
+            self.exc_info = None
+            self.skipped = False
+
+        @property
+        def name(self):
+            return self.plugin.name
+
+    def __init__(self, plugins, max_workers=1, session=None):
+        self.plugins = plugins
+        self.max_workers = max(1, max_workers if max_workers else 1)
+        self.session = session
+        self._cond = threading.Condition()
+        self._running = []
+        self._done = set()
+        self._failed = set()
+
+    def _can_start(self, task, pending_names):
+        for dep in task.dependencies:
+            if dep in pending_names:
+                return False
+        num_running = len(self._running) + 1
+        if num_running > self.max_workers:
+            return False
+        if task.limit is not None and num_running > task.limit:
+            return False
+        for other in self._running:
+            if other.limit is not None and num_running > other.limit:
+                return False
+        return True
+
+    def _run_task(self, task):
+        task.start = time.time()
+        try:
+            task.func()
+        except Exception:
+            task.exc_info = sys.exc_info()
+        task.duration = time.time() - task.start
+
+    def _worker(self, task):
+        self._run_task(task)
+        with self._cond:
+            self._running.remove(task)
+            self._done.add(task.name)
+            if task.exc_info is not None:
+                self._failed.add(task.name)
+            self._cond.notify()
+
+    def run(self, cmd, **kwargs):
+        tasks = []
+        for plugin in self.plugins:
+            if hasattr(plugin.impl, cmd):
+                func = getattr(plugin.impl, cmd)
+                if func:
+                    tasks.append(BackupPluginScheduler.Task(plugin, lambda func=func: func(**kwargs)))
+
+        pending = list(tasks)
+        threads = []
+        with self._cond:
+            self._done = set()
+            self._failed = set()
+            while pending:
+                # plugins depending on a failed or skipped plugin are skipped
+                skipped = [ t for t in pending if t.dependencies & self._failed ]
+                while skipped:
+                    task = skipped.pop(0)
+                    if self.session is not None:
+                        self.session.writelog('Skip plugin %s because of failed dependencies %s' % (task.name, ','.join(sorted(task.dependencies & self._failed))))
+                    task.skipped = True
+                    pending.remove(task)
+                    self._failed.add(task.name)
+                    skipped.extend([ t for t in pending if task.name in t.dependencies and t not in skipped ])
+                if not pending:
+                    break
+                # dependencies on plugins which do not implement this hook
+                # or which are not loaded at all are ignored
+                pending_names = set([ t.name for t in pending ] + [ t.name for t in self._running ])
+                startable = [ t for t in pending if self._can_start(t, pending_names) ]
+                if not startable and not self._running:
+                    # circular dependency; start the next plugin anyway
+                    # to guarantee progress
+                    if self.session is not None:
+                        self.session.writelog('Unresolvable dependencies for plugin %s' % pending[0].name)
+                    startable = pending[0:1]
+                if startable:
+                    task = startable[0]
+                    pending.remove(task)
+                    self._running.append(task)
+                    if self.max_workers == 1:
+                        # no need for a thread if the plugins run one by one
+                        self._worker(task)
+                    else:
+                        t = threading.Thread(target=self._worker, args=(task,), name='plugin-%s' % task.name)
+                        threads.append(t)
+                        t.start()
+                else:
+                    self._cond.wait()
+        for t in threads:
+            t.join()
+
+        for task in tasks:
+            if self.session is not None and not task.skipped:
+                self.session.add_timing('plugin', '%s.%s' % (task.name, cmd), task.start, task.duration, success=task.exc_info is None)
+        # propagate the first failure to the caller
+        for task in tasks:
+            if task.exc_info is not None:
+                (ex_type, ex_value, ex_traceback) = task.exc_info
+                raise ex_value.with_traceback(ex_traceback)
+        return tasks
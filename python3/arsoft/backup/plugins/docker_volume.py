@@ -5,7 +5,13 @@
 from ..plugin import *
 from arsoft.filelist import *
 from arsoft.rsync import Rsync
-from arsoft.utils import runcmdAndGetData
+from arsoft.utils import runcmdAndGetData, which, bytes2human
+from ..dumpfile import DumpFileWriter, COMPRESSORS, get_compressor, dump_command_output, read_checksum_file
+import concurrent.futures
+import hashlib
+import subprocess
+import tempfile
+import time
 
 class DockerVolumeBackupPluginConfig(BackupPluginConfig):
     
@@ -52,6 +58,7 @@ class DockerVolumeBackupPluginConfig(BackupPluginConfig):
     def __init__(self, parent):
         BackupPluginConfig.__init__(self, parent, 'docker_volume')
         self._items = []
+        self.workers = 1
 
     @property
     def items(self):
@@ -59,6 +66,7 @@ class DockerVolumeBackupPluginConfig(BackupPluginConfig):
 
     def _read_conf(self, inifile):
         ret = True
+        self.workers = inifile.getAsInteger(None, 'Workers', 1)
         for section in inifile.sections:
             item = DockerVolumeBackupPluginConfig.DockerVolumeConfigItem(inifile, section)
             if item.read_conf():
@@ -69,6 +77,7 @@ class DockerVolumeBackupPluginConfig(BackupPluginConfig):
 
     def _write_conf(self, inifile):
         ret = True
+        inifile.setAsInteger(None, 'Workers', self.workers)
         for item in self._items:
             if not item.write_conf(inifile):
                 ret = False
@@ -76,14 +85,114 @@ class DockerVolumeBackupPluginConfig(BackupPluginConfig):
 
     def __str__(self):
         ret = BackupPluginConfig.__str__(self)
+        ret = ret + 'workers: %i\n' % self.workers
         for item in self._items:
             ret = ret + ' item %s\n' % str(item)
         return ret
 
 class DockerVolumeBackupPlugin(BackupPlugin):
+    # list of all files with size and modification time, used to detect unchanged volumes
+    MANIFEST_COMMAND = ['find', '/data', '-exec', 'stat', '-c', '%n %s %Y', '{}', '+']
+    MANIFEST_EXTENSION = '.manifest'
+
     def __init__(self, backup_app):
         self.config = DockerVolumeBackupPluginConfig(backup_app)
         BackupPlugin.__init__(self, backup_app, 'docker_volume')
+        self.docker_exe = which('docker', only_first=True)
+
+    def _docker_run_args(self, volume, *args):
+        ret = [self.docker_exe, 'run', '--rm', '-v', '%s:/data:ro' % volume, 'busybox']
+        ret.extend(args)
+        return ret
+
+    def _volume_manifest_checksum(self, volume):
+        m = hashlib.sha1()
+        p = subprocess.Popen(self._docker_run_args(volume, *self.MANIFEST_COMMAND),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+        fd = p.stdout.fileno()
+        while True:
+            data = os.read(fd, DumpFileWriter.CHUNK_SIZE)
+            if not data:
+                break
+            m.update(data)
+        p.stdout.close()
+        sts = p.wait()
+        return m.hexdigest() if sts == 0 else None
+
+    def _write_manifest_checksum(self, manifest_file, checksum):
+        tmpfile = manifest_file + '.tmp'
+        try:
+            with open(tmpfile, 'w') as f:
+                f.write(checksum)
+            os.rename(tmpfile, manifest_file)
+        except (IOError, OSError) as e:
+            self.writelog('Unable to write manifest %s, error %s.\n' % (manifest_file, e))
+
+    def _archive_volume(self, volume, backup_dir, compress, compressor):
+        start = time.time()
+        size = None
+        files = []
+        chunk_store = None
+        if compress:
+            (compressor_args, extension) = compressor
+            backup_dest_file = os.path.join(backup_dir, volume + '.tar' + extension)
+            backup_checksum_file = backup_dest_file + '.md5'
+            chunk_store = self.chunk_store
+        else:
+            backup_dest_file = os.path.join(backup_dir, volume)
+            backup_checksum_file = None
+        manifest_file = backup_dest_file + self.MANIFEST_EXTENSION
+        # the archive is replaced by the list of its chunks when deduplicating
+        archive_file = backup_dest_file + chunk_store.MANIFEST_EXTENSION if chunk_store is not None else backup_dest_file
+
+        manifest_checksum = self._volume_manifest_checksum(volume)
+        if manifest_checksum is not None and os.path.exists(archive_file) and \
+            read_checksum_file(manifest_file) == manifest_checksum:
+            self.writelog('volume %s unchanged, keep %s' % (volume, archive_file))
+            files.append(archive_file)
+            if backup_checksum_file:
+                files.append(backup_checksum_file)
+            return (True, files)
+
+        if compress:
+            self.writelog('volume %s compress to %s' % (volume, backup_dest_file))
+            # tar runs inside the container, the compression on the host
+            args = self._docker_run_args(volume, 'tar', 'c', '-f', '-', '-C', '/data', './')
+            with tempfile.TemporaryFile() as stderr_file:
+                writer = DumpFileWriter(backup_dest_file, checksum_file=backup_checksum_file, checksum_format='%s  -\n', chunk_store=chunk_store)
+                sts = dump_command_output(args, writer, compressor_args, stderr=stderr_file)
+                if sts == 0:
+                    writer.commit()
+                    size = writer.size
+                    files.extend(writer.files)
+                else:
+                    writer.abort()
+                    stderr_file.seek(0)
+                    self.writelog('Failed to archive docker volume %s, error %s' % (volume, stderr_file.read().decode('utf8', 'replace')))
+        else:
+            try:
+                if not os.path.isdir(backup_dest_file):
+                    os.makedirs(backup_dest_file)
+            except OSError as e:
+                self.writelog('Unable to create directory %s for docker volume %s, error %s.\n' % (backup_dest_file, volume, e))
+                return (False, files)
+
+            self.writelog('volume %s copy to %s' % (volume, backup_dest_file))
+            args = [self.docker_exe, 'run', '--rm', '-v', '%s:/data' % volume, '-v', '%s:/dest/data' % backup_dest_file,
+                'busybox',
+                'cp', '-a', '/data', '/dest/' ]
+            (sts, stdout_data, stderr_data) = runcmdAndGetData(args=args, shell=False,
+                verbose=True, outputStdErr=True, outputStdOut=True)
+            if sts == 0:
+                files.append(backup_dest_file)
+
+        if sts == 0 and manifest_checksum is not None:
+            self._write_manifest_checksum(manifest_file, manifest_checksum)
+        duration = time.time() - start
+        if size is not None and duration > 0:
+            self.writelog('volume %s archived %s in %.1fs (%s/s)' % (volume, bytes2human(size), duration, bytes2human(size / duration)))
+        self.backup_app.session.add_timing('docker_volume', volume, start, duration, size=size, success=sts == 0)
+        return (sts == 0, files)
 
     def perform_backup(self, **kwargs):
         ret = True
@@ -91,47 +200,29 @@ class DockerVolumeBackupPlugin(BackupPlugin):
         if not self._mkdir(backup_dir):
             self.writelog('Failed to create directory %s' % backup_dir)
             ret = False
+        if self.docker_exe is None:
+            self.writelog('Unable to find docker executable')
+            ret = False
         if ret:
-            my_stdout = self.logfile_proxy
             dir_backup_filelist = FileListItem(base_directory=self.config.base_directory)
-            for item in self.config.items:
-                for volume in item.volume_list:
-
+            num_workers = max(1, self.config.workers if self.config.workers else 1)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = []
+                for item in self.config.items:
+                    compressor = None
                     if item.compress:
-                        tar_compress = ''
-                        if item.compress_format == 'bzip2':
-                            volume_bak_file = volume + '.tar.bz2'
-                            tar_compress = '-j'
-                        elif item.compress_format == 'gzip':
-                            volume_bak_file = volume + '.tar.gz'
-                            tar_compress = '-z'
-                        elif item.compress_format == 'xz':
-                            volume_bak_file = volume + '.tar.xz'
-                            tar_compress = '-J'
-                        backup_dest_file = os.path.join(backup_dir, volume_bak_file)
-                        self.writelog('volume %s compress to %s' % (volume, backup_dest_file))
-                        args = ['/usr/bin/docker', 'run', '--rm', '-v', '%s:/data' % volume, '-v', '%s:/dest' % backup_dir, 
-                            'busybox', 
-                            'tar', 'c', tar_compress, '-f', '/dest/%s' % volume_bak_file, '-C', '/data', './' ]
-                    else:
-                        backup_dest_file = os.path.join(backup_dir, volume)
-                        try:
-                            if not os.path.isdir(backup_dest_file):
-                                os.makedirs(backup_dest_file)
-                        except OSError as e:
-                            self.writelog('Unable to create directory %s for docker volume %s, error %s.\n' % (backup_dest_file, volume, e))
-                            backup_dest_file = None
-
-                        self.writelog('volume %s copy to %s' % (volume, backup_dest_file))
-                        args = ['/usr/bin/docker', 'run', '--rm', '-v', '%s:/data' % volume, '-v', '%s:/dest/data' % backup_dest_file, 
-                            'busybox', 
-                            'cp', '-a', '/data', '/dest/' ]
-                    if backup_dest_file:
-                        (sts, stdout_data, stderr_data) = runcmdAndGetData(executable='/usr/bin/docker', args=args, shell=False, 
-                            verbose=True, outputStdErr=True, outputStdOut=True)
-                        if sts == 0:
-                            dir_backup_filelist.append(backup_dest_file)
+                        compressor = get_compressor(item.compress_format)
+                        if compressor is None:
+                            self.writelog('Compressor %s not available (supported: %s).' % (item.compress_format, ','.join(sorted(COMPRESSORS.keys()))))
+                            ret = False
+                            continue
+                    for volume in item.volume_list:
+                        futures.append(executor.submit(self._archive_volume, volume, backup_dir, item.compress, compressor))
+                for future in futures:
+                    (volume_ret, files) = future.result()
+                    for f in files:
+                        dir_backup_filelist.append(f)
+            self._append_chunk_store(dir_backup_filelist)
             self.backup_app.append_to_filelist(dir_backup_filelist)
 
         return ret
-
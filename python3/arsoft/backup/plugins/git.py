@@ -8,6 +8,10 @@ from arsoft.filelist import *
 from arsoft.git.repo import *
 from arsoft.git.bundle import GitBundle
 from arsoft.git.error import *
+import concurrent.futures
+import threading
+import time
+import urllib.parse
 
 class GitBackupPluginConfig(BackupPluginConfig):
 
@@ -32,6 +36,12 @@ class GitBackupPluginConfig(BackupPluginConfig):
             ret = True if idx > 0 else False
             return ret
 
+        @property
+        def remote_host(self):
+            if not self.is_remote:
+                return None
+            return urllib.parse.urlsplit(self.url).hostname
+
         def __str__(self):
             if self.name:
                 return '%s (%s)' % (self.name, self.url)
@@ -41,6 +51,8 @@ class GitBackupPluginConfig(BackupPluginConfig):
         BackupPluginConfig.__init__(self, parent, 'git')
         self._repository_list = None
         self._filelist = None
+        self.workers = 1
+        self.max_per_host = 2
 
     def _list_to_repo_items(self, repo_url_list):
         self._repository_list = []
@@ -56,6 +68,8 @@ class GitBackupPluginConfig(BackupPluginConfig):
         self._repository_list = value
 
     def _read_conf(self, inifile):
+        self.workers = inifile.getAsInteger(None, 'Workers', 1)
+        self.max_per_host = inifile.getAsInteger(None, 'MaxPerHost', 2)
         repo_url_list = FileList.from_list(inifile.getAsArray(None, 'Repositories', []), base_directory=None, use_glob=True)
         self._list_to_repo_items(repo_url_list)
         for sect in inifile.sections:
@@ -68,6 +82,8 @@ class GitBackupPluginConfig(BackupPluginConfig):
         return True
     
     def _write_conf(self, inifile):
+        inifile.setAsInteger(None, 'Workers', self.workers)
+        inifile.setAsInteger(None, 'MaxPerHost', self.max_per_host)
         #filelist_path = os.path.join(config_dir, BackupConfigDefaults.REPOSITORY_LIST)
         #if self._repository_list:
             #self._repository_list.save(filelist_path)
@@ -79,6 +95,8 @@ class GitBackupPluginConfig(BackupPluginConfig):
 
     def __str__(self):
         ret = BackupPluginConfig.__str__(self)
+        ret = ret + 'workers: %i\n' % self.workers
+        ret = ret + 'max per host: %i\n' % self.max_per_host
         ret = ret + 'repositories:\n'
         if self._repository_list:
             for item in self._repository_list:
@@ -90,6 +108,16 @@ class GitBackupPlugin(BackupPlugin):
     def __init__(self, backup_app):
         self.config = GitBackupPluginConfig(backup_app)
         BackupPlugin.__init__(self, backup_app, 'git')
+        self._host_limits = {}
+        self._host_limits_lock = threading.Lock()
+
+    def _host_limit(self, hostname):
+        with self._host_limits_lock:
+            sem = self._host_limits.get(hostname)
+            if sem is None:
+                sem = threading.BoundedSemaphore(max(1, self.config.max_per_host))
+                self._host_limits[hostname] = sem
+            return sem
 
     def _git_backup_to_bundle(self, repository, bundle_file):
         ret = False
@@ -136,6 +164,59 @@ class GitBackupPlugin(BackupPlugin):
                 ret = False
         return ret
 
+    def _backup_repository(self, repo_item, backup_dir):
+        ret = True
+        bundle_file = None
+        if repo_item.is_remote:
+            local_repo_path = os.path.join(backup_dir, repo_item.name + '.git')
+            # limit the number of concurrent fetches from a single server
+            with self._host_limit(repo_item.remote_host):
+                if not self.update_remote_repo(local_repo_path, repo_item.url):
+                    local_repo_path = None
+        else:
+            local_repo_path = repo_item.url
+        repo = GitRepository(local_repo_path, verbose=self.backup_app._verbose) if local_repo_path else None
+        if repo:
+            if repo.valid:
+                if repo.empty:
+                    sys.stderr.write('Repository %s is empty. Skip\n' % str(repo_item))
+                    ret = False
+                else:
+                    bundle_file = os.path.join(backup_dir, repo.name + '.git_bundle')
+                    if self.backup_app._verbose:
+                        print('backup %s to %s' % (repo_item.url, bundle_file))
+                    if not self._git_backup_to_bundle(repo, bundle_file):
+                        bundle_file = None
+                        ret = False
+            else:
+                sys.stderr.write('Repository %s is invalid\n' % str(repo_item))
+                ret = False
+        else:
+            sys.stderr.write('Failed to load repository %s\n' % str(repo_item))
+            ret = False
+        return (ret, bundle_file)
+
+    def _timed_backup_repository(self, repo_item, backup_dir):
+        start = time.time()
+        (ret, bundle_file) = self._backup_repository(repo_item, backup_dir)
+        size = None
+        if bundle_file:
+            try:
+                size = os.path.getsize(bundle_file)
+            except OSError:
+                pass
+        self.backup_app.session.add_timing('git', repo_item.name, start, time.time() - start, size=size, success=ret)
+        return (ret, bundle_file)
+
+    def _ordered_repository_list(self):
+        # start the repositories which took the longest last time first, so
+        # they do not end up as stragglers. Unknown repositories go first.
+        last_durations = self.backup_app.job_state.history.last_durations('git')
+        def _sort_key(repo_item):
+            duration = last_durations.get(repo_item.name)
+            return -duration if duration is not None else float('-inf')
+        return sorted(self.config.repository_list, key=_sort_key)
+
     def perform_backup(self, **kwargs):
         ret = True
         backup_dir = self.config.intermediate_backup_directory
@@ -143,35 +224,18 @@ class GitBackupPlugin(BackupPlugin):
             ret = False
         if ret:
             repo_backup_filelist = FileListItem(base_directory=self.config.base_directory)
-            for repo_item in self.config.repository_list:
-                if repo_item.is_remote:
-                    local_repo_path = os.path.join(backup_dir, repo_item.name + '.git')
-                    if not self.update_remote_repo(local_repo_path, repo_item.url):
-                        local_repo_path = None
-                else:
-                    local_repo_path = repo_item.url
-                repo = GitRepository(local_repo_path, verbose=self.backup_app._verbose) if local_repo_path else None
-                if repo:
-                    if repo.valid:
-                        if repo.empty:
-                            sys.stderr.write('Repository %s is empty. Skip\n' % str(repo_item))
-                            ret = False
-                        else:
-                            bundle_file = os.path.join(backup_dir, repo.name + '.git_bundle')
-                            if self.backup_app._verbose:
-                                print('backup %s to %s' % (repo_item.url, bundle_file))
-                            if not self._git_backup_to_bundle(repo, bundle_file):
-                                ret = False
-                            else:
-                                repo_backup_filelist.append(bundle_file)
-                    else:
-                        sys.stderr.write('Repository %s is invalid\n' % str(repo_item))
+            repository_list = self._ordered_repository_list()
+            num_workers = max(1, self.config.workers if self.config.workers else 1)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [ executor.submit(self._timed_backup_repository, repo_item, backup_dir)
+                           for repo_item in repository_list ]
+                for future in futures:
+                    (repo_ret, bundle_file) = future.result()
+                    if not repo_ret:
                         ret = False
-                else:
-                    sys.stderr.write('Failed to load repository %s\n' % str(repo_item))
-                    ret = False
+                    if bundle_file:
+                        repo_backup_filelist.append(bundle_file)
             #print(repo_backup_filelist)
             self.backup_app.append_to_filelist(repo_backup_filelist)
             #print(self.intermediate_filelist)
         return ret
- 
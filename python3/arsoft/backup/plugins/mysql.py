@@ -3,21 +3,23 @@
 # kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
 
 from ..plugin import *
+from ..dumpfile import DumpFileWriter, dump_command_output, get_compressor, COMPRESSORS
 from arsoft.filelist import *
 from arsoft.utils import which
 
 import subprocess
 import sys
+import time
 import tempfile
-import hashlib
+import concurrent.futures
 
 (python_major, python_minor, python_micro, python_releaselevel, python_serial) = sys.version_info
 
-def mysqldump(exe, zip_exe, checksum_exe, dumpfile, checksum_file, socket=None, hostname=None, port=None, username=None, password=None, database=None, compress=True, verbose=False):
+def mysqldump(exe, compressor_args, dumpfile, checksum_file, socket=None, hostname=None, port=None, username=None, password=None, database=None, compress=True, verbose=False, chunk_store=None):
     sts = -1
     stdoutdata = None
     stderrdata = None
-    with tempfile.NamedTemporaryFile() as defaults_file:
+    with tempfile.NamedTemporaryFile() as defaults_file, tempfile.TemporaryFile() as stderr_file:
         all_args = [exe]
         all_args.append('--defaults-file=%s' % defaults_file.name)
         all_args.append('--opt')
@@ -36,10 +38,9 @@ def mysqldump(exe, zip_exe, checksum_exe, dumpfile, checksum_file, socket=None,
         if database:
             if isinstance(database, list):
                 all_args.append('--databases')
-                for d in database:
-                    all_args.append('"%s"' % d)
+                all_args.extend(database)
             else:
-                all_args.append('"%s"' % database)
+                all_args.append(database)
         else:
             all_args.append('--all-databases')
 
@@ -48,32 +49,17 @@ def mysqldump(exe, zip_exe, checksum_exe, dumpfile, checksum_file, socket=None,
             defaults_file.flush()
             defaults_file.seek(0)
 
-        all_args.extend(['|', zip_exe ])
-        all_args.extend(['|', 'tee', dumpfile ])
-        all_args.extend(['|', checksum_exe ])
-
         if verbose:
-            print("mysqldump " + ' '.join(all_args))
-
-        f_checksum = open(checksum_file, 'w')
-        p = subprocess.Popen(' '.join(all_args), stdout=f_checksum, stderr=subprocess.PIPE, stdin=None, shell=True)
-        if p:
-            (stdoutdata, stderrdata) = p.communicate()
-            sts = p.returncode
-        f_checksum.close()
-    return sts, stdoutdata, stderrdata
-
-def read_checksum_file(filename):
-    ret = None
-    try:
-        with open(filename, 'r') as content_file:
-            first_line = content_file.readline()
-            if first_line and ' ' in first_line:
-                (digest, digest_name) = first_line.split(' ', 1)
-                ret = digest
-    except IOError:
-        pass
-    return ret
+            print("mysqldump " + ' '.join(all_args) + (' | ' + ' '.join(compressor_args) if compressor_args else ''))
+
+        # the checksum is computed while the compressed dump is written
+        writer = DumpFileWriter(dumpfile, checksum_file=checksum_file, checksum_format='%s  -\n', chunk_store=chunk_store)
+        sts = dump_command_output(all_args, writer, compressor_args, stderr=stderr_file)
+        stderr_file.seek(0)
+        stderrdata = stderr_file.read()
+        if sts != 0:
+            writer.abort()
+    return sts, writer, stderrdata
 
 class MysqlBackupPluginConfig(BackupPluginConfig):
 
@@ -95,6 +81,8 @@ class MysqlBackupPluginConfig(BackupPluginConfig):
     def __init__(self, parent):
         BackupPluginConfig.__init__(self, parent, 'mysql')
         self._database_list = []
+        self.compressor = 'bzip2'
+        self.parallel = 1
 
     @property
     def database_list(self):
@@ -105,6 +93,8 @@ class MysqlBackupPluginConfig(BackupPluginConfig):
         self._database_list = value
 
     def _read_conf(self, inifile):
+        self.compressor = inifile.get(None, 'Compressor', 'bzip2')
+        self.parallel = inifile.getAsInteger(None, 'Parallel', 1)
         for sect in inifile.sections:
             db_name = inifile.get(sect, 'database', None)
             db_host = inifile.get(sect, 'host', None)
@@ -123,6 +113,8 @@ class MysqlBackupPluginConfig(BackupPluginConfig):
 
     def __str__(self):
         ret = BackupPluginConfig.__str__(self)
+        ret = ret + 'compressor: %s\n' % self.compressor
+        ret = ret + 'parallel: %i\n' % self.parallel
         ret = ret + 'databases:\n'
         if self._database_list:
             for item in self._database_list:
@@ -140,8 +132,27 @@ class MysqlBackupPlugin(BackupPlugin):
         self.config = MysqlBackupPluginConfig(backup_app)
         BackupPlugin.__init__(self, backup_app, 'mysql')
         self.mysqldump_exe = which('mysqldump', only_first=True)
-        self.zip_exe = which('bzip2', only_first=True)
-        self.checksum_exe = which('md5sum', only_first=True)
+
+    def _dump_database(self, database_item, backup_dir, compressor_args, extension):
+        if self.backup_app._verbose:
+            print('backup %s' % str(database_item))
+        db_dumpfile = os.path.join(backup_dir, database_item.database + '.mysql' + extension)
+        db_checksumfile = db_dumpfile + '.md5'
+
+        start = time.time()
+        sts, writer, stderrdata = mysqldump(self.mysqldump_exe, compressor_args,
+                        db_dumpfile, db_checksumfile,
+                        database=database_item.database,
+                        socket=database_item.socket,
+                        hostname=database_item.hostname, port=database_item.port,
+                        username=database_item.username, password=database_item.password,
+                        verbose=self.backup_app._verbose,
+                        chunk_store=self.chunk_store)
+        if sts == 0:
+            # replaces the previous dump only if the checksum differs
+            writer.commit()
+        self.backup_app.session.add_timing('mysql', database_item.database, start, time.time() - start, size=writer.size, success=sts == 0)
+        return (sts, stderrdata, writer.files)
 
     def perform_backup(self, **kwargs):
         ret = True
@@ -151,43 +162,28 @@ class MysqlBackupPlugin(BackupPlugin):
         if not self.mysqldump_exe:
             sys.stderr.write('mysqldump not found.\n')
             ret = False
+        compressor = get_compressor(self.config.compressor)
+        if compressor is None:
+            sys.stderr.write('Compressor %s not available (supported: %s).\n' % (self.config.compressor, ','.join(sorted(COMPRESSORS.keys()))))
+            ret = False
         if ret:
+            (compressor_args, extension) = compressor
             mysql_backup_filelist = FileListItem(base_directory=self.config.base_directory)
-            for database_item in self.config.database_list:
-                if self.backup_app._verbose:
-                    print('backup %s' % str(database_item))
-                db_dumpfile = os.path.join(backup_dir, database_item.database + '.mysql.bz2')
-                db_checksumfile = db_dumpfile + '.md5'
-
-                db_dumpfile_tmp = db_dumpfile + '.tmp'
-                db_checksumfile_tmp = db_dumpfile_tmp + '.md5'
-
-                sts, stdoutdata, stderrdata = mysqldump(self.mysqldump_exe, self.zip_exe, self.checksum_exe,
-                                db_dumpfile_tmp, db_checksumfile_tmp,
-                                database=database_item.database,
-                                socket=database_item.socket,
-                                hostname=database_item.hostname, port=database_item.port,
-                                username=database_item.username, password=database_item.password,
-                                verbose=self.backup_app._verbose)
-                if sts != 0:
-                    sys.stderr.write('Dump of database %s failed. %s\n' % (str(database_item), stderrdata))
-                    ret = False
-                else:
-                    checksum = read_checksum_file(db_checksumfile)
-                    checksum_tmp = read_checksum_file(db_checksumfile_tmp)
-
-                    if checksum == checksum_tmp:
-                        os.remove(db_dumpfile_tmp)
-                        os.remove(db_checksumfile_tmp)
+            num_workers = max(1, self.config.parallel if self.config.parallel else 1)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [ executor.submit(self._dump_database, database_item, backup_dir, compressor_args, extension)
+                           for database_item in self.config.database_list ]
+                for database_item, future in zip(self.config.database_list, futures):
+                    (sts, stderrdata, files) = future.result()
+                    if sts != 0:
+                        sys.stderr.write('Dump of database %s failed. %s\n' % (str(database_item), stderrdata))
+                        ret = False
                     else:
-                        os.rename(db_dumpfile_tmp, db_dumpfile)
-                        os.rename(db_checksumfile_tmp, db_checksumfile)
-
-                    mysql_backup_filelist.append(db_dumpfile)
-                    mysql_backup_filelist.append(db_checksumfile)
+                        for f in files:
+                            mysql_backup_filelist.append(f)
+            self._append_chunk_store(mysql_backup_filelist)
 
             #print(mysql_backup_filelist)
             self.backup_app.append_to_filelist(mysql_backup_filelist)
             #print(self.intermediate_filelist)
         return ret
- 
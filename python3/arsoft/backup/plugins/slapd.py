@@ -6,7 +6,10 @@ from ..plugin import *
 from arsoft.filelist import *
 from arsoft.utils import which
 from arsoft.sshutils import SudoSessionException
-import hashlib
+from ..dumpfile import DumpFileWriter, COMPRESSORS, get_compressor, compress_stream
+import tempfile
+import threading
+import time
 import sys
 
 class SlapdBackupPluginConfig(BackupPluginConfig):
@@ -25,6 +28,7 @@ class SlapdBackupPluginConfig(BackupPluginConfig):
     def __init__(self, parent):
         BackupPluginConfig.__init__(self, parent, 'slapd')
         self._server_list = []
+        self._compressor = 'none'
 
     @property
     def server_list(self):
@@ -34,7 +38,16 @@ class SlapdBackupPluginConfig(BackupPluginConfig):
     def server_list(self, value):
         self._server_list = value
 
+    @property
+    def compressor(self):
+        return self._compressor
+
+    @compressor.setter
+    def compressor(self, value):
+        self._compressor = value
+
     def _read_conf(self, inifile):
+        self._compressor = inifile.get(None, 'Compressor', 'none')
         for sect in inifile.sections:
             hostname = inifile.get(sect, 'host', None)
             port = inifile.getAsInteger(sect, 'port', 22)
@@ -47,10 +60,12 @@ class SlapdBackupPluginConfig(BackupPluginConfig):
         return True
 
     def _write_conf(self, inifile):
+        inifile.set(None, 'Compressor', self._compressor)
         return True
 
     def __str__(self):
         ret = BackupPluginConfig.__str__(self)
+        ret = ret + 'compressor: %s\n' % self._compressor
         ret = ret + 'servers:\n'
         if self._server_list:
             for item in self._server_list:
@@ -66,53 +81,83 @@ class SlapdBackupPlugin(BackupPlugin):
         BackupPlugin.__init__(self, backup_app, 'slapd')
         self.slapcat_exe = which('slapcat', only_first=True)
 
-    def _update_dump_file(self, dest_file, dump_data):
-        m = hashlib.md5()
-        m.update(dump_data)
-        new_checksum = m.hexdigest()
-
-        old_checksum = None
+    def _dump_server(self, cxn, exe, dumpfile, checksum_file, compressor_args):
+        # slapcat writes into a pipe which is drained by a reader thread (optionally
+        # through the compressor), so the dump never has to be kept in memory.
+        writer = DumpFileWriter(dumpfile, checksum_file=checksum_file, chunk_store=self.chunk_store)
         try:
-            f = open(dest_file + '.md5', 'r')
-            old_checksum = f.read().strip()
-            f.close()
-        except IOError:
-            pass
-
-        ret = True
-        if old_checksum != new_checksum:
+            (sts, stderr_data) = self._run_slapcat(cxn, exe, writer, compressor_args)
+        except BaseException:
+            # never leave the partial dump (including password hashes) behind
+            writer.abort()
+            raise
+        if sts != 0:
+            writer.abort()
+        return (sts, writer, stderr_data)
+
+    def _run_slapcat(self, cxn, exe, writer, compressor_args):
+        (read_fd, write_fd) = os.pipe()
+        if compressor_args:
             try:
-                f = open(dest_file, 'w')
-                f.write(dump_data.decode())
-                # protect the file content (includes passwords and other sensitive information)
-                # from the rest of the world.
-                os.fchmod(f.fileno(), 0o600)
-                f.close()
-                f = open(dest_file + '.md5', 'w')
-                f.write(new_checksum)
-                # same for checksump file not necessary, but looks better.
-                os.fchmod(f.fileno(), 0o600)
-                f.close()
-            except IOError:
-                ret = False
-        return ret
+                zp = compress_stream(compressor_args, read_fd)
+            except:
+                os.close(write_fd)
+                raise
+            finally:
+                os.close(read_fd)
+            source = zp.stdout
+        else:
+            zp = None
+            source = os.fdopen(read_fd, 'rb', buffering=0)
+        reader_errors = []
+        def _reader():
+            try:
+                writer.copy_from(source)
+            except (IOError, OSError) as e:
+                reader_errors.append(e)
+        reader = threading.Thread(target=_reader, name='slapd-dump-reader')
+        reader.start()
+        sts = -1
+        stderr_data = None
+        with tempfile.TemporaryFile() as stderr_file:
+            try:
+                (sts, stdout_data, stderr_data) = cxn.runcmdAndGetData(args=[exe], sudo=True, outputStdErr=False, outputStdOut=False,
+                                                                       stdout=write_fd, stderr=stderr_file)
+            finally:
+                # closing our end of the pipe signals EOF to the reader
+                os.close(write_fd)
+                reader.join()
+                source.close()
+                zip_sts = zp.wait() if zp is not None else 0
+            stderr_file.seek(0)
+            stderr_data = stderr_file.read().decode('utf8', 'replace')
+        if sts == 0:
+            sts = zip_sts
+        if reader_errors:
+            stderr_data = str(reader_errors[0])
+            sts = -1
+        return (sts, stderr_data)
 
     def perform_backup(self, **kwargs):
         ret = True
         backup_dir = self.config.intermediate_backup_directory
         if not self._mkdir(backup_dir):
             ret = False
+        compressor = get_compressor(self.config.compressor)
+        if compressor is None:
+            sys.stderr.write('Compressor %s not available (supported: %s).\n' % (self.config.compressor, ','.join(sorted(COMPRESSORS.keys()))))
+            ret = False
         if ret:
+            (compressor_args, extension) = compressor
             slapd_backup_filelist = FileListItem(base_directory=self.config.base_directory)
 
             for server in self.config.server_list:
                 if self.backup_app._verbose:
                     print('backup LDAP server %s' % str(server))
 
-                slapd_dumpfile = os.path.join(backup_dir, server.name + '.ldif')
+                slapd_dumpfile = os.path.join(backup_dir, server.name + '.ldif' + extension)
                 slapd_checksumfile = slapd_dumpfile + '.md5'
 
-                slapd_dump_data = None
                 exe = 'slapcat'
                 if self.backup_app.is_localhost(server.hostname):
                     if self.slapcat_exe is None:
@@ -130,21 +175,25 @@ class SlapdBackupPlugin(BackupPlugin):
                         print('use remote server %s' % str(server_item))
                     if server_item:
                         cxn = server_item.connection
+                        start = time.time()
                         try:
-                            (sts, stdout_data, stderr_data) = cxn.runcmdAndGetData(args=[exe], sudo=True, outputStdErr=False, outputStdOut=False)
+                            (sts, writer, stderr_data) = self._dump_server(cxn, exe, slapd_dumpfile, slapd_checksumfile, compressor_args)
                             if sts != 0:
                                 sys.stderr.write('slapcat failed, error %s\n' % stderr_data)
                                 ret = False
                             else:
-                                slapd_dump_data = stdout_data
+                                # replaces the previous dump only if the checksum differs
+                                writer.commit()
+                                for f in writer.files:
+                                    slapd_backup_filelist.append(f)
+                            self.backup_app.session.add_timing('slapd', server.name, start, time.time() - start, size=writer.size, success=sts == 0)
                         except SudoSessionException as e:
                             sys.stderr.write('slapcat failed, because sudo failed: %s.\n' % str(e))
                             ret = False
-                if ret and slapd_dump_data:
-                    ret = self._update_dump_file(slapd_dumpfile, slapd_dump_data)
-                    if ret:
-                        slapd_backup_filelist.append(slapd_dumpfile)
-                        slapd_backup_filelist.append(slapd_checksumfile)
+                        except (IOError, OSError) as e:
+                            sys.stderr.write('Failed to write LDAP dump %s: %s.\n' % (slapd_dumpfile, str(e)))
+                            ret = False
 
+            self._append_chunk_store(slapd_backup_filelist)
             self.backup_app.append_to_filelist(slapd_backup_filelist)
         return ret
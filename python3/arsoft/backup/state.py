@@ -5,18 +5,203 @@
 import sys
 import os.path
 import datetime
+import sqlite3
+import threading
 from arsoft.inifile import IniFile
 from arsoft.timestamp import timestamp_from_datetime
 from arsoft.disks.disk import Drive
 from arsoft.utils import logfile_writer_proxy
+from .statistics import BackupStatistics
 
 class BackupStateDefaults(object):
     JOB_STATE_CONF = 'backup_job.state'
+    CATALOG_FILE = 'backup_catalog.db'
     HISTORY_FILE_PREFIX = 'backup_run_'
     HISTORY_FILE_EXTENSION = '.state'
     LOG_FILE_EXTENSION = '.log'
     TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
 
+class BackupTiming(object):
+    def __init__(self, category, name, start, duration, size=None, success=True):
+        self.category = category
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.size = size
+        self.success = success
+
+    @property
+    def throughput(self):
+        if self.size is None or not self.duration:
+            return None
+        return self.size / self.duration
+
+    def __str__(self):
+        if self.size is None:
+            return '%s %s: %.3fs%s' % (self.category, self.name, self.duration, '' if self.success else ' (failed)')
+        else:
+            return '%s %s: %.3fs, %i bytes%s' % (self.category, self.name, self.duration, self.size, '' if self.success else ' (failed)')
+
+class BackupJobCatalog(object):
+    """
+    Keeps the state of all backup sessions of a job in a single SQLite
+    database instead of one INI file per session. Sessions are indexed by
+    their unique name (the timestamp string) and by start date/backup dir.
+    """
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS sessions (name TEXT PRIMARY KEY, date REAL NOT NULL, success INTEGER NOT NULL DEFAULT 0, ' \
+            'failure_message TEXT, start REAL, end REAL, backup_dir TEXT, backup_disk TEXT)',
+        'CREATE INDEX IF NOT EXISTS sessions_date ON sessions (date, backup_dir)',
+        'CREATE TABLE IF NOT EXISTS timings (session TEXT NOT NULL, category TEXT NOT NULL, name TEXT NOT NULL, ' \
+            'start REAL, duration REAL, size INTEGER, success INTEGER NOT NULL DEFAULT 1)',
+        'CREATE INDEX IF NOT EXISTS timings_session ON timings (session, category)',
+        'CREATE TABLE IF NOT EXISTS statistics (backup_dir TEXT PRIMARY KEY, data TEXT NOT NULL)',
+        ]
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.filename = os.path.join(state_dir, BackupStateDefaults.CATALOG_FILE)
+        self._cxn = None
+        # timings are recorded from the worker threads of the plugins
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _to_timestamp(value):
+        return timestamp_from_datetime(value) if value is not None else None
+
+    @staticmethod
+    def _from_timestamp(value):
+        return datetime.datetime.fromtimestamp(value) if value is not None else None
+
+    def open(self):
+        if self._cxn is None:
+            if not os.path.isdir(self.state_dir):
+                return False
+            try:
+                self._cxn = sqlite3.connect(self.filename, check_same_thread=False)
+                with self._cxn:
+                    for stmt in BackupJobCatalog.SCHEMA:
+                        self._cxn.execute(stmt)
+            except sqlite3.Error as e:
+                sys.stderr.write('Failed to open backup catalog %s; error %s\n' % (self.filename, str(e)) )
+                self._cxn = None
+        return True if self._cxn is not None else False
+
+    def close(self):
+        if self._cxn is not None:
+            self._cxn.close()
+            self._cxn = None
+
+    def load(self):
+        ret = {}
+        if self.open():
+            cur = self._cxn.execute('SELECT name, success, failure_message, start, end, backup_dir, backup_disk FROM sessions ORDER BY date')
+            for (name, success, failure_message, start, end, backup_dir, backup_disk) in cur:
+                ret[name] = (True if success else False, failure_message,
+                             self._from_timestamp(start), self._from_timestamp(end),
+                             backup_dir, backup_disk)
+        return ret
+
+    def store(self, item):
+        with self._lock:
+            if not self.open():
+                return False
+            with self._cxn:
+                self._cxn.execute('INSERT OR REPLACE INTO sessions (name, date, success, failure_message, start, end, backup_dir, backup_disk) ' \
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                  (item.unique_name, item.timestamp, 1 if item._success else 0, item._failure_message,
+                                   self._to_timestamp(item._startdate), self._to_timestamp(item._enddate),
+                                   item._backup_dir, item._backup_disk) )
+        return True
+
+    def is_legacy_imported(self):
+        # the state files of previous versions only need to be imported once,
+        # which is recorded in the user version of the database
+        with self._lock:
+            if not self.open():
+                return False
+            (version,) = self._cxn.execute('PRAGMA user_version').fetchone()
+        return True if version >= 1 else False
+
+    def set_legacy_imported(self):
+        with self._lock:
+            if not self.open():
+                return False
+            with self._cxn:
+                self._cxn.execute('PRAGMA user_version=1')
+        return True
+
+    def remove(self, items):
+        with self._lock:
+            if not self.open():
+                return False
+            with self._cxn:
+                names = [ (item.unique_name,) for item in items ]
+                self._cxn.executemany('DELETE FROM timings WHERE session=?', names)
+                self._cxn.executemany('DELETE FROM sessions WHERE name=?', names)
+        return True
+
+    def add_timing(self, item, timing):
+        with self._lock:
+            if not self.open():
+                return False
+            with self._cxn:
+                self._cxn.execute('INSERT INTO timings (session, category, name, start, duration, size, success) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  (item.unique_name, timing.category, timing.name, timing.start, timing.duration,
+                                   timing.size, 1 if timing.success else 0) )
+        return True
+
+    def get_timings(self, item, category=None):
+        ret = []
+        with self._lock:
+            if self.open():
+                if category is None:
+                    cur = self._cxn.execute('SELECT category, name, start, duration, size, success FROM timings WHERE session=? ORDER BY start',
+                                            (item.unique_name,) )
+                else:
+                    cur = self._cxn.execute('SELECT category, name, start, duration, size, success FROM timings WHERE session=? AND category=? ORDER BY start',
+                                            (item.unique_name, category) )
+                for (category, name, start, duration, size, success) in cur:
+                    ret.append(BackupTiming(category, name, start, duration, size, True if success else False))
+        return ret
+
+    def get_statistics(self, backup_dir):
+        ret = None
+        with self._lock:
+            if self.open():
+                row = self._cxn.execute('SELECT data FROM statistics WHERE backup_dir=?', (backup_dir,) ).fetchone()
+                if row is not None:
+                    ret = BackupStatistics.from_json(row[0])
+        return ret
+
+    def set_statistics(self, backup_dir, statistics):
+        with self._lock:
+            if not self.open():
+                return False
+            with self._cxn:
+                self._cxn.execute('INSERT OR REPLACE INTO statistics (backup_dir, data) VALUES (?, ?)', (backup_dir, statistics.to_json()) )
+        return True
+
+    def remove_statistics(self, backup_dirs):
+        with self._lock:
+            if not self.open():
+                return False
+            with self._cxn:
+                self._cxn.executemany('DELETE FROM statistics WHERE backup_dir=?', [ (d,) for d in backup_dirs ])
+        return True
+
+    def get_last_durations(self, category):
+        ret = {}
+        with self._lock:
+            if self.open():
+                # timings are inserted in chronological order, so the row with
+                # the highest rowid is the most recent one for each name
+                cur = self._cxn.execute('SELECT name, duration FROM timings WHERE rowid IN ' \
+                                        '(SELECT MAX(rowid) FROM timings WHERE category=? GROUP BY name)', (category,) )
+                for (name, duration) in cur:
+                    ret[name] = duration
+        return ret
+
 class BackupJobHistoryItem(object):
     def __init__(self, parent, filename, temporary=False, verbose=False):
         self.parent = parent
@@ -39,6 +224,8 @@ class BackupJobHistoryItem(object):
         self._backup_dir = None
         self._backup_disk = None
         self._verbose = verbose
+        self._timings = []
+        self._log_lock = threading.Lock()
 
     @staticmethod
     def create(parent, state_dir, temporary=False, verbose=False):
@@ -116,10 +303,15 @@ class BackupJobHistoryItem(object):
         else:
             raise ValueError("invalid value for backup_disk %s" % value)
 
+    def _set_state(self, state):
+        (self._success, self._failure_message, self._startdate, self._enddate, self._backup_dir, self._backup_disk) = state
+        self._require_read = False
+
     def _read_state(self):
         if self.temporary:
             ret = True
         else:
+            # only used to import legacy state files into the catalog
             inifile = IniFile(commentPrefix='#', keyValueSeperator='=', disabled_values=False)
             ret = inifile.open(self.filename)
             self._success = inifile.getAsBoolean(None, 'Success', False)
@@ -135,16 +327,7 @@ class BackupJobHistoryItem(object):
         if self.temporary:
             ret = True
         else:
-            inifile = IniFile(commentPrefix='#', keyValueSeperator='=', disabled_values=False)
-            # read existing file
-            inifile.open(self.filename)
-            inifile.setAsBoolean(None, 'Success', self._success)
-            inifile.set(None, 'FailureMessage', self._failure_message)
-            inifile.setAsTimestamp(None, 'Start', self._startdate)
-            inifile.setAsTimestamp(None, 'End', self._enddate)
-            inifile.set(None, 'BackupDir', self._backup_dir)
-            inifile.set(None, 'BackupDisc', self._backup_disk)
-            ret = inifile.save(self.filename)
+            ret = self.parent.catalog.store(self)
             if ret:
                 self.parent._item_changed(self)
                 self._require_read = False
@@ -165,14 +348,30 @@ class BackupJobHistoryItem(object):
         return self._logfile_proxy
 
     def writelog(self, *args, plugin=None):
-        proxy = self.openlog()
-        if proxy:
-            proxy.write(*args)
-        if self._verbose:
-            if plugin is not None:
-                sys.stdout.write(('[%s]' % plugin) + ' '.join(args) + '\n')
-            else:
-                sys.stdout.write(' '.join(args) + '\n')
+        with self._log_lock:
+            proxy = self.openlog()
+            if proxy:
+                proxy.write(*args)
+            if self._verbose:
+                if plugin is not None:
+                    sys.stdout.write(('[%s]' % plugin) + ' '.join(args) + '\n')
+                else:
+                    sys.stdout.write(' '.join(args) + '\n')
+
+    def add_timing(self, category, name, start, duration, size=None, success=True):
+        timing = BackupTiming(category, name, start, duration, size=size, success=success)
+        if self.temporary:
+            self._timings.append(timing)
+            ret = True
+        else:
+            ret = self.parent.catalog.add_timing(self, timing)
+        return ret
+
+    def timings(self, category=None):
+        if self.temporary:
+            return [ t for t in self._timings if category is None or t.category == category ]
+        else:
+            return self.parent.catalog.get_timings(self, category)
 
     @property
     def logfile_proxy(self):
@@ -193,30 +392,84 @@ class BackupJobHistory(object):
     def __init__(self, job_state, state_dir):
         self.job_state = job_state
         self.state_dir = state_dir
+        self.catalog = BackupJobCatalog(state_dir) if state_dir else None
         self._items = None
+        self._items_by_date = None
+
+    def _import_legacy_items(self, known_items):
+        # pick up all state files from previous versions which are not yet
+        # recorded in the catalog, store them in the catalog and remove them
+        ret = []
+        if self.catalog.is_legacy_imported():
+            return ret
+        complete = True
+        for itemname in os.listdir(self.state_dir):
+            fullpath = os.path.join(self.state_dir, itemname)
+            if BackupJobHistoryItem.is_history_item(fullpath):
+                item = BackupJobHistoryItem(self, fullpath)
+                if item.unique_name not in known_items:
+                    item._read_state()
+                    if not self.catalog.store(item):
+                        complete = False
+                        continue
+                    ret.append(item)
+                try:
+                    os.unlink(fullpath)
+                except OSError:
+                    complete = False
+        if complete:
+            self.catalog.set_legacy_imported()
+        return ret
 
     def load(self):
         if self._items is None:
             tmp_items = []
-            if os.path.isdir(self.state_dir):
-                for itemname in os.listdir(self.state_dir):
-                    fullpath = os.path.join(self.state_dir, itemname)
-                    #print('found %s' % fullpath)
-                    if BackupJobHistoryItem.is_history_item(fullpath):
-                        item = BackupJobHistoryItem(self, fullpath)
-                        tmp_items.append(item)
+            if self.state_dir and os.path.isdir(self.state_dir):
+                catalog_items = self.catalog.load()
+                for name, state in catalog_items.items():
+                    fullpath = os.path.join(self.state_dir, BackupStateDefaults.HISTORY_FILE_PREFIX + name + BackupStateDefaults.HISTORY_FILE_EXTENSION)
+                    item = BackupJobHistoryItem(self, fullpath)
+                    item._set_state(state)
+                    tmp_items.append(item)
+                tmp_items.extend(self._import_legacy_items(catalog_items))
             self._items = sorted(tmp_items, key=lambda item: item.timestamp)
+            self._items_by_date = {}
+            for item in self._items:
+                self._add_to_index(item)
+
+    def _add_to_index(self, item):
+        if item.date in self._items_by_date:
+            self._items_by_date[item.date].append(item)
+        else:
+            self._items_by_date[item.date] = [item]
+
+    def _remove_from_index(self, item):
+        same_date = self._items_by_date.get(item.date)
+        if same_date is not None:
+            same_date.remove(item)
+            if not same_date:
+                del self._items_by_date[item.date]
 
     def save(self):
         for item in self._items:
-            item.save()
+            item._write_state()
 
     def create_new_item(self, verbose=False):
         self.load()
         item = BackupJobHistoryItem.create(self, self.state_dir, verbose=verbose)
         self._items.append(item)
+        self._add_to_index(item)
         return item
 
+    def find(self, date):
+        self.load()
+        return self._items_by_date.get(date, [])
+
+    def last_durations(self, category):
+        if self.catalog is None:
+            return {}
+        return self.catalog.get_last_durations(category)
+
     def create_temporary_item(self, verbose=False):
         item = BackupJobHistoryItem.create(self, '/tmp', True, verbose=verbose)
         return item
@@ -227,6 +480,7 @@ class BackupJobHistory(object):
 
     def reload(self):
         self._items = None
+        self._items_by_date = None
         self.load()
 
     def _item_changed(self, item):
@@ -242,8 +496,17 @@ class BackupJobHistory(object):
         return self._items[index]
 
     def __delitem__(self, index):
-        item = self._items[index]
-        os.unlink(item.filename)
+        if isinstance(index, slice):
+            items = self._items[index]
+        else:
+            items = [ self._items[index] ]
+        if self.catalog is not None:
+            self.catalog.remove(items)
+        for item in items:
+            # remove state file from previous versions
+            if os.path.isfile(item.filename):
+                os.unlink(item.filename)
+            self._remove_from_index(item)
         del self._items[index]
 
     def __str__(self):
@@ -324,7 +587,8 @@ class BackupJobState(object):
             else:
                 ret = True
             if ret:
-                self.history = BackupJobHistory(self, state_dir)
+                if self.history.state_dir != state_dir:
+                    self.history = BackupJobHistory(self, state_dir)
 
                 ret = self._write_state_conf(self.job_state_conf)
         else:
@@ -373,10 +637,8 @@ class BackupJobState(object):
         if len(self.history) > max_count:
             num_to_delete = len(self.history) - max_count
             #print('numbers to delete %i' % num_to_delete)
-            for i in range(0, num_to_delete):
-                #print('delete num %i=%s' % (i, self.history[0]))
-                del self.history[0]
-                self._dirty = True
+            del self.history[0:num_to_delete]
+            self._dirty = True
 
         if isinstance(max_age, datetime.datetime):
             max_rentention_time = max_age
@@ -398,18 +660,32 @@ class BackupJobState(object):
         return True
 
     def find_session(self, timestamp, backup_dir=None, backup_disk=None):
-        for item in self.history:
-            if item.date == timestamp:
-                if backup_dir is not None:
-                    if item.backup_dir != backup_dir:
-                        continue
-
-                if backup_disk is not None:
-                    if item.backup_disk != backup_disk:
-                        continue
-                return item
+        for item in self.history.find(timestamp):
+            if backup_dir is not None:
+                if item.backup_dir != backup_dir:
+                    continue
+
+            if backup_disk is not None:
+                if item.backup_disk != backup_disk:
+                    continue
+            return item
         return None
     
+    def get_statistics(self, backup_dir):
+        if self.history.catalog is None:
+            return None
+        return self.history.catalog.get_statistics(backup_dir)
+
+    def set_statistics(self, backup_dir, statistics):
+        if self.history.catalog is None:
+            return False
+        return self.history.catalog.set_statistics(backup_dir, statistics)
+
+    def remove_statistics(self, backup_dirs):
+        if self.history.catalog is None:
+            return False
+        return self.history.catalog.remove_statistics(backup_dirs)
+
     def _item_changed(self, item):
         if item.success:
             if self.last_success is None or item.date > self.last_success:
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+import stat
+import heapq
+import json
+
+class BackupStatistics(object):
+    """
+    Statistics of a single backup snapshot. Besides the totals a pool of
+    the largest files is kept, which is larger than the number of files
+    shown, so the statistics of the next snapshot can be derived from it
+    even when some of the largest files have been removed.
+    """
+    NUM_BIGGEST_FILES = 15
+    NUM_CANDIDATES = 4 * NUM_BIGGEST_FILES
+
+    def __init__(self, total_size=0, num_files=0, num_dirs=0, candidates=None):
+        self.total_size = total_size
+        self.num_files = num_files
+        self.num_dirs = num_dirs
+        # list of (size, name) sorted by size in descending order
+        self.candidates = candidates if candidates is not None else []
+
+    def biggest_files(self, num=NUM_BIGGEST_FILES):
+        return [ (name, size) for (size, name) in self.candidates[0:num] ]
+
+    def to_json(self):
+        return json.dumps({'total_size': self.total_size, 'num_files': self.num_files, 'num_dirs': self.num_dirs,
+                           'candidates': self.candidates })
+
+    @staticmethod
+    def from_json(data):
+        try:
+            d = json.loads(data)
+        except ValueError:
+            return None
+        return BackupStatistics(total_size=d.get('total_size', 0), num_files=d.get('num_files', 0), num_dirs=d.get('num_dirs', 0),
+                                candidates=[ (size, name) for (size, name) in d.get('candidates', []) ])
+
+    @staticmethod
+    def from_files(files, stats, num_candidates=NUM_CANDIDATES):
+        # files is a dict of name and stat result, e.g. from Rsync.listdir
+        candidates = heapq.nlargest(num_candidates, [ (fstat.st_size, name) for (name, fstat) in files.items() if stat.S_ISREG(fstat.st_mode) ])
+        return BackupStatistics(total_size=stats.get('total_file_size', 0) or 0,
+                                num_files=stats.get('num_total_files', 0) or 0,
+                                num_dirs=stats.get('num_dirs', 0) or 0,
+                                candidates=candidates)
+
+    def __str__(self):
+        return 'BackupStatistics(size=%i, files=%i, dirs=%i)' % (self.total_size, self.num_files, self.num_dirs)
+
+class BackupStatisticsCollector(object):
+    """
+    Derives the statistics of a new snapshot from the statistics of the
+    previous snapshot and the itemized changes reported by rsync while the
+    new snapshot is created. The totals are taken from the rsync --stats
+    summary, the pool of the largest files is updated with the changed
+    files only. Memory usage is bounded by the size of the pool.
+    """
+    def __init__(self, previous=None, source_base_directory='/', full_transfer=False, num_candidates=BackupStatistics.NUM_CANDIDATES):
+        self.previous = previous
+        self.source_base_directory = source_base_directory
+        self.full_transfer = full_transfer
+        self.num_candidates = num_candidates
+        # only changes of the previous candidates are of interest
+        self._previous_names = set([ name for (size, name) in previous.candidates ]) if previous is not None else set()
+        self._changed = set()
+        # min-heap of the largest changed files
+        self._heap = []
+
+    @property
+    def complete(self):
+        # without the statistics of the previous snapshot the unchanged
+        # files are unknown unless everything has been transferred
+        return self.previous is not None or self.full_transfer
+
+    def add_item(self, flags, size, name):
+        if name in self._previous_names:
+            self._changed.add(name)
+        if flags[1] == 'f' and not flags.startswith('*deleting'):
+            entry = (size, name)
+            if len(self._heap) < self.num_candidates:
+                heapq.heappush(self._heap, entry)
+            elif entry > self._heap[0]:
+                heapq.heapreplace(self._heap, entry)
+
+    def _still_present(self, name):
+        # the file did not show up as changed, so it is either unchanged or
+        # has been removed from the source (which rsync does not report when
+        # using --link-dest)
+        try:
+            st = os.lstat(os.path.join(self.source_base_directory, name))
+        except OSError:
+            return None
+        return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+    def finish(self, rsync_stats):
+        candidates = list(self._heap)
+        if self.previous is not None:
+            for (size, name) in self.previous.candidates:
+                if name in self._changed:
+                    continue
+                current_size = self._still_present(name)
+                if current_size is not None:
+                    candidates.append( (current_size, name) )
+        candidates = heapq.nlargest(self.num_candidates, candidates)
+        return BackupStatistics(total_size=rsync_stats.get('total_file_size', 0) or 0,
+                                num_files=rsync_stats.get('num_total_files', 0) or 0,
+                                num_dirs=rsync_stats.get('num_dirs', 0) or 0,
+                                candidates=candidates)
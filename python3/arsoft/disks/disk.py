@@ -5,12 +5,21 @@
 dbus_found = False
 try:
     import dbus
+    import dbus.bus
     dbus_found = True
 except ImportError:
     pass
+glib_found = False
+try:
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    glib_found = True
+except ImportError:
+    pass
 import os.path
 import stat
 import re
+import time
 
 class Device(object):
     def __init__(self, mgr, path, dev_obj, obj_iface_and_props):
@@ -18,6 +27,8 @@ class Device(object):
         self._path = path
         self._dev_obj = dev_obj
         self._obj_iface_and_props = obj_iface_and_props
+        # decoded byte array properties
+        self._decoded_props = {}
 
     @property
     def path(self):
@@ -71,23 +82,40 @@ class Device(object):
 
     def _get_obj_property_byte_array(self, iface_name, prop_name, default_value=None):
         if iface_name in self._obj_iface_and_props:
-            return Device._bytearray_to_string(self._obj_iface_and_props[iface_name].get(prop_name, default_value))
+            key = (iface_name, prop_name)
+            if key not in self._decoded_props:
+                self._decoded_props[key] = Device._bytearray_to_string(self._obj_iface_and_props[iface_name].get(prop_name, default_value))
+            return self._decoded_props[key]
         else:
             return default_value
 
     def _get_obj_property_array_of_byte_array(self, iface_name, prop_name, default_value=None):
         if iface_name in self._obj_iface_and_props:
-            tmp = self._obj_iface_and_props[iface_name].get(prop_name, default_value)
-            if isinstance(tmp, dbus.Array):
-                ret = []
-                for a in tmp:
-                    ret.append(Device._bytearray_to_string(a))
-            else:
-                ret = default_value
-            return ret
+            key = (iface_name, prop_name)
+            if key not in self._decoded_props:
+                tmp = self._obj_iface_and_props[iface_name].get(prop_name, default_value)
+                if isinstance(tmp, dbus.Array):
+                    ret = []
+                    for a in tmp:
+                        ret.append(Device._bytearray_to_string(a))
+                else:
+                    ret = default_value
+                self._decoded_props[key] = ret
+            return self._decoded_props[key]
         else:
             return default_value
 
+    def _update_properties(self, iface_name, changed_props, invalidated_props):
+        props = self._obj_iface_and_props.get(iface_name)
+        if props is None:
+            return
+        props.update(changed_props)
+        if invalidated_props:
+            # fetch all properties of the interface in a single call
+            props_iface = dbus.Interface(self._dev_obj, 'org.freedesktop.DBus.Properties')
+            props.update(props_iface.GetAll(iface_name))
+        self._decoded_props = {}
+
     def __repr__(self):
         return str(type(self)) + '[' + self._path + ']'
 
@@ -568,18 +596,37 @@ class Disks(object):
     _udisks_manager = None
     _udisks_manager_drives = None
     _udisks_manager_drives_obj = None
+    _dbus_bus_address = None
+    _dbus_mainloop = None
 
     SERVICE_NAME = "org.freedesktop.UDisks2"
     DEVICE_CLASS = 'org.freedesktop.UDisks2.Device'
 
     def __init__(self):
         self._last_error = None
+        self._signal_matches = []
+        self._changed = False
+        self._build_indexes([])
         self.rescan()
 
+    @staticmethod
+    def set_bus_address(address):
+        # use the given bus (e.g. a private bus for testing) instead of the system bus
+        Disks._dbus_bus_address = address
+        Disks._dbus_system_bus = None
+        Disks._udisks_manager_obj = None
+        Disks._udisks_manager = None
+
     @staticmethod
     def _dbus_connect():
         if Disks._dbus_system_bus is None:
-            Disks._dbus_system_bus = dbus.SystemBus()
+            # the GLib main loop is only required to receive signals
+            if glib_found and Disks._dbus_mainloop is None:
+                Disks._dbus_mainloop = DBusGMainLoop()
+            if Disks._dbus_bus_address:
+                Disks._dbus_system_bus = dbus.bus.BusConnection(Disks._dbus_bus_address, mainloop=Disks._dbus_mainloop)
+            else:
+                Disks._dbus_system_bus = dbus.SystemBus(mainloop=Disks._dbus_mainloop)
             Disks._udisks_manager_obj = Disks._dbus_system_bus.get_object(Disks.SERVICE_NAME, "/org/freedesktop/UDisks2")
             Disks._udisks_manager = dbus.Interface(Disks._udisks_manager_obj, 'org.freedesktop.DBus.ObjectManager')
         return True if Disks._udisks_manager is not None else False
@@ -587,7 +634,9 @@ class Disks(object):
     @staticmethod
     def _create_device(mgr, path, obj_iface_and_props):
         if obj_iface_and_props:
-            dev_obj = Disks._dbus_system_bus.get_object(Disks.SERVICE_NAME, path)
+            # all properties are already known from GetManagedObjects, so skip
+            # the introspection round trip for every object
+            dev_obj = Disks._dbus_system_bus.get_object(Disks.SERVICE_NAME, path, introspect=False)
 
             is_block = True if Block.INTERFACE_NAME in obj_iface_and_props else False
             is_drive = True if Drive.INTERFACE_NAME in obj_iface_and_props else False
@@ -628,22 +677,175 @@ class Disks(object):
         return self._last_error
 
     def rescan(self):
-        self._list = []
+        self._build_indexes([])
         if not Disks._dbus_connect():
             return False
+        devices = []
         for obj_path, obj_iface_and_props in Disks._udisks_manager.GetManagedObjects().items():
-            self._list.append(Disks._create_device(self, obj_path, obj_iface_and_props))
+            devices.append(Disks._create_device(self, obj_path, obj_iface_and_props))
+        self._build_indexes(devices)
         ret = True
         return ret
+
+    def _build_indexes(self, devices):
+        # _by_path keeps the devices in the order they have been found; the
+        # other indexes map each key to all devices with this key in the
+        # same order, so the first one wins for ambiguous keys just like a
+        # linear search would
+        self._by_path = {}
+        self._device_seq = {}
+        self._next_seq = 0
+        self._by_devfile = {}
+        self._by_devno = {}
+        self._by_uuid = {}
+        self._by_label = {}
+        self._by_serial = {}
+        self._by_drive = {}
+        for dev in devices:
+            if dev is not None and dev.path not in self._by_path:
+                self._add_device(dev)
+
+    def _index_keys(self, dev):
+        ret = []
+        if isinstance(dev, Block):
+            for name in set([dev.device, dev.preferred_device] + (dev.symlinks or [])):
+                if name:
+                    ret.append( (self._by_devfile, name) )
+            if dev.device_number is not None:
+                ret.append( (self._by_devno, int(dev.device_number)) )
+            if dev.id_uuid:
+                ret.append( (self._by_uuid, str(dev.id_uuid)) )
+            if dev.id_label:
+                ret.append( (self._by_label, str(dev.id_label)) )
+            ret.append( (self._by_drive, dev.drive) )
+        elif isinstance(dev, Drive):
+            if dev.serial:
+                ret.append( (self._by_serial, str(dev.serial)) )
+        return ret
+
+    def _add_to_indexes(self, dev):
+        seq = self._device_seq[dev.path]
+        for (index, key) in self._index_keys(dev):
+            devices = index.setdefault(key, [])
+            pos = len(devices)
+            while pos > 0 and self._device_seq[devices[pos - 1].path] > seq:
+                pos -= 1
+            devices.insert(pos, dev)
+
+    def _remove_from_indexes(self, dev):
+        for (index, key) in self._index_keys(dev):
+            devices = index.get(key)
+            if devices is not None and dev in devices:
+                devices.remove(dev)
+                if not devices:
+                    del index[key]
+
+    def _add_device(self, dev):
+        self._device_seq[dev.path] = self._next_seq
+        self._next_seq += 1
+        self._by_path[dev.path] = dev
+        self._add_to_indexes(dev)
+
+    def _replace_device(self, old_dev, dev):
+        # keeps the position of the device
+        self._remove_from_indexes(old_dev)
+        if dev is None:
+            del self._by_path[old_dev.path]
+            del self._device_seq[old_dev.path]
+        else:
+            self._by_path[dev.path] = dev
+            self._add_to_indexes(dev)
+
+    @staticmethod
+    def _first(index, key):
+        devices = index.get(key)
+        return devices[0] if devices else None
+
+    @property
+    def is_monitoring(self):
+        return True if self._signal_matches else False
+
+    def start_monitoring(self):
+        """
+        Keeps the device list up to date using the InterfacesAdded and
+        InterfacesRemoved signals of UDisks2. Returns False if signals cannot
+        be received (no GLib main loop available).
+        """
+        if self._signal_matches:
+            return True
+        if not glib_found or not Disks._dbus_connect():
+            return False
+        self._signal_matches = [
+            Disks._udisks_manager.connect_to_signal('InterfacesAdded', self._on_interfaces_added),
+            Disks._udisks_manager.connect_to_signal('InterfacesRemoved', self._on_interfaces_removed),
+            Disks._dbus_system_bus.add_signal_receiver(self._on_properties_changed, signal_name='PropertiesChanged',
+                                                       dbus_interface='org.freedesktop.DBus.Properties',
+                                                       bus_name=Disks.SERVICE_NAME, path_keyword='path'),
+            ]
+        # pick up changes between the initial scan and the subscription
+        self.rescan()
+        return True
+
+    def stop_monitoring(self):
+        for match in self._signal_matches:
+            match.remove()
+        self._signal_matches = []
+
+    def _on_interfaces_added(self, obj_path, obj_iface_and_props):
+        old_dev = self._by_path.get(obj_path)
+        if old_dev is None:
+            dev = Disks._create_device(self, obj_path, obj_iface_and_props)
+            if dev is not None:
+                self._add_device(dev)
+        else:
+            # the device class depends on the interfaces, so re-create the device
+            merged = dict(old_dev._obj_iface_and_props)
+            merged.update(obj_iface_and_props)
+            self._replace_device(old_dev, Disks._create_device(self, obj_path, merged))
+        self._changed = True
+
+    def _on_interfaces_removed(self, obj_path, interfaces):
+        old_dev = self._by_path.get(obj_path)
+        if old_dev is not None:
+            remaining = dict(old_dev._obj_iface_and_props)
+            for iface in interfaces:
+                remaining.pop(iface, None)
+            self._replace_device(old_dev, Disks._create_device(self, obj_path, remaining))
+        self._changed = True
+
+    def _on_properties_changed(self, iface_name, changed_props, invalidated_props, path=None):
+        dev = self._by_path.get(path)
+        if dev is not None:
+            # only the index entries of this device change
+            self._remove_from_indexes(dev)
+            dev._update_properties(iface_name, changed_props, invalidated_props)
+            self._add_to_indexes(dev)
+            self._changed = True
+
+    def wait_for_change(self, timeout):
+        """
+        Waits up to timeout seconds for devices to appear or disappear and
+        returns True if the device list might have changed. Without monitoring
+        this simply sleeps and rescans.
+        """
+        if not self._signal_matches:
+            time.sleep(timeout)
+            return self.rescan()
+        context = GLib.MainContext.default()
+        expired = []
+        def _on_timeout():
+            expired.append(True)
+            return False
+        source_id = GLib.timeout_add(max(0, int(timeout * 1000)), _on_timeout)
+        self._changed = False
+        while not self._changed and not expired:
+            context.iteration(True)
+        if not expired:
+            GLib.source_remove(source_id)
+        return self._changed
     
     def _get_device_by_udisks_path(self, path):
-        ret = None
-        for dev in self._list:
-            if dev.path == path:
-                ret = dev
-        if ret is None:
-            ret = Disks._create_device(self, path)
-        return ret
+        return self._by_path.get(path)
     
     def _get_device_by_devpath(self, devpath):
         ret = None
@@ -651,32 +853,27 @@ class Disks(object):
             devpath = os.path.join('/sys', devpath)
         elif devpath.startswith('/devices/'):
             devpath = '/sys' + devpath
-        for dev in self._list:
-            #print('compare %s<>%s' % (dev.nativepath, devpath))
-            if dev.path == devpath:
-                ret = dev
-        return ret
+        return self._by_path.get(devpath)
 
-    def find_device(self, devfile=None, devpath=None, dev_inode=None):
+    def find_device(self, devfile=None, devpath=None, dev_inode=None, uuid=None, label=None):
         if not Disks._dbus_connect():
             return None
         ret = None
         if dev_inode is not None:
-            for d in self._list:
-                if isinstance(d, Block):
-                    if d.device_number == dev_inode:
-                        ret = d
-                        break
+            ret = Disks._first(self._by_devno, dev_inode)
         elif devfile is not None:
-            for d in self._list:
-                if isinstance(d, Block):
-                    if d.device == devfile or d.preferred_device == devfile or devfile in d.symlinks:
-                        ret = d
-                        break
+            ret = Disks._first(self._by_devfile, devfile)
         elif devpath is not None:
             ret = self._get_device_by_devpath(devpath)
+        elif uuid is not None:
+            ret = Disks._first(self._by_uuid, uuid)
+        elif label is not None:
+            ret = Disks._first(self._by_label, label)
         return ret
 
+    def find_drive_by_serial(self, serial):
+        return Disks._first(self._by_serial, serial)
+
     def find_device_for_file(self, path):
         ret = None
         if os.path.exists(path):
@@ -745,9 +942,35 @@ class Disks(object):
             ret = None
         return ret
     
+    @staticmethod
+    def _serial_from_pattern(pattern):
+        for e in pattern.split(','):
+            if ':' in e:
+                key, value = e.split(':', 1)
+                if key == 'serial':
+                    return value
+            else:
+                return e
+        return None
+
     def find_drive_by_pattern(self, pattern):
+        patterns = pattern if isinstance(pattern, list) else [pattern]
+        serials = [ Disks._serial_from_pattern(p) for p in patterns ]
+        if serials and None not in serials:
+            # every pattern names a serial number, so only check those drives
+            # and pick the one a linear search would have found first
+            ret = None
+            ret_idx = None
+            for serial in set(serials):
+                for devobj in self._by_serial.get(serial, []):
+                    if any([ devobj.match(p) for p in patterns ]):
+                        idx = self._device_seq[devobj.path]
+                        if ret_idx is None or idx < ret_idx:
+                            ret = devobj
+                            ret_idx = idx
+            return ret
         ret = None
-        for devobj in self._list:
+        for devobj in self._by_path.values():
             if isinstance(devobj, Drive):
                 if isinstance(pattern, list):
                     for p in pattern:
@@ -764,31 +987,27 @@ class Disks(object):
 
     def __str__(self):
         ret = ''
-        for d in self._list:
+        for d in self._by_path.values():
             ret = ret + str(d) + "\n"
         return ret
 
     def get_block_devices(self, drive_obj=None, master_only=False):
         ret = []
-        for devobj in self._list:
-            if isinstance(devobj, Block):
-                if drive_obj is None:
-                    if master_only:
-                        if devobj.is_master:
-                            ret.append(devobj)
-                    else:
-                        ret.append(devobj)
-                elif devobj.drive == drive_obj.path:
-                    if master_only:
-                        if devobj.is_master:
-                            ret.append(devobj)
-                    else:
-                        ret.append(devobj)
+        if drive_obj is None:
+            candidates = [ devobj for devobj in self._by_path.values() if isinstance(devobj, Block) ]
+        else:
+            candidates = self._by_drive.get(drive_obj.path, [])
+        for devobj in candidates:
+            if master_only:
+                if devobj.is_master:
+                    ret.append(devobj)
+            else:
+                ret.append(devobj)
         return ret
 
     def get_partitions(self, drive_obj=None):
         ret = []
-        for devobj in self._list:
+        for devobj in self._by_path.values():
             if isinstance(devobj, Partition):
                 if drive_obj is None:
                     ret.append(devobj)
@@ -801,7 +1020,7 @@ class Disks(object):
 
     def get_filesystems(self, drive_obj=None):
         ret = []
-        for devobj in self._list:
+        for devobj in self._by_path.values():
             if isinstance(devobj, Filesystem) or isinstance(devobj, FilesystemWithPartition):
                 if drive_obj is None:
                     ret.append(devobj)
@@ -813,7 +1032,7 @@ class Disks(object):
 
     @property
     def devices(self):
-        return self._list
+        return list(self._by_path.values())
 
     @property
     def partitions(self):
@@ -822,7 +1041,7 @@ class Disks(object):
     @property
     def blocks(self):
         ret = []
-        for d in self._list:
+        for d in self._by_path.values():
             if isinstance(d, Block):
                 ret.append(d)
         return ret
@@ -830,7 +1049,7 @@ class Disks(object):
     @property
     def drives(self):
         ret = []
-        for d in self._list:
+        for d in self._by_path.values():
             if isinstance(d, Drive):
                 ret.append(d)
         return ret
@@ -838,7 +1057,7 @@ class Disks(object):
     @property
     def loops(self):
         ret = []
-        for d in self._list:
+        for d in self._by_path.values():
             if isinstance(d, Loop):
                 ret.append(d)
         return ret
@@ -850,7 +1069,7 @@ class Disks(object):
     @property
     def fixed_drives(self):
         ret = []
-        for d in self._list:
+        for d in self._by_path.values():
             if isinstance(d, Drive) and d.is_removable:
                 ret.append(d)
         return ret
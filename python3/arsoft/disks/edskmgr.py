@@ -419,12 +419,20 @@ class ExternalDiskManager(object):
 
         disk_mgr = Disks()
         diskobj = disk_mgr.find_drive_by_pattern(pattern)
-        if not diskobj:
-            if abs_timeout is not None:
-                while time.time() < abs_timeout:
-                    time.sleep(wait_interval)
-                    disk_mgr.rescan()
-                    diskobj = disk_mgr.find_drive_by_pattern(pattern)
-                    if diskobj:
+        if not diskobj and abs_timeout is not None:
+            # wait for the UDisks2 signals if possible and poll otherwise
+            if disk_mgr.start_monitoring():
+                # the disk might have arrived before the subscription
+                diskobj = disk_mgr.find_drive_by_pattern(pattern)
+            try:
+                while not diskobj:
+                    remaining = abs_timeout - time.time()
+                    if remaining <= 0:
                         break
+                    if not disk_mgr.is_monitoring:
+                        remaining = min(remaining, wait_interval)
+                    if disk_mgr.wait_for_change(remaining):
+                        diskobj = disk_mgr.find_drive_by_pattern(pattern)
+            finally:
+                disk_mgr.stop_monitoring()
         return diskobj
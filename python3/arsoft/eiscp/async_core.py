@@ -0,0 +1,461 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import asyncio
+import os
+import re
+import struct
+from collections import deque
+
+from .core import eISCPTimeoutError, command_to_iscp, iscp_to_command
+
+
+class Subscription(object):
+    """Receives the messages of an :class:`AsyncReceiver` which are not
+    replies to a pending command, optionally limited to the given
+    command prefixes. The queue holds at most ``max_pending`` messages;
+    if the subscriber falls behind, the oldest messages are dropped and
+    counted in ``dropped`` so a slow subscriber never stalls the
+    receiver.
+    """
+
+    def __init__(self, receiver, prefixes=None, max_pending=64):
+        self._receiver = receiver
+        self.prefixes = set(prefixes) if prefixes else None
+        self.dropped = 0
+        self._messages = deque(maxlen=max_pending)
+        self._waiter = None
+        self._closed = False
+
+    def _put(self, message):
+        if self.prefixes is not None and message[:3] not in self.prefixes:
+            return
+        if len(self._messages) == self._messages.maxlen:
+            self.dropped += 1
+        self._messages.append(message)
+        self._wakeup()
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def close(self):
+        self._closed = True
+        self._receiver._subscriptions.discard(self)
+        self._wakeup()
+
+    async def get(self, timeout=None):
+        """Returns the next message, or None once the subscription or
+        the connection has been closed. Raises eISCPTimeoutError if no
+        message arrives within timeout."""
+        while not self._messages:
+            if self._closed:
+                return None
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                if timeout is None:
+                    await self._waiter
+                else:
+                    try:
+                        await asyncio.wait_for(self._waiter, timeout)
+                    except asyncio.TimeoutError:
+                        raise eISCPTimeoutError(timeout)
+            finally:
+                self._waiter = None
+        return self._messages.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncReceiver(object):
+    """Asyncio interface to Onkyo receivers. A single reader task
+    receives all messages: a reply is handed to the oldest command
+    waiting for a message with the same three character prefix (for
+    a sent MVLUP we accept MVL13), every other message is passed on to
+    the subscriptions. Nothing is polled, so a reply is delivered as
+    soon as it arrives.
+
+    Subclasses implement the transport, see :class:`AsyncNetworkReceiver`
+    and :class:`AsyncSerialReceiver`.
+    """
+
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        # transports receiving data besides the one of the writer
+        self._read_transport = None
+        self._read_task = None
+        self._pending = {}
+        self._subscriptions = set()
+
+    async def _open(self):
+        raise NotImplementedError()
+
+    async def _read_message(self):
+        raise NotImplementedError()
+
+    def _encode(self, iscp_message):
+        raise NotImplementedError()
+
+    @property
+    def connected(self):
+        return self._read_task is not None and not self._read_task.done()
+
+    async def connect(self):
+        if self._read_task is not None and self._read_task.done():
+            # the connection has been lost, so open a new one
+            await self.disconnect()
+        if self._read_task is None:
+            (self._reader, self._writer) = await self._open()
+            self._read_task = asyncio.ensure_future(self._read_loop())
+        return self
+
+    async def disconnect(self):
+        if self._read_task is not None:
+            self._read_task.cancel()
+            try:
+                await self._read_task
+            except asyncio.CancelledError:
+                pass
+            self._read_task = None
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self._writer = None
+        if self._read_transport is not None:
+            self._read_transport.close()
+            self._read_transport = None
+        self._reader = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.disconnect()
+
+    async def _read_loop(self):
+        error = None
+        try:
+            while True:
+                message = await self._read_message()
+                if message is None:
+                    break
+                self._dispatch(message)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            error = e
+        finally:
+            # nothing will arrive any more, so release everybody waiting
+            for waiters in self._pending.values():
+                for future in waiters:
+                    if not future.done():
+                        future.set_exception(ConnectionError('Connection to receiver closed: %s' % (error or 'EOF')))
+            self._pending = {}
+            for subscription in list(self._subscriptions):
+                subscription.close()
+
+    def _dispatch(self, message):
+        waiters = self._pending.get(message[:3])
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result(message)
+                return
+        for subscription in list(self._subscriptions):
+            subscription._put(message)
+
+    def subscribe(self, prefixes=None, max_pending=64):
+        """Returns a new :class:`Subscription` for status messages."""
+        subscription = Subscription(self, prefixes=prefixes, max_pending=max_pending)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    @staticmethod
+    def _normalize(iscp_message):
+        iscp_message = iscp_message.strip()
+        if iscp_message.startswith('!1'):
+            iscp_message = iscp_message[2:]
+        return iscp_message
+
+    async def send(self, iscp_message):
+        """Send a low-level ISCP message, like ``MVL50``, without
+        waiting for a response."""
+        await self.connect()
+        self._writer.write(self._encode(self._normalize(iscp_message)))
+        await self._writer.drain()
+
+    async def raw(self, iscp_message, timeout=None):
+        """Send a low-level ISCP message and return the response, the
+        next message with the same command prefix."""
+        await self.connect()
+        iscp_message = self._normalize(iscp_message)
+        future = asyncio.get_event_loop().create_future()
+        waiters = self._pending.setdefault(iscp_message[:3], deque())
+        waiters.append(future)
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            self._writer.write(self._encode(iscp_message))
+            await self._writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise eISCPTimeoutError(timeout)
+        finally:
+            if not future.done():
+                future.cancel()
+            try:
+                waiters.remove(future)
+            except ValueError:
+                pass
+
+    async def command(self, command, arguments=None, zone=None):
+        """Send a high-level command to the receiver and return the
+        response formatted as a command, see :func:`command_to_iscp`."""
+        response = await self.raw(command_to_iscp(command, arguments, zone))
+        if response:
+            return iscp_to_command(response)
+
+    async def power_on(self):
+        """Turn the receiver power on."""
+        return await self.command('system-power', 'on')
+
+    async def power_off(self):
+        """Turn the receiver power off."""
+        return await self.command('system-power', 'standby')
+
+
+def _strip_iscp(data):
+    # !1 = start character and unit type, the end is EOF, CR and/or LF
+    message = data.decode('utf-8', 'replace').rstrip('\x1a\r\n')
+    if message.startswith('!'):
+        message = message[2:]
+    return message
+
+
+class AsyncNetworkReceiver(AsyncReceiver):
+    """eISCP over TCP, each ISCP message is wrapped in a packet with a
+    16 byte header."""
+
+    HEADER = struct.Struct('! 4s I I b 3x')
+
+    def __init__(self, host, port=60128, timeout=5.0):
+        AsyncReceiver.__init__(self, timeout=timeout)
+        self.host = host
+        self.port = port
+
+    def __repr__(self):
+        return "<%s %s:%s>" % (self.__class__.__name__, self.host, self.port)
+
+    async def _open(self):
+        return await asyncio.open_connection(self.host, self.port)
+
+    def _encode(self, iscp_message):
+        data = ('!1%s\r' % iscp_message).encode('utf-8')
+        return self.HEADER.pack(b'ISCP', self.HEADER.size, len(data), 0x01) + data
+
+    async def _read_message(self):
+        try:
+            header = await self._reader.readexactly(self.HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+        magic, header_size, data_size, version = self.HEADER.unpack(header)
+        if magic != b'ISCP' or header_size < self.HEADER.size:
+            raise ConnectionError('Invalid eISCP header %r' % header)
+        if header_size > self.HEADER.size:
+            await self._reader.readexactly(header_size - self.HEADER.size)
+        return _strip_iscp(await self._reader.readexactly(data_size))
+
+
+class AsyncSerialReceiver(AsyncReceiver):
+    """ISCP over RS232 as used by onkyo-rs232. The serial port is put
+    into raw mode with termios, so no additional module is needed."""
+
+    TERMINATORS = re.compile(b'[\x1a\r\n]')
+
+    def __init__(self, devfile, baudrate=9600, timeout=5.0):
+        AsyncReceiver.__init__(self, timeout=timeout)
+        self.devfile = devfile
+        self.baudrate = baudrate
+        self._buffer = b''
+        self._messages = deque()
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.devfile)
+
+    async def _open(self):
+        import termios
+        import tty
+
+        loop = asyncio.get_event_loop()
+        fd = os.open(self.devfile, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(fd)
+            speed = getattr(termios, 'B%i' % self.baudrate)
+            attrs = termios.tcgetattr(fd)
+            attrs[4] = attrs[5] = speed
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+            read_file = os.fdopen(fd, 'rb', buffering=0)
+        except:
+            os.close(fd)
+            raise
+        write_file = None
+        read_transport = None
+        try:
+            write_file = os.fdopen(os.dup(fd), 'wb', buffering=0)
+            reader = asyncio.StreamReader()
+            (read_transport, read_protocol) = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), read_file)
+            (transport, protocol) = await loop.connect_write_pipe(lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()), write_file)
+        except:
+            if read_transport is not None:
+                read_transport.close()
+            read_file.close()
+            if write_file is not None:
+                write_file.close()
+            raise
+        writer = asyncio.StreamWriter(transport, protocol, None, loop)
+        # closed together with the writer in disconnect
+        self._read_transport = read_transport
+        self._buffer = b''
+        self._messages.clear()
+        return (reader, writer)
+
+    def _encode(self, iscp_message):
+        return ('!1%s\r\n' % iscp_message).encode('utf-8')
+
+    async def _read_message(self):
+        while not self._messages:
+            data = await self._reader.read(4096)
+            if not data:
+                return None
+            parts = self.TERMINATORS.split(self._buffer + data)
+            self._buffer = parts.pop()
+            for part in parts:
+                if part.startswith(b'!'):
+                    self._messages.append(_strip_iscp(part))
+        return self._messages.popleft()
+
+
+if __name__ == '__main__':
+    # benchmark: round-trip latency against a local fake receiver
+    import sys
+    import time
+
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    status_interval = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+
+    async def fake_receiver(reader, writer):
+        header = AsyncNetworkReceiver.HEADER
+        state = { 'MVL': '20', 'PWR': '01', 'AMT': '00' }
+
+        def packet(message):
+            data = ('!1%s\x1a\r\n' % message).encode('utf-8')
+            return header.pack(b'ISCP', header.size, len(data), 0x01) + data
+
+        async def status_updates():
+            # unsolicited messages as sent when another controller is used
+            while True:
+                await asyncio.sleep(status_interval)
+                writer.write(packet('NLSU0-Status'))
+
+        status_task = asyncio.ensure_future(status_updates())
+        try:
+            while True:
+                (magic, header_size, data_size, version) = header.unpack(await reader.readexactly(header.size))
+                message = _strip_iscp(await reader.readexactly(data_size))
+                prefix, argument = message[:3], message[3:]
+                if argument != 'QSTN':
+                    state[prefix] = argument
+                writer.write(packet(prefix + state.get(prefix, 'N/A')))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            status_task.cancel()
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(fake_receiver, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with AsyncNetworkReceiver('127.0.0.1', port) as receiver:
+            status = receiver.subscribe(max_pending=16)
+            latencies = []
+            for i in range(num):
+                start = time.time()
+                response = await receiver.raw('MVL%02X' % (i % 80))
+                latencies.append(time.time() - start)
+                assert response == 'MVL%02X' % (i % 80), response
+            latencies.sort()
+            print('%i commands: mean %.3fms, median %.3fms, max %.3fms' % (num,
+                sum(latencies) * 1000 / num, latencies[num // 2] * 1000, latencies[-1] * 1000))
+            print('status messages received %i, dropped %i' % (len(status._messages), status.dropped))
+
+            start = time.time()
+            responses = await asyncio.gather(*[ receiver.raw(cmd) for cmd in [ 'PWRQSTN', 'AMTQSTN', 'MVLQSTN' ] * (num // 3) ])
+            duration = time.time() - start
+            print('%i pipelined queries in %.3fs (%.3fms/query)' % (len(responses), duration, duration * 1000 / len(responses)))
+        # let the fake receiver see the end of the connection
+        await asyncio.sleep(0.01)
+        server.close()
+        await server.wait_closed()
+
+    async def serial_reconnect(cycles=20):
+        # the serial receiver on a pty has to release everything on disconnect
+        import pty
+        import threading
+
+        (master_fd, slave_fd) = pty.openpty()
+        devfile = os.ttyname(slave_fd)
+        stop = threading.Event()
+
+        def fake_serial_receiver():
+            buf = b''
+            while not stop.is_set():
+                try:
+                    data = os.read(master_fd, 1024)
+                except OSError:
+                    break
+                buf += data
+                while b'\n' in buf:
+                    (line, buf) = buf.split(b'\n', 1)
+                    if line.startswith(b'!1PWRQSTN'):
+                        os.write(master_fd, b'!1PWR01\x1a\r\n')
+
+        responder = threading.Thread(target=fake_serial_receiver, daemon=True)
+        responder.start()
+        receiver = AsyncSerialReceiver(devfile, timeout=2.0)
+        num_fds = None
+        for i in range(cycles):
+            await receiver.connect()
+            response = await receiver.raw('PWRQSTN')
+            assert response == 'PWR01', response
+            await receiver.disconnect()
+            # give the transports the chance to close their pipes
+            await asyncio.sleep(0)
+            if num_fds is None:
+                num_fds = len(os.listdir('/proc/self/fd'))
+        leaked = len(os.listdir('/proc/self/fd')) - num_fds
+        stop.set()
+        os.close(slave_fd)
+        os.close(master_fd)
+        print('%i serial reconnects, %i file descriptors leaked' % (cycles, leaked))
+
+    asyncio.run(main())
+    if os.path.isdir('/proc/self/fd'):
+        asyncio.run(serial_reconnect())
@@ -7,10 +7,9 @@ import struct
 import time
 import socket, select
 import queue, threading
+import bisect
 from collections import namedtuple
 
-from . import commands
-
 
 class ISCPMessage(object):
     """Deals with formatting and parsing data wrapped in an ISCP
@@ -115,6 +114,10 @@ def normalize_command(command):
     return command
 
 
+_command_sep = re.compile(r'[. ]')
+_argument_sep = re.compile(r'[:=]')
+_argument_list_sep = re.compile(r'[ ,]')
+
 def command_to_iscp(command, arguments=None, zone=None):
     """Transform the given given high-level command to a
     low-level ISCP message.
@@ -146,25 +149,24 @@ def command_to_iscp(command, arguments=None, zone=None):
         command('zone2.volume=66')
     """
     default_zone = 'main'
-    command_sep = r'[. ]'
     norm = lambda s: s.strip().lower()
 
     # If parts are not explicitly given, parse the command
     if arguments is None and zone is None:
         # Separating command and args with colon allows multiple args
         if ':' in command or '=' in command:
-            base, arguments = re.split(r'[:=]', command, 1)
-            parts = [norm(c) for c in re.split(command_sep, base)]
+            base, arguments = _argument_sep.split(command, 1)
+            parts = [norm(c) for c in _command_sep.split(base)]
             if len(parts) == 2:
                 zone, command = parts
             else:
                 zone = default_zone
                 command = parts[0]
             # Split arguments by comma or space
-            arguments = [norm(a) for a in re.split(r'[ ,]', arguments)]
+            arguments = [norm(a) for a in _argument_list_sep.split(arguments)]
         else:
             # Split command part by space or dot
-            parts = [norm(c) for c in re.split(command_sep, command)]
+            parts = [norm(c) for c in _command_sep.split(command)]
             if len(parts) >= 3:
                 zone, command = parts[:2]
                 arguments = parts[3:]
@@ -176,12 +178,13 @@ def command_to_iscp(command, arguments=None, zone=None):
                 raise ValueError('Need at least command and argument')
 
     # Find the command in our database, resolve to internal eISCP command
-    group = commands.ZONE_MAPPINGS.get(zone, zone)
-    if not zone in commands.COMMANDS:
+    table = _get_command_table()
+    group = table.zone_mappings.get(zone, zone)
+    if not group in table.zones:
         raise ValueError('"%s" is not a valid zone' % zone)
 
-    prefix = commands.COMMAND_MAPPINGS[group].get(command, command)
-    if not prefix in commands.COMMANDS[group]:
+    prefix = table.command_mappings.get(group, {}).get(command, command)
+    if not (group, prefix) in table.zone_commands:
         raise ValueError('"%s" is not a valid command in zone "%s"'
                 % (command, zone))
 
@@ -193,19 +196,13 @@ def command_to_iscp(command, arguments=None, zone=None):
     argument = arguments[0]
 
     # 1. Consider if there is a alias, e.g. level-up for UP.
-    try:
-        value = commands.VALUE_MAPPINGS[group][prefix][argument]
-    except KeyError:
+    value = table.value_codes.get((group, prefix, argument))
+    if value is None:
         # 2. See if we can match a range or pattern
-        for possible_arg in commands.VALUE_MAPPINGS[group][prefix]:
-            if argument.isdigit():
-                if isinstance(possible_arg, xrange):
-                    if int(argument) in possible_arg:
-                        # We need to send the format "FF", hex() gives us 0xff
-                        value = hex(int(argument))[2:].upper()
-                    break
-
-            # TODO: patterns not yet supported
+        # TODO: patterns not yet supported
+        if argument.isdigit() and table.in_range(group, prefix, int(argument)):
+            # We need to send the format "FF", hex() gives us 0xff
+            value = hex(int(argument))[2:].upper()
         else:
             raise ValueError('"%s" is not a valid argument for command '
                              '"%s" in zone "%s"' % (argument, command, zone))
@@ -213,26 +210,88 @@ def command_to_iscp(command, arguments=None, zone=None):
     return '%s%s' % (prefix, value)
 
 
-def iscp_to_command(iscp_message):
-    for zone, zone_cmds in commands.COMMANDS.items():
-        # For now, ISCP commands are always three characters, which
-        # makes this easy.
-        command, args = iscp_message[:3], iscp_message[3:]
-        if command in zone_cmds:
-            if args in zone_cmds[command]['values']:
-                return zone_cmds[command]['name'], \
-                       zone_cmds[command]['values'][args]['name']
-            else:
-                match = re.match('[+-]?[0-9a-f]$', args, re.IGNORECASE)
-                if match:
-                    return zone_cmds[command]['name'], \
-                             int(args, 16)
-                else:
-                    return zone_cmds[command]['name'], args
+_hex_argument = re.compile('[+-]?[0-9a-f]$', re.IGNORECASE)
 
-    else:
+def iscp_to_command(iscp_message):
+    # For now, ISCP commands are always three characters, which
+    # makes this easy.
+    command, args = iscp_message[:3], iscp_message[3:]
+    entry = _get_command_table().by_prefix.get(command)
+    if entry is None:
         raise ValueError(
             'Cannot convert ISCP message to command: %s' % iscp_message)
+    name, value_names = entry
+    if args in value_names:
+        return name, value_names[args]
+    elif _hex_argument.match(args):
+        return name, int(args, 16)
+    else:
+        return name, args
+
+
+class _CommandTable(object):
+    """Lookup tables compiled from the generated commands module.
+
+    ``by_prefix`` maps the three character ISCP command to its name and
+    the names of its values, using the first zone which knows the
+    command. ``value_codes`` maps (zone, command, argument) to the ISCP
+    value and ``ranges`` holds the numeric ranges of each (zone, command)
+    sorted by their start, to be searched with bisect.
+    """
+
+    def __init__(self, commands):
+        self.zones = set(commands.COMMANDS.keys())
+        self.zone_mappings = commands.ZONE_MAPPINGS
+        self.command_mappings = commands.COMMAND_MAPPINGS
+        self.zone_commands = set()
+        self.by_prefix = {}
+        for zone, zone_cmds in commands.COMMANDS.items():
+            for prefix, cmd in zone_cmds.items():
+                self.zone_commands.add((zone, prefix))
+                if prefix not in self.by_prefix:
+                    value_names = dict([ (args, value['name']) for args, value in cmd['values'].items() ])
+                    self.by_prefix[prefix] = (cmd['name'], value_names)
+
+        self.value_codes = {}
+        self.ranges = {}
+        for zone, zone_values in commands.VALUE_MAPPINGS.items():
+            for prefix, values in zone_values.items():
+                ranges = []
+                for argument, value in values.items():
+                    if isinstance(argument, range):
+                        ranges.append(argument)
+                    else:
+                        self.value_codes[(zone, prefix, argument)] = value
+                if ranges:
+                    ranges.sort(key=lambda r: r.start)
+                    self.ranges[(zone, prefix)] = ([ r.start for r in ranges ], ranges)
+
+    def in_range(self, zone, command, number):
+        entry = self.ranges.get((zone, command))
+        if entry is None:
+            return False
+        starts, ranges = entry
+        # only ranges starting at or before the number can contain it
+        for i in range(bisect.bisect_right(starts, number) - 1, -1, -1):
+            if number in ranges[i]:
+                return True
+        return False
+
+
+_command_table = None
+_command_table_lock = threading.Lock()
+
+def _get_command_table():
+    """Returns the compiled command table. The large generated commands
+    module is only imported on first use, so users sending raw ISCP
+    messages never pay for it."""
+    global _command_table
+    if _command_table is None:
+        with _command_table_lock:
+            if _command_table is None:
+                from . import commands
+                _command_table = _CommandTable(commands)
+    return _command_table
 
 class eISCPTimeoutError(Exception):
     def __init__(self, timeout=None):
@@ -523,3 +582,37 @@ class Receiver(eISCP):
 
         finally:
             eISCP.disconnect(self)
+
+
+if __name__ == '__main__':
+    # benchmark: import time and message translation
+    import subprocess
+    import sys
+
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    for module in [ 'arsoft.eiscp.core', 'arsoft.eiscp.commands' ]:
+        durations = []
+        for i in range(5):
+            output = subprocess.check_output([ sys.executable, '-c',
+                'import time; start = time.time(); import %s; print(time.time() - start)' % module ])
+            durations.append(float(output))
+        print('import %s: %.1fms' % (module, min(durations) * 1000))
+
+    start = time.time()
+    _get_command_table()
+    print('compile command table: %.1fms' % ((time.time() - start) * 1000))
+
+    messages = [ 'PWR01', 'MVL32', 'SLI10', 'TUN10270', 'NTCPLAY', 'ZVLUP', 'CTLUP', 'LMD00' ]
+    start = time.time()
+    for i in range(num):
+        iscp_to_command(messages[i % len(messages)])
+    duration = time.time() - start
+    print('iscp_to_command: %i messages in %.3fs (%.2fus/message)' % (num, duration, duration * 1e6 / num))
+
+    commands = [ 'system-power on', 'master-volume 50', 'zone2.volume=20', 'main.master-volume:level-up', 'audio-muting toggle' ]
+    start = time.time()
+    for i in range(num):
+        command_to_iscp(commands[i % len(commands)])
+    duration = time.time() - start
+    print('command_to_iscp: %i commands in %.3fs (%.2fus/command)' % (num, duration, duration * 1e6 / num))
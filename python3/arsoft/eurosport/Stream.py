@@ -8,7 +8,7 @@ import arsoft.m3u8 as m3u8
 import urllib.request, urllib.error
 import time
 import threading
-from collections import deque
+from collections import OrderedDict
 from Crypto.Cipher import AES
 
 BS = 16
@@ -30,15 +30,89 @@ class AESCipher:
         cipher = AES.new(self.key, AES.MODE_CBC, self.iv )
         return unpad(cipher.decrypt( enc ))
 
+class KeyCache(object):
+    """
+    Least recently used cache of the AES keys of a stream by their URI, so
+    the key is fetched once and not again for every segment.
+    """
+    def __init__(self, max_keys=16):
+        self.max_keys = max_keys
+        self._keys = OrderedDict()
+        self._cond = threading.Condition()
+        self._fetching = set()
+
+    def get(self, uri, fetch):
+        with self._cond:
+            # parallel downloads of segments with the same key wait for a
+            # single fetch instead of all requesting the key
+            while uri in self._fetching:
+                self._cond.wait()
+            keydata = self._keys.get(uri)
+            if keydata is not None:
+                self._keys.move_to_end(uri)
+                return keydata
+            self._fetching.add(uri)
+        keydata = None
+        try:
+            keydata = fetch(uri)
+        finally:
+            with self._cond:
+                self._fetching.discard(uri)
+                if keydata is not None:
+                    self._keys[uri] = keydata
+                    while len(self._keys) > self.max_keys:
+                        self._keys.popitem(last=False)
+                self._cond.notify_all()
+        return keydata
+
+    def clear(self):
+        with self._cond:
+            self._keys.clear()
+
+class SegmentDecryptor(object):
+    """
+    Decrypts an AES-128 CBC encrypted segment piece by piece while it is
+    downloaded. The last block is held back until finish() because it
+    carries the PKCS7 padding.
+    """
+    def __init__(self, key, iv):
+        self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        self._pending = b''
+
+    def update(self, data):
+        data = self._pending + data
+        size = len(data) - (len(data) % BS)
+        if size == len(data):
+            size -= BS
+        if size <= 0:
+            self._pending = data
+            return b''
+        self._pending = data[size:]
+        return self._cipher.decrypt(data[:size])
+
+    def finish(self):
+        if not self._pending:
+            return b''
+        if len(self._pending) % BS:
+            raise ValueError('Encrypted segment size is not a multiple of %i' % BS)
+        data = self._cipher.decrypt(self._pending)
+        self._pending = b''
+        padding = data[-1]
+        if 1 <= padding <= BS:
+            data = data[:-padding]
+        return data
+
 class Stream:
 
-    def __init__(self, stream_config, cookie):
+    def __init__(self, stream_config, cookie, key_cache=None, chunk_size=64*1024):
         self.m3u_list = None
         self.uri = None
         self.my_cookie = None
         self.uri = stream_config.absolute_uri
         self._headers = {'Cookie': 'authentication=%s'%cookie}
         self._segment_index = -1
+        self._key_cache = key_cache if key_cache is not None else KeyCache()
+        self._chunk_size = chunk_size
         self.stream_config = stream_config
         if self.stream_config.stream_info is None:
             self.download_playlist()
@@ -62,9 +136,7 @@ class Stream:
 
     def get_stream_url(self):
         if self.m3u_list is not None and self._segment_index < len(self.m3u_list.segments):
-            seg = self.m3u_list.segments[self._segment_index]
-            ret = seg.base_uri + '/' + seg.uri
-            return ret
+            return self._segment_url(self.m3u_list.segments[self._segment_index])
         else:
             return None
 
@@ -76,8 +148,15 @@ class Stream:
     def bandwidth(self):
         return self.get_available_bandwidth()
 
-    def _get_key(self, key):
-        url = key.uri
+    @property
+    def media_sequence(self):
+        return (self.m3u_list.media_sequence or 0) if self.m3u_list is not None else 0
+
+    @property
+    def is_endlist(self):
+        return self.m3u_list.is_endlist if self.m3u_list is not None else False
+
+    def _fetch_key(self, url):
         try:
             #req = urllib.request.Request(url, headers=self._headers)
             req = urllib.request.Request(url)
@@ -87,37 +166,64 @@ class Stream:
             print('Http error on %s: %s' % (url, e))
         return None
 
-    def get_part(self):
-        if self.m3u_list is None:
-            return None
+    def _get_key(self, key):
+        return self._key_cache.get(key.absolute_uri, self._fetch_key)
 
-        url = None
-        cipher = None
-        self._segment_index += 1
-        if self._segment_index < len(self.m3u_list.segments):
-            seg = self.m3u_list.segments[self._segment_index]
-            if seg.key:
-                print(seg.key)
-                keydata = self._get_key(seg.key)
-                if keydata:
-                    cipher = AESCipher(keydata, iv=seg.key.iv)
-            url = seg.base_uri + '/' + seg.uri
-
-        if url is None:
-            return None
+    def _segment_url(self, seg):
+        return seg.base_uri + '/' + seg.uri
 
-        data = None
+    def _segment_decryptor(self, seg, sequence):
+        if not seg.key or seg.key.method != 'AES-128':
+            return None
+        keydata = self._get_key(seg.key)
+        if not keydata:
+            return None
+        if seg.key.iv:
+            iv = bytes.fromhex(seg.key.iv[2:] if seg.key.iv[0:2] in ['0x', '0X'] else seg.key.iv).rjust(BS, b'\0')
+        else:
+            # without an IV the media sequence number is used
+            iv = sequence.to_bytes(BS, 'big')
+        return SegmentDecryptor(keydata, iv)
+
+    def iter_segment(self, seg, sequence):
+        """
+        Downloads the given segment and yields its decrypted data in chunks
+        of at most chunk_size bytes, so the segment never has to be held in
+        memory in its encrypted and decrypted form at once.
+        """
+        decryptor = self._segment_decryptor(seg, sequence)
+        url = self._segment_url(seg)
         try:
             req = urllib.request.Request(url, headers=self._headers)
             contents = urllib.request.urlopen(req)
-            data = contents.read()
-
+            while True:
+                data = contents.read(self._chunk_size)
+                if not data:
+                    break
+                if decryptor is not None:
+                    data = decryptor.update(data)
+                if data:
+                    yield data
+            if decryptor is not None:
+                data = decryptor.finish()
+                if data:
+                    yield data
         except urllib.error.HTTPError as e:
             print('Http error on %s: %s' % (url, e))
-        if data and cipher:
-            data = cipher.decrypt(data)
 
-        return data
+    def get_segment_data(self, seg, sequence):
+        return b''.join(self.iter_segment(seg, sequence))
+
+    def get_part(self):
+        if self.m3u_list is None:
+            return None
+
+        self._segment_index += 1
+        if self._segment_index >= len(self.m3u_list.segments):
+            return None
+        seg = self.m3u_list.segments[self._segment_index]
+        data = self.get_segment_data(seg, self.media_sequence + self._segment_index)
+        return data if data else None
 
     def get_available_bandwidth(self):
         return self.stream_info.bandwidth
@@ -140,41 +246,167 @@ class Stream:
 
 
 class StreamDownloader(object):
-
-    def __init__(self, stream):
-        self.downloaded_parts = {}
-        self.stream = None
-        self.parts_to_be_played = deque([])
+    """
+    Downloads the parts of a stream in background threads. Up to
+    max_workers parts are downloaded at the same time and no more than
+    prefetch parts are downloaded ahead of the consumer. No new download is
+    started as long as the parts waiting for the consumer take up
+    max_buffer_size bytes or more, so at most max_workers parts are held in
+    memory on top of that.
+    """
+    def __init__(self, stream, max_workers=4, prefetch=8, max_buffer_size=32*1024*1024, playlist_refresh_interval=1.0):
         self.stream = stream
+        self.max_workers = max(1, max_workers)
+        self.prefetch = max(self.max_workers, prefetch)
+        self.max_buffer_size = max_buffer_size
+        self.playlist_refresh_interval = playlist_refresh_interval
+        self._cond = threading.Condition()
         self._stop = False
-        threading.Thread(target=self.play).start()
-        pass
-
-    def play(self):
-        while not self._stop:
+        # parts are identified by their media sequence number
+        self._next_sequence = None
+        self._next_part = None
+        self._ready = {}
+        self._buffer_size = 0
+        self._active = 0
+        self._refreshing = False
+        self._last_refresh = 0
+        self._finished = False
+        self._threads = []
+        for i in range(self.max_workers):
+            t = threading.Thread(target=self._worker, name='StreamDownloader-%i' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _next_segment(self):
+        # called with the condition held; returns the next segment to download
+        if self.stream.m3u_list is None:
+            return None
+        segments = self.stream.m3u_list.segments
+        first = self.stream.media_sequence
+        if self._next_sequence is None or self._next_sequence < first:
+            if self._next_sequence is not None:
+                # the playlist moved on while we were behind
+                print('Stream skipped parts %i to %i' % (self._next_sequence, first - 1))
+                self._discard_ready(first)
+            self._next_sequence = first
+            self._next_part = first
+        index = self._next_sequence - first
+        if index >= len(segments):
+            return None
+        ret = (self._next_sequence, segments[index])
+        self._next_sequence += 1
+        return ret
+
+    def _discard_ready(self, sequence):
+        for seq in [ seq for seq in self._ready if seq < sequence ]:
+            data = self._ready.pop(seq)
+            if data:
+                self._buffer_size -= len(data)
+
+    def _refresh_playlist(self):
+        # called with the condition held, which is released while downloading
+        self._refreshing = True
+        self._cond.release()
+        try:
+            self.stream.download_playlist()
+        except Exception as e:
+            print('Failed to download playlist: %s' % e)
+        finally:
+            self._cond.acquire()
+            self._refreshing = False
+            self._last_refresh = time.time()
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                item = None
+                while not self._stop:
+                    if self._next_part is not None and self._next_sequence is not None and \
+                        (self._next_sequence - self._next_part >= self.prefetch or self._buffer_size >= self.max_buffer_size):
+                        self._cond.wait()
+                        continue
+                    item = self._next_segment()
+                    if item is not None:
+                        break
+                    if self.stream.m3u_list is not None and self.stream.is_endlist:
+                        if self._active == 0:
+                            self._finished = True
+                            self._cond.notify_all()
+                        self._cond.wait()
+                    elif self._refreshing:
+                        self._cond.wait()
+                    else:
+                        delay = self._last_refresh + self.playlist_refresh_interval - time.time()
+                        if delay > 0:
+                            self._cond.wait(delay)
+                        else:
+                            self._refresh_playlist()
+                if self._stop:
+                    return
+                self._active += 1
+
+            (sequence, seg) = item
+            data = None
             try:
-                url = self.stream.get_stream_url()
-                if url is None:
-                    self.stream.download_playlist()
-                    time.sleep(1)
-                    continue
-                else:
-                    print('Downloading part ' + url)
-                    self.downloaded_parts[url] = True
-                    self.parts_to_be_played.append(self.stream.get_part())
-            except KeyboardInterrupt:
-                self._stop = True
+                print('Downloading part %i %s' % (sequence, seg.uri))
+                data = self.stream.get_segment_data(seg, sequence)
+            except Exception as e:
+                print('Failed to download part %i: %s' % (sequence, e))
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    if sequence >= self._next_part:
+                        self._ready[sequence] = data
+                        if data:
+                            self._buffer_size += len(data)
+                    self._cond.notify_all()
 
     def stop(self):
-        self._stop = True
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        for t in self._threads:
+            t.join(timeout)
+
+    def _pop_next_part(self):
+        # called with the condition held; failed parts are skipped
+        while self._next_part in self._ready:
+            data = self._ready.pop(self._next_part)
+            self._next_part += 1
+            self._cond.notify_all()
+            if data:
+                self._buffer_size -= len(data)
+                return data
+        return None
 
-    def get_next_part(self):
-        if len(self.parts_to_be_played) == 0:
-            raise StreamDownloader.NoDataAvailable
-        else:
-            return self.parts_to_be_played.popleft()
+    def get_next_part(self, block=False, timeout=None):
+        """
+        Returns the data of the next part. Without block NoDataAvailable is
+        raised if the part has not been downloaded yet, otherwise the call
+        waits until it is. None is returned once all parts of a finished
+        stream have been consumed.
+        """
+        with self._cond:
+            deadline = time.time() + timeout if timeout is not None else None
+            while True:
+                data = self._pop_next_part()
+                if data is not None:
+                    return data
+                if self._finished and self._active == 0 and not self._ready:
+                    return None
+                if not block or self._stop:
+                    raise StreamDownloader.NoDataAvailable
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise StreamDownloader.NoDataAvailable
+                    self._cond.wait(remaining)
 
     class NoDataAvailable(Exception):
         pass
-
-
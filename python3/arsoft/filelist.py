@@ -3,7 +3,195 @@
 # kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
 
 import glob
+import fnmatch
+import json
+import os
 import os.path
+import re
+import tempfile
+import threading
+import time
+
+class DirectoryListingCache(object):
+    """
+    Keeps the listings of directories keyed by the modification time of the
+    directory, optionally stored in a file to be reused by the next run.
+    Listings of directories modified within the last RACY_INTERVAL seconds
+    are not cached, because a change within the same timestamp tick would
+    go unnoticed.
+    """
+    RACY_INTERVAL = 2
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._used = set()
+        self._modified = False
+        if filename is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+            self._entries = dict([ (path, (tuple(key), entries)) for (path, key, entries) in data ])
+            ret = True
+        except (IOError, OSError, ValueError, TypeError):
+            self._entries = {}
+            ret = False
+        self._used = set()
+        self._modified = False
+        return ret
+
+    def save(self):
+        if self.filename is None:
+            return False
+        with self._lock:
+            # only keep the directories used by this run
+            if not self._modified and len(self._used) == len(self._entries):
+                return True
+            data = [ (path, key, entries) for (path, (key, entries)) in self._entries.items() if path in self._used ]
+        try:
+            (fd, tmpfile) = tempfile.mkstemp(prefix='.' + os.path.basename(self.filename), dir=os.path.dirname(self.filename) or None)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmpfile, self.filename)
+            self._modified = False
+            ret = True
+        except (IOError, OSError):
+            ret = False
+        return ret
+
+    @staticmethod
+    def _scandir(path):
+        ret = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                ret.append( (entry.name, is_dir, entry.is_symlink()) )
+        return ret
+
+    def listdir(self, path):
+        """Returns a list of (name, is_dir) of the given directory."""
+        st = os.stat(path or os.curdir)
+        key = (st.st_ino, st.st_mtime_ns)
+        with self._lock:
+            cached = self._entries.get(path)
+        if cached is not None and cached[0] == key:
+            entries = cached[1]
+        else:
+            entries = self._scandir(path or os.curdir)
+            if st.st_mtime_ns < (time.time() - self.RACY_INTERVAL) * 1e9:
+                with self._lock:
+                    self._entries[path] = (key, entries)
+                    self._modified = True
+            cached = None
+        with self._lock:
+            self._used.add(path)
+        ret = []
+        for (name, is_dir, is_symlink) in entries:
+            if is_symlink and cached is not None:
+                # the target of a symlink may change without touching the directory
+                is_dir = os.path.isdir(os.path.join(path, name))
+            ret.append( (name, is_dir) )
+        return ret
+
+class _PatternNode(object):
+    def __init__(self, component=None):
+        self.component = component
+        self.regex = re.compile(fnmatch.translate(component)) if component and glob.has_magic(component) else None
+        self.children = {}
+        self.patterns = []
+
+class GlobExpander(object):
+    """
+    Expands a set of glob patterns at once. All patterns are compiled into a
+    tree of path components, which is walked once with os.scandir: every
+    directory is listed at most once, and only subdirectories which can
+    still match any pattern are entered. The results are the same as with
+    glob.glob for each pattern.
+    """
+    def __init__(self, listing_cache=None):
+        self.listing_cache = listing_cache
+        self._roots = {}
+        self._results = {}
+        self._listings = {}
+
+    def add(self, pattern):
+        if pattern in self._results:
+            return
+        self._results[pattern] = None
+        if not glob.has_magic(pattern):
+            return
+        dirname = pattern
+        components = []
+        while glob.has_magic(dirname):
+            (dirname, basename) = os.path.split(dirname)
+            components.insert(0, basename)
+        node = self._roots.get(dirname)
+        if node is None:
+            node = self._roots[dirname] = _PatternNode()
+        for comp in components:
+            child = node.children.get(comp)
+            if child is None:
+                child = node.children[comp] = _PatternNode(comp)
+            node = child
+        node.patterns.append(pattern)
+
+    def _listdir(self, dirname):
+        ret = self._listings.get(dirname)
+        if ret is None:
+            try:
+                if self.listing_cache is not None:
+                    ret = self.listing_cache.listdir(dirname)
+                else:
+                    ret = [ (name, is_dir) for (name, is_dir, is_symlink) in DirectoryListingCache._scandir(dirname or os.curdir) ]
+            except OSError:
+                ret = []
+            self._listings[dirname] = ret
+        return ret
+
+    def _walk(self, dirname, node, is_dir):
+        for pattern in node.patterns:
+            self._results[pattern].append(dirname)
+        if not node.children or not is_dir:
+            return
+        magic_children = []
+        for (comp, child) in node.children.items():
+            if child.regex is None:
+                path = os.path.join(dirname, comp)
+                if os.path.lexists(path):
+                    self._walk(path, child, bool(child.children) and os.path.isdir(path))
+            else:
+                magic_children.append(child)
+        if magic_children:
+            entries = self._listdir(dirname)
+            for child in magic_children:
+                with_hidden = child.component[0] == '.'
+                for (name, entry_is_dir) in entries:
+                    if name[0] == '.' and not with_hidden:
+                        continue
+                    if child.regex.match(name):
+                        # prune: a file can only be the last component
+                        if not entry_is_dir and not child.patterns:
+                            continue
+                        self._walk(os.path.join(dirname, name), child, entry_is_dir)
+
+    def expand(self):
+        for pattern in self._results:
+            self._results[pattern] = []
+            if not glob.has_magic(pattern) and pattern and os.path.lexists(pattern):
+                self._results[pattern].append(pattern)
+        for (dirname, node) in self._roots.items():
+            self._walk(dirname, node, not dirname or os.path.isdir(dirname))
+        self._listings = {}
+
+    def matches(self, pattern):
+        return self._results.get(pattern) or []
 
 class FileListItemBase(object):
     def __init__(self, filename=None, base_directory=None, use_glob=True):
@@ -11,6 +199,7 @@ class FileListItemBase(object):
         self._base_directory = base_directory
         self._use_glob = use_glob
         self._items = None
+        self._pending = []
         self.clear()
         if filename is not None:
             self.open(filename)
@@ -61,6 +250,7 @@ class FileListItemBase(object):
             fobj = filename_or_fileobj
 
         if fobj:
+            self._resolve()
             try:
                 for it in self.__iter__():
                     it_str = self._item_to_string(it)
@@ -75,11 +265,33 @@ class FileListItemBase(object):
 
     def clear(self):
         self._items = set()
+        self._pending = []
+
+    def add_patterns(self, expander):
+        for pending in self._pending:
+            expander.add(pending[0])
+
+    def apply_expansion(self, expander):
+        pending = self._pending
+        self._pending = []
+        for args in pending:
+            self._append_expanded(expander.matches(args[0]), *args)
+
+    def _resolve(self):
+        # patterns are expanded when the items are needed, so a file list can
+        # expand the patterns of all its items in a single pass
+        if self._pending:
+            expander = GlobExpander()
+            self.add_patterns(expander)
+            expander.expand()
+            self.apply_expansion(expander)
 
     def empty(self):
+        self._resolve()
         return False if self._items else True
 
     def __str__(self):
+        self._resolve()
         return ','.join(self._items)
 
     def _item_to_string(self, item):
@@ -101,6 +313,7 @@ class FileListItemBase(object):
         self._base_directory = value
 
     def __len__(self):
+        self._resolve()
         return len(self._items)
 
     def extend(self, list):
@@ -114,19 +327,23 @@ class FileListItem(FileListItemBase):
     def append(self, item):
         fullname = os.path.join(self._base_directory, item) if self._base_directory else item
         if self._use_glob:
-            newitems = glob.glob(fullname)
-            if newitems:
-                self._items = self._items.union(newitems)
-            else:
-                self._items.add(item)
+            self._pending.append( (fullname, item) )
+        else:
+            self._items.add(item)
+
+    def _append_expanded(self, newitems, fullname, item):
+        if newitems:
+            self._items.update(newitems)
         else:
             self._items.add(item)
 
     def __iter__(self):
+        self._resolve()
         return iter(self._items)
 
     @property
     def items(self):
+        self._resolve()
         return self._items
 
     @items.setter
@@ -154,8 +371,10 @@ class FileListItemWithDestination(FileListItemBase):
 
     def clear(self):
         self._items = {}
+        self._pending = []
 
     def __iter__(self):
+        self._resolve()
         return iter(self._items.items())
 
     def _item_to_string(self, item):
@@ -186,19 +405,21 @@ class FileListItemWithDestination(FileListItemBase):
         else:
             source_fullname = os.path.join(self._base_directory, source)
         if self._use_glob:
-            newitems = glob.glob(source_fullname)
-            if newitems:
-                for newitem in newitems:
-                    if newitem == source_fullname: continue
-                    if dest is None:
-                        dest_fullname = os.path.basename(newitem)
-                    else:
-                        if self._dest_base_directory:
-                            dest_fullname = os.path.join(self._dest_base_directory, dest)
-                        else:
-                            dest_fullname = dest
-                    self._items[newitem] = dest_fullname
+            self._pending.append( (source_fullname, source, dest) )
+        else:
+            if dest is None:
+                dest_fullname = os.path.basename(source_fullname)
             else:
+                if self._dest_base_directory:
+                    dest_fullname = os.path.join(self._dest_base_directory, dest)
+                else:
+                    dest_fullname = dest
+            self._items[source] = dest_fullname
+
+    def _append_expanded(self, newitems, source_fullname, source, dest):
+        if newitems:
+            for newitem in newitems:
+                if newitem == source_fullname: continue
                 if dest is None:
                     dest_fullname = os.path.basename(newitem)
                 else:
@@ -206,7 +427,7 @@ class FileListItemWithDestination(FileListItemBase):
                         dest_fullname = os.path.join(self._dest_base_directory, dest)
                     else:
                         dest_fullname = dest
-                self._items[source] = dest_fullname
+                self._items[newitem] = dest_fullname
         else:
             if dest is None:
                 dest_fullname = os.path.basename(source_fullname)
@@ -217,10 +438,10 @@ class FileListItemWithDestination(FileListItemBase):
                     dest_fullname = dest
             self._items[source] = dest_fullname
 
-
     @property
     def items(self):
         #print('return items %s' % self._items)
+        self._resolve()
         return self._items
 
     @items.setter
@@ -233,11 +454,12 @@ class FileListItemWithDestination(FileListItemBase):
             self.append(value)
 
 class FileListBase(object):
-    def __init__(self, filename=None, base_directory=None, use_glob=True):
+    def __init__(self, filename=None, base_directory=None, use_glob=True, listing_cache=None):
         self._items = []
         self._plain_list = None
         self._base_directory = base_directory
         self._use_glob = use_glob
+        self.listing_cache = listing_cache
         if filename is not None:
             self.open(filename)
 
@@ -250,6 +472,15 @@ class FileListBase(object):
         self._build_plain_list()
         return False if self._plain_list else True
 
+    def _expand_patterns(self):
+        # expand the patterns of all items with one walk over the file system
+        expander = GlobExpander(listing_cache=self.listing_cache)
+        for i in self._items:
+            i.add_patterns(expander)
+        expander.expand()
+        for i in self._items:
+            i.apply_expansion(expander)
+
     def open(self, filename):
         self.clear()
         if isinstance(filename, list):
@@ -303,8 +534,8 @@ class FileListBase(object):
         return ret
 
 class FileList(FileListBase):
-    def __init__(self, filename=None, base_directory=None, use_glob=True):
-        FileListBase.__init__(self, filename, base_directory, use_glob)
+    def __init__(self, filename=None, base_directory=None, use_glob=True, listing_cache=None):
+        FileListBase.__init__(self, filename, base_directory, use_glob, listing_cache)
 
     @staticmethod
     def from_list(list, base_directory=None, use_glob=True):
@@ -316,6 +547,7 @@ class FileList(FileListBase):
 
     def _build_plain_list(self):
         if self._plain_list is None:
+            self._expand_patterns()
             self._plain_list = []
             for i in self._items:
                 self._plain_list.extend(i.items)
@@ -358,8 +590,8 @@ class FileList(FileListBase):
         return self._plain_list.__iter__()
 
 class FileListWithDestination(FileListBase):
-    def __init__(self, filename=None, base_directory=None, dest_base_directory=None, use_glob=True):
-        FileListBase.__init__(self, filename, base_directory, use_glob)
+    def __init__(self, filename=None, base_directory=None, dest_base_directory=None, use_glob=True, listing_cache=None):
+        FileListBase.__init__(self, filename, base_directory, use_glob, listing_cache)
         self._dest_base_directory = dest_base_directory
 
     @property
@@ -380,6 +612,7 @@ class FileListWithDestination(FileListBase):
 
     def _build_plain_list(self):
         if self._plain_list is None:
+            self._expand_patterns()
             self._plain_list = {}
             for i in self._items:
                 for it in i.__iter__():
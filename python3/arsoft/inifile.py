@@ -5,6 +5,10 @@
 import re
 import datetime
 import os
+import io
+import stat
+import tempfile
+import threading
 from .timestamp import timestamp_from_datetime
 from .utils import unquote_string, escape_string_for_c, unescape_string_from_c
 
@@ -17,13 +21,38 @@ class IniSection(object):
         self.original = original
         self.comment = comment
         self.values = []
+        # key -> lines with this key (in file order)
+        self._index = {}
 
     def clone(self, newinifile=None):
         ret = IniSection(newinifile if newinifile else self.inifile, self.name, self.lineno, self.original, self.comment)
         for v in iter(self.values):
-            ret.values.append(v.clone(newinifile))
+            ret._appendLine(v.clone(newinifile))
         return ret
 
+    def _indexLine(self, line):
+        if line.key is not None:
+            lines = self._index.get(line.key)
+            if lines is None:
+                self._index[line.key] = [line]
+            else:
+                lines.append(line)
+
+    def _unindexLine(self, line):
+        lines = self._index.get(line.key)
+        if lines is not None:
+            lines.remove(line)
+            if not lines:
+                del self._index[line.key]
+
+    def _appendLine(self, line):
+        self.values.append(line)
+        self._indexLine(line)
+
+    def _removeLine(self, line):
+        self.values.remove(line)
+        self._unindexLine(line)
+
     class IniLine(object):
         inifile = None
         lineno = -1
@@ -82,9 +111,9 @@ class IniSection(object):
             return self.asString(only_data=False)
 
     def get(self, key, default=''):
-        for v in self.values:
-            if v.key == key:
-                return v.value
+        lines = self._index.get(key)
+        if lines:
+            return lines[0].value
         return default
 
     def getAsBoolean(self, key, default=None):
@@ -148,8 +177,8 @@ class IniSection(object):
     def getAsArray(self, key, default=[]):
         ret = []
         found = False
-        for v in self.values:
-            if v.key == key and not v.disabled:
+        for v in self._index.get(key, []):
+            if not v.disabled:
                 ret.append( v.value )
                 found = True
         return ret if found else default
@@ -169,32 +198,30 @@ class IniSection(object):
         return ret
 
     def set(self, key, value, comment='', disabled=False):
+        lines = self._index.get(key, [])
         if type(value) == list:
-            idx = 0
-            found = 0
-            last = -1
             num_values = len(value)
-            i = 0
-            for v in iter(self.values):
-                if v.key == key:
-                    if idx < num_values:
-                        v.value = value[idx]
-                        if type(comment) == list:
-                            v.comment = comment[idx]
-                        else:
-                            v.comment = comment
-                        if type(disabled) == list:
-                            v.disabled = disabled[idx]
-                        else:
-                            v.disabled = disabled
-                        v.original = None
-                        idx += 1
-                        found += 1
-                        last = i
+            found = 0
+            last = None
+            for v in list(lines):
+                if found < num_values:
+                    v.value = value[found]
+                    if type(comment) == list:
+                        v.comment = comment[found]
+                    else:
+                        v.comment = comment
+                    if type(disabled) == list:
+                        v.disabled = disabled[found]
                     else:
-                        self.values.remove(v)
-                i += 1
+                        v.disabled = disabled
+                    v.original = None
+                    found += 1
+                    last = v
+                else:
+                    self._removeLine(v)
             if found < num_values:
+                # additional values go right after the existing ones
+                pos = self.values.index(last) + 1 if last is not None else len(self.values)
                 for idx in range(found, num_values):
                     if type(comment) == list:
                         c = comment[idx]
@@ -205,51 +232,38 @@ class IniSection(object):
                     else:
                         d = disabled
                     iniline = IniSection.IniLine(self.inifile, -1, None, key, value[idx], c, d)
-                    if last < 0:
-                        self.values.append(iniline)
-                    else:
-                        self.values.insert(last, iniline)
-                        last += 1
+                    self.values.insert(pos, iniline)
+                    self._indexLine(iniline)
+                    pos += 1
             ret = True
         else:
-            found = False
-            for v in self.values:
-                if v.key == key:
-                    if found == False:
-                        v.original = None
-                        v.value = value
-                        v.comment = comment
-                        v.disabled = disabled
-                        found = True
-                    else:
-                        del(v)
-            if found == False:
-                self.values.append(IniSection.IniLine(self.inifile, -1, None, key, value, comment, disabled))
+            if lines:
+                v = lines[0]
+                v.original = None
+                v.value = value
+                v.comment = comment
+                v.disabled = disabled
+            else:
+                self._appendLine(IniSection.IniLine(self.inifile, -1, None, key, value, comment, disabled))
             ret = True
         return ret
 
     def _getLast(self, key):
-        ret = None
-        for v in self.values:
-            if v.key == key:
-                ret = v
-                break
-        return ret
+        lines = self._index.get(key)
+        return lines[0] if lines else None
 
     def append(self, key, value, comment='', disabled=False):
-        self.values.append(IniSection.IniLine(self.inifile, -1, None, key, value, comment, disabled))
+        self._appendLine(IniSection.IniLine(self.inifile, -1, None, key, value, comment, disabled))
 
     def appendRaw(self, lineno, line, key, value, comment, disabled):
-        self.values.append(IniSection.IniLine(self.inifile, lineno, line, key, value, comment, disabled))
+        self._appendLine(IniSection.IniLine(self.inifile, lineno, line, key, value, comment, disabled))
 
     def remove(self, key):
-        found = False
-        for v in self.values:
-            if v.key == key:
-                found = True
-                self.values.remove(v)
-                break
-        return found
+        lines = self._index.get(key)
+        if lines:
+            self._removeLine(lines[0])
+            return True
+        return False
 
     def merge(self, another_section):
         ret = True
@@ -263,6 +277,7 @@ class IniSection(object):
         self.lineno = -1
         self.original = None
         self.values = []
+        self._index = {}
         self.comment = ''
 
     @property
@@ -312,6 +327,15 @@ class IniSection(object):
     def __repr__(self):
         return self.asString(only_data=False)
 
+def _stat_key(st):
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+# parsed files shared by all IniFile instances: path -> (stat key, parser options,
+# sections, comment prefix, key/value separator, file content)
+_parse_cache = {}
+_parse_cache_lock = threading.Lock()
+PARSE_CACHE_SIZE = 64
+
 class IniFile(object):
     def __init__(self, filename=None, commentPrefix=None, keyValueSeperator=None, disabled_values=True, keyIsWord=True, autoQuoteStrings=False, qt=False):
         self.m_commentPrefix = commentPrefix
@@ -319,8 +343,11 @@ class IniFile(object):
         self.m_autoQuoteStrings = True if autoQuoteStrings or qt else False
         self.m_autoEscapeStrings = True if qt else False
         self.m_sections = []
+        self.m_sectionIndex = {}
         self.m_filename = filename
         self.m_last_error = None
+        # (path, stat key, content) of the last file read or written
+        self.m_fileState = None
         #
         # Regular expressions for parsing section headers and options.
         #
@@ -375,13 +402,44 @@ class IniFile(object):
         if filename is not None:
             self._open(filename)
 
+    def _parserOptions(self):
+        return (self.SECTCRE.pattern, self.OPTCRE.pattern, self.COMMENTRE.pattern,
+                self.m_commentPrefix, self.m_keyValueSeperator, self.m_autoQuoteStrings, self.m_autoEscapeStrings)
+
     def _open(self, filename):
         try:
-            f = open(filename, 'r')
-            self._read(f)
-            f.close()
+            path = os.path.realpath(filename)
+            with open(path, 'r') as f:
+                file_stat_key = _stat_key(os.fstat(f.fileno()))
+                options = self._parserOptions()
+                entry = None
+                if not self.m_sections:
+                    with _parse_cache_lock:
+                        entry = _parse_cache.get(path)
+                    if entry is not None and (entry[0] != file_stat_key or entry[1] != options):
+                        entry = None
+                if entry is not None:
+                    (file_stat_key, options, sections, commentPrefix, keyValueSeperator, content) = entry
+                    for section in sections:
+                        self._addSection(section.clone(self))
+                    self.m_commentPrefix = commentPrefix
+                    self.m_keyValueSeperator = keyValueSeperator
+                else:
+                    content = f.read()
+                    cacheable = not self.m_sections
+                    self._read(io.StringIO(content))
+                    if cacheable:
+                        entry = (file_stat_key, options, [ section.clone() for section in self.m_sections ],
+                                 self.m_commentPrefix, self.m_keyValueSeperator, content)
+                        with _parse_cache_lock:
+                            _parse_cache.pop(path, None)
+                            while len(_parse_cache) >= PARSE_CACHE_SIZE:
+                                # drop the oldest entry
+                                del _parse_cache[next(iter(_parse_cache))]
+                            _parse_cache[path] = entry
+            self.m_fileState = (path, file_stat_key, content)
             ret = True
-        except IOError as e:
+        except (IOError, OSError) as e:
             self.m_last_error = e
             ret = False
         return ret
@@ -396,10 +454,13 @@ class IniFile(object):
             ret = self._open(filename)
             if not ret:
                 self.m_sections = []
+                self.m_sectionIndex = {}
         return ret
 
     def close(self):
         self.m_sections = []
+        self.m_sectionIndex = {}
+        self.m_fileState = None
         self.m_commentPrefix = None
         self.m_keyValueSeperator = None
         self.m_last_error = None
@@ -411,10 +472,11 @@ class IniFile(object):
         ret.OPTCRE = self.OPTCRE
         ret.COMMENTRE = self.COMMENTRE
         ret.m_sections = []
+        ret.m_sectionIndex = {}
         for section in iter(self.m_sections):
             newsection = section.clone()
             newsection.inifile = ret
-            ret.m_sections.append(newsection)
+            ret._addSection(newsection)
         return ret
 
     @property
@@ -433,10 +495,23 @@ class IniFile(object):
         return self.m_keyValueSeperator
 
     def _getSection(self, name):
-        for section in self.m_sections:
-            if section.name == name:
-                return section
-        return None
+        return self.m_sectionIndex.get(name)
+
+    def _addSection(self, section):
+        self.m_sections.append(section)
+        # lookups always return the first section with a given name
+        if section.name not in self.m_sectionIndex:
+            self.m_sectionIndex[section.name] = section
+        return section
+
+    def _removeSection(self, section):
+        self.m_sections.remove(section)
+        if self.m_sectionIndex.get(section.name) is section:
+            del self.m_sectionIndex[section.name]
+            for other in self.m_sections:
+                if other.name == section.name:
+                    self.m_sectionIndex[section.name] = other
+                    break
 
     def _read(self, file):
         """Parse a sectioned setup file.
@@ -462,8 +537,7 @@ class IniFile(object):
             # comment or blank line?
             if line.strip() == '': # or line[0] in '#;':
                 if cursect is None:
-                    cursect = IniSection(self, None, lineno)
-                    self.m_sections.append(cursect)
+                    cursect = self._addSection(IniSection(self, None, lineno))
                 cursect.appendRaw(lineno, line.rstrip('\n'), None, None, None, False)
                 lineno = lineno + 1
                 optname = None
@@ -483,14 +557,12 @@ class IniFile(object):
                     sectname = mo.group('header')
                     cursect = self._getSection(sectname)
                     if cursect is None:
-                        cursect = IniSection(self, sectname, lineno, line)
-                        self.m_sections.append(cursect)
+                        cursect = self._addSection(IniSection(self, sectname, lineno, line))
                     # So sections can't start with a continuation line
                     optname = None
                 else:
                     if cursect is None:
-                        cursect = IniSection(self, None, lineno)
-                        self.m_sections.append(cursect)
+                        cursect = self._addSection(IniSection(self, None, lineno))
                     mo = self.OPTCRE.match(line)
                     if mo:
                         try:
@@ -652,8 +724,7 @@ class IniFile(object):
     def set(self, section, key, value, comment=None):
         section_obj = self._getSection(section)
         if section_obj is None:
-            self.m_sections.append( IniSection(self, section) )
-            section_obj = self._getSection(section)
+            section_obj = self._addSection( IniSection(self, section) )
         return section_obj.set(key, value, comment)
 
     def setAsBoolean(self, section, key, value, comment=None):
@@ -704,20 +775,18 @@ class IniFile(object):
     def append(self, section, key, value, comment=None):
         section_obj = self._getSection(section)
         if section_obj is None:
-            self.m_sections.append( IniSection(self, section) )
-            section_obj = self._getSection(section)
+            section_obj = self._addSection( IniSection(self, section) )
         return section_obj.append(key, value, comment)
 
     def remove(self, section, key):
         ret = False
-        for section_obj in self.m_sections:
-            if section_obj.name == section:
-                if key == '*':
-                    self.m_sections.remove(section_obj)
-                    ret = True
-                else:
-                    ret = section_obj.remove(key)
-                break
+        section_obj = self._getSection(section)
+        if section_obj is not None:
+            if key == '*':
+                self._removeSection(section_obj)
+                ret = True
+            else:
+                ret = section_obj.remove(key)
         return ret
 
     def has_section(self, section):
@@ -769,27 +838,60 @@ class IniFile(object):
     def save(self, filename=None):
         if filename is None:
             filename = self.m_filename
-        
+
         if hasattr(filename, 'write'):
-            f = filename
-        else:
-            try:
-                f = open(filename, 'w')
-            except IOError as e:
-                self.m_last_error = e
-                f = None
-        if f:
             try:
                 for section in self.m_sections:
-                    f.write(str(section))
+                    filename.write(str(section))
                 ret = True
             except IOError as e:
                 self.m_last_error = e
                 ret = False
-            if not hasattr(filename, 'write'):
-                f.close()
         else:
+            ret = self._save(filename, self.asString())
+        return ret
+
+    def _save(self, filename, content):
+        path = os.path.realpath(filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is not None and self.m_fileState is not None:
+            (state_path, state_stat_key, state_content) = self.m_fileState
+            # nothing changed since the file has been read or written
+            if state_path == path and state_stat_key == _stat_key(st) and state_content == content:
+                return True
+        tmpname = None
+        try:
+            if st is not None:
+                # replace an existing file atomically and keep its permissions
+                (fd, tmpname) = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=os.path.dirname(path))
+                with os.fdopen(fd, 'w') as f:
+                    os.fchmod(f.fileno(), stat.S_IMODE(st.st_mode))
+                    if st.st_uid != os.geteuid() or st.st_gid != os.getegid():
+                        try:
+                            os.fchown(f.fileno(), st.st_uid, st.st_gid)
+                        except OSError:
+                            pass
+                    f.write(content)
+                os.rename(tmpname, path)
+                tmpname = None
+            else:
+                with open(path, 'w') as f:
+                    f.write(content)
+            self.m_fileState = (path, _stat_key(os.stat(path)), content)
+            ret = True
+        except (IOError, OSError) as e:
+            self.m_last_error = e
             ret = False
+        if tmpname is not None:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+        with _parse_cache_lock:
+            _parse_cache.pop(path, None)
         return ret
 
     def merge(self, another_inifile):
@@ -800,8 +902,7 @@ class IniFile(object):
             my_section_obj = self._getSection(section_obj.name)
             if my_section_obj is None:
                 #print('create new section ' + section_obj.name)
-                self.m_sections.append( IniSection(self, section_obj.name) )
-                my_section_obj = self._getSection(section_obj.name)
+                my_section_obj = self._addSection( IniSection(self, section_obj.name) )
             ret = my_section_obj.merge(section_obj)
             if not ret:
                 break
@@ -816,8 +917,7 @@ class IniFile(object):
                 my_section_obj.clear()
             else:
                 # add a new section because it's missing
-                self.m_sections.append( IniSection(self, section_obj.name) )
-                my_section_obj = self._getSection(section_obj.name)
+                my_section_obj = self._addSection( IniSection(self, section_obj.name) )
             ret = my_section_obj.merge(section_obj)
             if not ret:
                 break
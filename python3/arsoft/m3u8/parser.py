@@ -14,6 +14,9 @@ http://tools.ietf.org/html/draft-pantos-http-live-streaming-08#section-3.2
 http://stackoverflow.com/questions/2785755/how-to-split-but-ignore-separators-in-quoted-strings-in-python
 '''
 ATTRIBUTELISTPATTERN = re.compile(r'''((?:[^,"']|"[^"]*"|'[^']*')+)''')
+CUEOUT_PATTERN = re.compile('.*Duration=(.*),SCTE35=(.*)$')
+CUEOUT_ELEMENTAL_PATTERN = re.compile('.*EXT-OATCLS-SCTE35:(.*)$')
+CUEOUT_ENVIVIO_PATTERN = re.compile('.*DURATION=(.*),.*,CUE="(.*)"')
 
 
 def cast_date_time(value):
@@ -61,105 +64,163 @@ def parse(content, strict=False):
     }
 
     lineno = 0
-    for line in string_to_lines(content):
+    prevline = ''
+    for raw_line in string_to_lines(content):
         lineno += 1
-        line = line.strip()
+        line = raw_line.strip()
+
+        if line.startswith('#'):
+            tag = line.split(':', 1)[0]
+            handler = _tag_handlers.get(tag)
+            if handler is None:
+                handler = _find_tag_handler(line)
+            # lines starting with # without a known tag are comments
+            if handler is not None:
+                handler(line, data, state, lineno, strict, prevline)
+
+        elif line == '':
+            # blank lines are legal
+            pass
 
-        if line.startswith(protocol.ext_x_byterange):
-            _parse_byterange(line, state)
-            state['expect_segment'] = True
+        elif state['expect_segment']:
+            _parse_ts_chunk(line, data, state)
+            state['expect_segment'] = False
 
-        elif line.startswith(protocol.ext_x_targetduration):
-            _parse_simple_parameter(line, data, float)
+        elif state['expect_playlist']:
+            _parse_variant_playlist(line, data, state)
+            state['expect_playlist'] = False
 
-        elif line.startswith(protocol.ext_x_media_sequence):
-            _parse_simple_parameter(line, data, int)
+        elif strict:
+            raise ParseError(lineno, line)
 
-        elif line.startswith(protocol.ext_x_program_date_time):
-            _, program_date_time = _parse_simple_parameter_raw_value(line, cast_date_time)
-            if not data.get('program_date_time'):
-                data['program_date_time'] = program_date_time
-            state['current_program_date_time'] = program_date_time
+        prevline = raw_line
 
-        elif line.startswith(protocol.ext_x_discontinuity):
-            state['discontinuity'] = True
+    return data
 
-        elif line.startswith(protocol.ext_x_cue_out):
-            _parse_cueout(line, state)
-            state['cue_out'] = True
-            state['cue_start'] = True
 
-        elif line.startswith(protocol.ext_x_cue_out_start):
-            _parse_cueout_start(line, state, string_to_lines(content)[lineno - 2])
-            state['cue_out'] = True
-            state['cue_start'] = True
+def _handle_byterange(line, data, state, lineno, strict, prevline):
+    _parse_byterange(line, state)
+    state['expect_segment'] = True
 
-        elif line.startswith(protocol.ext_x_cue_span):
-            state['cue_out'] = True
-            state['cue_start'] = True
 
-        elif line.startswith(protocol.ext_x_version):
-            _parse_simple_parameter(line, data)
+def _handle_targetduration(line, data, state, lineno, strict, prevline):
+    _parse_simple_parameter(line, data, float)
 
-        elif line.startswith(protocol.ext_x_allow_cache):
-            _parse_simple_parameter(line, data)
 
-        elif line.startswith(protocol.ext_x_key):
-            key = _parse_key(line)
-            state['current_key'] = key
-            if key not in data['keys']:
-                data['keys'].append(key)
+def _handle_media_sequence(line, data, state, lineno, strict, prevline):
+    _parse_simple_parameter(line, data, int)
 
-        elif line.startswith(protocol.extinf):
-            _parse_extinf(line, data, state, lineno, strict)
-            state['expect_segment'] = True
 
-        elif line.startswith(protocol.ext_x_stream_inf):
-            state['expect_playlist'] = True
-            _parse_stream_inf(line, data, state)
+def _handle_program_date_time(line, data, state, lineno, strict, prevline):
+    _, program_date_time = _parse_simple_parameter_raw_value(line, cast_date_time)
+    if not data.get('program_date_time'):
+        data['program_date_time'] = program_date_time
+    state['current_program_date_time'] = program_date_time
 
-        elif line.startswith(protocol.ext_x_i_frame_stream_inf):
-            _parse_i_frame_stream_inf(line, data)
 
-        elif line.startswith(protocol.ext_x_media):
-            _parse_media(line, data, state)
+def _handle_discontinuity(line, data, state, lineno, strict, prevline):
+    state['discontinuity'] = True
 
-        elif line.startswith(protocol.ext_x_playlist_type):
-            _parse_simple_parameter(line, data)
 
-        elif line.startswith(protocol.ext_i_frames_only):
-            data['is_i_frames_only'] = True
+def _handle_cue_out(line, data, state, lineno, strict, prevline):
+    _parse_cueout(line, state)
+    state['cue_out'] = True
+    state['cue_start'] = True
 
-        elif line.startswith(protocol.ext_is_independent_segments):
-            data['is_independent_segments'] = True
 
-        elif line.startswith(protocol.ext_x_endlist):
-            data['is_endlist'] = True
+def _handle_cue_out_start(line, data, state, lineno, strict, prevline):
+    _parse_cueout_start(line, state, prevline)
+    state['cue_out'] = True
+    state['cue_start'] = True
 
-        elif line.startswith(protocol.ext_x_map):
-            data['segment_map_uri'] = _parse_segment_map_uri(line)
 
-        # Comments and whitespace
-        elif line.startswith('#'):
-            # comment
-            pass
+def _handle_cue_span(line, data, state, lineno, strict, prevline):
+    state['cue_out'] = True
+    state['cue_start'] = True
 
-        elif line.strip() == '':
-            # blank lines are legal
-            pass
 
-        elif state['expect_segment']:
-            _parse_ts_chunk(line, data, state)
-            state['expect_segment'] = False
+def _handle_simple_parameter(line, data, state, lineno, strict, prevline):
+    _parse_simple_parameter(line, data)
 
-        elif state['expect_playlist']:
-            _parse_variant_playlist(line, data, state)
-            state['expect_playlist'] = False
 
-        elif strict:
-            raise ParseError(lineno, line)
+def _handle_key(line, data, state, lineno, strict, prevline):
+    key = _parse_key(line)
+    state['current_key'] = key
+    if key not in data['keys']:
+        data['keys'].append(key)
 
-    return data
+
+def _handle_extinf(line, data, state, lineno, strict, prevline):
+    _parse_extinf(line, data, state, lineno, strict)
+    state['expect_segment'] = True
+
+
+def _handle_stream_inf(line, data, state, lineno, strict, prevline):
+    state['expect_playlist'] = True
+    _parse_stream_inf(line, data, state)
+
+
+def _handle_i_frame_stream_inf(line, data, state, lineno, strict, prevline):
+    _parse_i_frame_stream_inf(line, data)
+
+
+def _handle_media(line, data, state, lineno, strict, prevline):
+    _parse_media(line, data, state)
+
+
+def _handle_i_frames_only(line, data, state, lineno, strict, prevline):
+    data['is_i_frames_only'] = True
+
+
+def _handle_independent_segments(line, data, state, lineno, strict, prevline):
+    data['is_independent_segments'] = True
+
+
+def _handle_endlist(line, data, state, lineno, strict, prevline):
+    data['is_endlist'] = True
+
+
+def _handle_map(line, data, state, lineno, strict, prevline):
+    data['segment_map_uri'] = _parse_segment_map_uri(line)
+
+
+# Tags in the order they are matched against the start of a line. Some tags
+# are prefixes of others (#EXT-X-CUE-OUT of #EXT-X-CUE-OUT-CONT, #EXT-X-MEDIA
+# of #EXT-X-MEDIA-SEQUENCE), so the longer one has to come first.
+_tag_prefixes = [
+    (protocol.ext_x_byterange, _handle_byterange),
+    (protocol.ext_x_targetduration, _handle_targetduration),
+    (protocol.ext_x_media_sequence, _handle_media_sequence),
+    (protocol.ext_x_program_date_time, _handle_program_date_time),
+    (protocol.ext_x_discontinuity, _handle_discontinuity),
+    (protocol.ext_x_cue_out, _handle_cue_out),
+    (protocol.ext_x_cue_out_start, _handle_cue_out_start),
+    (protocol.ext_x_cue_span, _handle_cue_span),
+    (protocol.ext_x_version, _handle_simple_parameter),
+    (protocol.ext_x_allow_cache, _handle_simple_parameter),
+    (protocol.ext_x_key, _handle_key),
+    (protocol.extinf, _handle_extinf),
+    (protocol.ext_x_stream_inf, _handle_stream_inf),
+    (protocol.ext_x_i_frame_stream_inf, _handle_i_frame_stream_inf),
+    (protocol.ext_x_media, _handle_media),
+    (protocol.ext_x_playlist_type, _handle_simple_parameter),
+    (protocol.ext_i_frames_only, _handle_i_frames_only),
+    (protocol.ext_is_independent_segments, _handle_independent_segments),
+    (protocol.ext_x_endlist, _handle_endlist),
+    (protocol.ext_x_map, _handle_map),
+]
+
+
+def _find_tag_handler(line):
+    for (prefix, handler) in _tag_prefixes:
+        if line.startswith(prefix):
+            return handler
+    return None
+
+
+# Known tags can be looked up directly by the part of the line before the
+# colon; only unknown tags and comments go through the list of prefixes.
+_tag_handlers = dict([ (prefix, _find_tag_handler(prefix)) for (prefix, handler) in _tag_prefixes ])
 
 
 def _parse_key(line):
@@ -225,18 +286,11 @@ def _parse_attribute_list(prefix, line, atribute_parser):
 def _parse_stream_inf(line, data, state):
     data['is_variant'] = True
     data['media_sequence'] = None
-    atribute_parser = remove_quotes_parser('codecs', 'audio', 'video', 'subtitles')
-    atribute_parser["program_id"] = int
-    atribute_parser["bandwidth"] = lambda x: int(float(x))
-    atribute_parser["average_bandwidth"] = int
-    state['stream_info'] = _parse_attribute_list(protocol.ext_x_stream_inf, line, atribute_parser)
+    state['stream_info'] = _parse_attribute_list(protocol.ext_x_stream_inf, line, _stream_inf_attribute_parser)
 
 
 def _parse_i_frame_stream_inf(line, data):
-    atribute_parser = remove_quotes_parser('codecs', 'uri')
-    atribute_parser["program_id"] = int
-    atribute_parser["bandwidth"] = int
-    iframe_stream_info = _parse_attribute_list(protocol.ext_x_i_frame_stream_inf, line, atribute_parser)
+    iframe_stream_info = _parse_attribute_list(protocol.ext_x_i_frame_stream_inf, line, _i_frame_stream_inf_attribute_parser)
     iframe_playlist = {'uri': iframe_stream_info.pop('uri'),
                        'iframe_stream_info': iframe_stream_info}
 
@@ -244,8 +298,7 @@ def _parse_i_frame_stream_inf(line, data):
 
 
 def _parse_media(line, data, state):
-    quoted = remove_quotes_parser('uri', 'group_id', 'language', 'name', 'characteristics')
-    media = _parse_attribute_list(protocol.ext_x_media, line, quoted)
+    media = _parse_attribute_list(protocol.ext_x_media, line, _media_attribute_parser)
     data['media'].append(media)
 
 
@@ -282,14 +335,14 @@ def _parse_simple_parameter(line, data, cast_to=str):
 
 def _parse_cueout(line, state):
     param, value = line.split(':', 1)
-    res = re.match('.*Duration=(.*),SCTE35=(.*)$', value)
+    res = CUEOUT_PATTERN.match(value)
     if res:
         state['current_cue_out_duration'] = res.group(1)
         state['current_cue_out_scte35'] = res.group(2)
 
 def _cueout_elemental(line, state, prevline):
     param, value = line.split(':', 1)
-    res = re.match('.*EXT-OATCLS-SCTE35:(.*)$', prevline)
+    res = CUEOUT_ELEMENTAL_PATTERN.match(prevline)
     if res:
         return (res.group(1), value)
     else:
@@ -297,7 +350,7 @@ def _cueout_elemental(line, state, prevline):
 
 def _cueout_envivio(line, state, prevline):
     param, value = line.split(':', 1)
-    res = re.match('.*DURATION=(.*),.*,CUE="(.*)"', value)
+    res = CUEOUT_ENVIVIO_PATTERN.match(value)
     if res:
         return (res.group(2), res.group(1))
     else:
@@ -348,3 +401,55 @@ def normalize_attribute(attribute):
 
 def is_url(uri):
     return re.match(r'https?://', uri) is not None
+
+
+_stream_inf_attribute_parser = remove_quotes_parser('codecs', 'audio', 'video', 'subtitles')
+_stream_inf_attribute_parser["program_id"] = int
+_stream_inf_attribute_parser["bandwidth"] = lambda x: int(float(x))
+_stream_inf_attribute_parser["average_bandwidth"] = int
+
+_i_frame_stream_inf_attribute_parser = remove_quotes_parser('codecs', 'uri')
+_i_frame_stream_inf_attribute_parser["program_id"] = int
+_i_frame_stream_inf_attribute_parser["bandwidth"] = int
+
+_media_attribute_parser = remove_quotes_parser('uri', 'group_id', 'language', 'name', 'characteristics')
+
+
+if __name__ == '__main__':
+    # benchmark: synthetic live and VOD playlists with ad markers
+    import sys
+    import time
+
+    def _synthetic_playlist(num_segments, live, cue_every=50):
+        lines = [ '#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:6' ]
+        if live:
+            lines.append('#EXT-X-MEDIA-SEQUENCE:%i' % 123456)
+            lines.append('#EXT-X-PROGRAM-DATE-TIME:2014-08-13T13:36:33+00:00')
+        else:
+            lines.append('#EXT-X-PLAYLIST-TYPE:VOD')
+        lines.append('#EXT-X-KEY:METHOD=AES-128,URI="https://example.com/key",IV=0x10ef8f758ca555115584bb5b3c687f52')
+        for i in range(num_segments):
+            if i % cue_every == 0:
+                lines.append('#EXT-OATCLS-SCTE35:/DAlAAAAAAAAAP/wFAUAAAABf+/+ANgNkv4AFJlwAAEBAQAA5Pd7Pg==')
+                lines.append('#EXT-X-CUE-OUT:30.000')
+            elif i % cue_every == 1:
+                lines.append('#EXT-X-CUE-OUT-CONT:ElapsedTime=6,Duration=30,SCTE35=/DAlAAAAAAAAAP/wFAUAAAABf+/+ANgNkv4AFJlwAAEBAQAA5Pd7Pg==')
+            elif i % cue_every == 5:
+                lines.append('#EXT-X-CUE-IN')
+                lines.append('#EXT-X-DISCONTINUITY')
+            lines.append('#EXTINF:6.000,')
+            lines.append('segment%i.ts' % i)
+        if not live:
+            lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    sizes = [ int(arg) for arg in sys.argv[1:] ] or [ 10000, 50000, 100000 ]
+    for live in [ False, True ]:
+        for num_segments in sizes:
+            content = _synthetic_playlist(num_segments, live)
+            start = time.time()
+            result = parse(content)
+            duration = time.time() - start
+            assert len(result['segments']) == num_segments
+            print('%s playlist, %i segments (%i bytes): %.3fs (%.1f us/segment)' % (
+                'live' if live else 'VOD', num_segments, len(content), duration, duration * 1e6 / num_segments))
@@ -5,15 +5,64 @@
 import socket
 import select
 import sys
+import time
+import collections
+
+class ManagementEvent(object):
+    """
+    A real-time notification of the management interface, e.g. BYTECOUNT,
+    BYTECOUNT_CLI, STATE, LOG or CLIENT. For CLIENT notifications env holds
+    the environment sent along with it.
+    """
+    def __init__(self, type, data, env=None):
+        self.type = type
+        self.data = data
+        self.env = env
+
+    @property
+    def args(self):
+        return self.data.split(',')
+
+    def __str__(self):
+        if self.env:
+            return '>%s:%s %s' % (self.type, self.data, self.env)
+        else:
+            return '>%s:%s' % (self.type, self.data)
 
 class ManagementInterface(object):
     MGMT_HEADER = 'OpenVPN Management Interface Version'
+    RECV_SIZE = 64 * 1024
+    # upper limit for a single line and for the events queued for events()
+    MAX_LINE_LENGTH = 1024 * 1024
+    MAX_PENDING_EVENTS = 4096
+
     def __init__(self, socket_addr=None, timeout=5):
         self._socket_addr = socket_addr
         self._socket = None
         self._timeout = timeout
         self._header = None
-        
+        self._buffer = bytearray()
+        self._responses = collections.deque()
+        self._events = None
+        self._subscribers = {}
+        self._client_event = None
+
+    @staticmethod
+    def _parse_tcp_address(socket_addr):
+        if socket_addr.startswith('tcp:'):
+            socket_addr = socket_addr[4:]
+        if socket_addr.startswith('['):
+            # [ipv6-address]:port
+            idx = socket_addr.find(']')
+            hostname = socket_addr[1:idx]
+            port = socket_addr[idx+2:] if socket_addr[idx+1:idx+2] == ':' else None
+        elif socket_addr.count(':') == 1:
+            (hostname, port) = socket_addr.split(':')
+        else:
+            hostname = socket_addr
+            port = None
+        return (hostname, int(port) if port else 23)
+
     def open(self, socket_addr=None):
         if socket_addr is None:
             socket_addr = self._socket_addr
@@ -26,16 +75,17 @@ class ManagementInterface(object):
             except socket.error:
                 sock = None
         else:
-            if ':' in socket_addr:
-                (hostname, port) = socket_addr.split(socket_addr)
-            else:
-                hostname = socket_addr
-                port = 23
-            sock = socket.create_connection((hostname, port), self._timeout)
+            try:
+                sock = socket.create_connection(self._parse_tcp_address(socket_addr), self._timeout)
+            except (socket.error, ValueError):
+                sock = None
 
         if sock:
             self._socket = sock
             self._socket.setblocking(0)
+            self._buffer = bytearray()
+            self._responses.clear()
+            self._header = None
             self._socket.sendall(b'\n')
             self._header = self._read_header(self._timeout)
             if self._header is not None:
@@ -50,11 +100,18 @@ class ManagementInterface(object):
         if self._socket:
             self._socket.close()
             self._socket = None
+        self._buffer = bytearray()
+        self._responses.clear()
+        self._client_event = None
+
+    def fileno(self):
+        return self._socket.fileno() if self._socket else -1
 
     def _purge(self, timeout):
         # purge any available data
-        self._read_all(timeout)
-        
+        self._receive(self._deadline(timeout))
+        self._responses.clear()
+
     @property
     def version(self):
         if self._header is None:
@@ -69,71 +126,259 @@ class ManagementInterface(object):
                 ret = -1
             return ret
 
-    def _read_header(self, timeout):
-        data = b''
-        s_reply = ([self._socket], [], [])
-        s_args = s_reply
-        if timeout is not None:
-            s_args = s_args + (timeout,)
-            from time import time
-            time_start = time()
-
-        ret = None
-        while select.select(*s_args) == s_reply:
-            buf = self._socket.recv(256)
-            if data is None:
+    @staticmethod
+    def _deadline(timeout):
+        return time.time() + timeout if timeout is not None else None
+
+    def _receive(self, deadline):
+        """
+        Waits until data is available or the deadline has passed, reads all
+        available data and splits it into lines. Notifications are
+        dispatched immediately, all other lines are queued as responses.
+        Returns False if the connection is closed or the deadline passed.
+        """
+        if self._socket is None:
+            return False
+        if deadline is None:
+            readable = select.select([self._socket], [], [])[0]
+        else:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            readable = select.select([self._socket], [], [], remaining)[0]
+        if not readable:
+            return False
+        try:
+            data = self._socket.recv(self.RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except socket.error:
+            data = None
+        if not data:
+            self.close()
+            return False
+        self._feed(data)
+        return True
+
+    def _feed(self, data):
+        self._buffer += data
+        start = 0
+        while True:
+            idx = self._buffer.find(b'\n', start)
+            if idx < 0:
                 break
+            line = self._buffer[start:idx].decode('utf8', 'replace').rstrip('\r')
+            start = idx + 1
+            if line.startswith('>'):
+                self._handle_notification(line)
             else:
-                data = data + buf
+                self._responses.append(line)
+        if start:
+            del self._buffer[:start]
+        if len(self._buffer) > self.MAX_LINE_LENGTH:
+            # no sane management interface sends such lines, so give up
+            self.close()
 
-            if data.endswith(b"\r\n"):
-                ret = data.split(b'\r\n')[0]
+    def _read_header(self, timeout):
+        deadline = self._deadline(timeout)
+        while self._header is None:
+            if not self._receive(deadline):
                 break
-            if timeout is not None:
-                elapsed = time() - time_start
-                if elapsed >= timeout:
-                    break
-                s_args = s_reply + (timeout-elapsed,)
-        return ret
+        return self._header
+
+    def _readline(self, deadline):
+        while not self._responses:
+            if not self._receive(deadline):
+                return None
+        return self._responses.popleft()
 
     def _read_response(self, timeout, has_end_marker=False):
-        data = b''
-        s_reply = ([self._socket], [], [])
-        s_args = s_reply
-        if timeout is not None:
-            s_args = s_args + (timeout,)
-            from time import time
-            time_start = time()
-
-        ret = None
-        while select.select(*s_args) == s_reply:
-            buf = self._socket.recv(256)
-            if data is None:
-                break
-            else:
-                data = data + buf
+        return self._read_response_until(self._deadline(timeout), has_end_marker=has_end_marker)
 
-            if has_end_marker:
-                if data.endswith(b"END\r\n"):
-                    ret = data.decode('utf8').split('\r\n')
-                    if len(ret) > 0 and not ret[-1]:
-                        del ret[-1]
-                    break
-            elif data.endswith(b"\r\n"):
-                ret = data.decode('utf8').split('\r\n')
-                if len(ret) > 0 and not ret[-1]:
-                    del ret[-1]
-                break
-            if timeout is not None:
-                elapsed = time() - time_start
-                if elapsed >= timeout:
-                    break
-                s_args = s_reply + (timeout-elapsed,)
+    def _read_response_until(self, deadline, has_end_marker=False):
+        line = self._readline(deadline)
+        if line is None:
+            return None
+        ret = [ line ]
+        if has_end_marker and not line.startswith('SUCCESS:') and not line.startswith('ERROR:'):
+            while line != 'END':
+                line = self._readline(deadline)
+                if line is None:
+                    # incomplete response, so drop everything to get back in sync
+                    self._responses.clear()
+                    return None
+                ret.append(line)
+        return ret
+
+    def send_commands(self, commands):
+        """
+        Sends all commands at once and returns their responses in the same
+        order, each as a list of lines (multi-line responses end with the END
+        line) or None on timeout. commands is a list of command strings or
+        (command, has_end_marker) tuples.
+        """
+        commands = [ (c, True) if isinstance(c, str) else c for c in commands ]
+        if self._socket is None:
+            return [ None ] * len(commands)
+        self._socket.setblocking(1)
+        try:
+            self._socket.sendall(b''.join([ c.encode('utf8') + b'\n' for (c, has_end_marker) in commands ]))
+        finally:
+            self._socket.setblocking(0)
+        deadline = self._deadline(self._timeout)
+        ret = []
+        for (c, has_end_marker) in commands:
+            ret.append(self._read_response_until(deadline, has_end_marker=has_end_marker))
         return ret
 
     def _send_command(self, command, has_end_marker=True):
-        self._socket.sendall(command.encode('utf8') + b'\n')
-        return self._read_response(self._timeout, has_end_marker=has_end_marker)
+        return self.send_commands([ (command, has_end_marker) ])[0]
+
+    def _handle_notification(self, line):
+        (type, sep, data) = line[1:].partition(':')
+        if type == 'INFO' and self._header is None and ManagementInterface.MGMT_HEADER in data:
+            self._header = line
+            return
+        if type == 'CLIENT':
+            if data.startswith('ENV,'):
+                if self._client_event is not None:
+                    env = data[4:]
+                    if env == 'END':
+                        event = self._client_event
+                        self._client_event = None
+                        self._dispatch(event)
+                    else:
+                        (key, sep, value) = env.partition('=')
+                        self._client_event.env[key] = value
+                return
+            event = ManagementEvent(type, data, env={})
+            if not data.startswith('ADDRESS,'):
+                # all other client notifications are followed by their environment
+                self._client_event = event
+                return
+        else:
+            event = ManagementEvent(type, data)
+        self._dispatch(event)
+
+    def _dispatch(self, event):
+        for callback in self._subscribers.get(event.type, []) + self._subscribers.get(None, []):
+            callback(event)
+        if self._events is not None:
+            self._events.append(event)
+
+    def subscribe(self, callback, event_type=None):
+        """
+        Calls callback(event) for every notification of the given type (e.g.
+        'BYTECOUNT_CLI', 'CLIENT' or 'STATE'), or all if event_type is None.
+        Callbacks are run while reading from the interface, i.e. from
+        process_events(), events() or any command.
+        """
+        self._subscribers.setdefault(event_type, []).append(callback)
+
+    def unsubscribe(self, callback, event_type=None):
+        callbacks = self._subscribers.get(event_type)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+
+    def process_events(self, timeout=None):
+        """
+        Reads from the interface and dispatches notifications to the
+        subscribers until the timeout expires or the connection is closed.
+        """
+        deadline = self._deadline(timeout)
+        while self._receive(deadline):
+            pass
+        return self._socket is not None
+
+    def events(self, timeout=None):
+        """
+        Yields the notifications until the timeout expires or the
+        connection is closed. At most MAX_PENDING_EVENTS are buffered, the
+        oldest ones are dropped if the consumer falls behind.
+        """
+        if self._events is None:
+            self._events = collections.deque(maxlen=self.MAX_PENDING_EVENTS)
+        deadline = self._deadline(timeout)
+        try:
+            while True:
+                while self._events:
+                    yield self._events.popleft()
+                if not self._receive(deadline):
+                    break
+            while self._events:
+                yield self._events.popleft()
+        finally:
+            self._events = None
+
+    async def async_events(self, max_pending=MAX_PENDING_EVENTS):
+        """
+        Asynchronous iterator over the notifications, until the connection
+        is closed. When max_pending events are waiting the socket is not
+        read any further, so a slow consumer slows down the sender instead
+        of using up memory.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        # one read may produce several events, so the queue itself is not
+        # bounded; reading stops instead once max_pending events are waiting
+        queue = asyncio.Queue()
+        fd = self._socket.fileno()
+        state = { 'reading': False }
+
+        def queue_event(event):
+            queue.put_nowait(event)
+
+        def on_readable():
+            try:
+                data = self._socket.recv(self.RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error:
+                data = None
+            if not data:
+                stop_reading()
+                self.close()
+                queue.put_nowait(None)
+                return
+            self._feed(data)
+            if queue.qsize() >= max_pending or self._socket is None:
+                stop_reading()
+            if self._socket is None:
+                queue.put_nowait(None)
+
+        def start_reading():
+            if not state['reading'] and self._socket is not None:
+                loop.add_reader(fd, on_readable)
+                state['reading'] = True
+
+        def stop_reading():
+            if state['reading']:
+                loop.remove_reader(fd)
+                state['reading'] = False
+
+        self.subscribe(queue_event)
+        try:
+            start_reading()
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                if queue.qsize() < max_pending // 2:
+                    start_reading()
+                yield event
+        finally:
+            stop_reading()
+            self.unsubscribe(queue_event)
+
+    def set_bytecount(self, interval):
+        """Enables (interval > 0) or disables the BYTECOUNT/BYTECOUNT_CLI notifications."""
+        return self._send_command('bytecount %i' % interval, has_end_marker=False)
+
+    def set_state_notifications(self, enable=True):
+        return self._send_command('state %s' % ('on' if enable else 'off'), has_end_marker=False)
+
+    def set_log_notifications(self, enable=True):
+        return self._send_command('log %s' % ('on' if enable else 'off'), has_end_marker=False)
 
     def status(self, version=3):
         return self._send_command('status ' + str(version))
@@ -4,9 +4,13 @@
 
 import tempfile
 from .filelist import *
-from .utils import runcmdAndGetData
+from .utils import runcmdAndGetData, bytes2human
 from .timestamp import strptime_as_timestamp
 import urllib.parse
+import subprocess
+import datetime
+import re
+import time
 import sys
 import stat
 
@@ -82,6 +86,175 @@ class rsync_stat_result(object):
             self.st_ctime
             )
 
+class RsyncProgress(object):
+    """
+    Progress of a running transfer as reported by rsync --info=progress2.
+    """
+    def __init__(self, bytes_transferred, percent, rate, eta, files_transferred=0, files_remaining=None, files_total=None, elapsed=0.0):
+        self.bytes_transferred = bytes_transferred
+        self.percent = percent
+        self.rate = rate
+        self.eta = eta
+        self.files_transferred = files_transferred
+        self.files_remaining = files_remaining
+        self.files_total = files_total
+        self.elapsed = elapsed
+
+    @property
+    def files_checked(self):
+        if self.files_total is None or self.files_remaining is None:
+            return None
+        return self.files_total - self.files_remaining
+
+    @property
+    def files_checked_per_second(self):
+        checked = self.files_checked
+        if checked is None or self.elapsed <= 0:
+            return None
+        return checked / self.elapsed
+
+    def __str__(self):
+        ret = '%s bytes (%i%%), %s/s' % (self.bytes_transferred, self.percent, bytes2human(self.rate) if self.rate is not None else 'N/A')
+        if self.files_total is not None:
+            ret = ret + ', %i/%i files checked' % (self.files_checked, self.files_total)
+            fps = self.files_checked_per_second
+            if fps is not None:
+                ret = ret + ' (%.1f files/s)' % fps
+        if self.eta is not None:
+            ret = ret + ', ETA %s' % datetime.timedelta(seconds=self.eta)
+        return ret
+
+class RsyncOutputParser(object):
+    """
+    Incremental parser for the output of rsync. The output is fed in chunks
+    as read from the rsync process. Lines are split at CR and LF since rsync
+    updates the progress by rewriting the current line. Only the current
+    line and the collected statistics are kept, so the memory usage does
+    not depend on the number of files listed by rsync.
+    """
+    MAX_LINE_LENGTH = 64 * 1024
+    SIZE_UNITS = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4 }
+    STATS_KEY_PREFIXES = ('Number of', 'Total ', 'File list', 'Literal data', 'Matched data')
+    LINE_SEPARATOR = re.compile(b'[\r\n]')
+    # output of --out-format=ITEMIZE_OUT_FORMAT
+    ITEMIZE_OUT_FORMAT = '%i %l %n'
+    ITEMIZE_LINE = re.compile(r'^(\*deleting|[<>ch.*][fdLDS][^ ]{7,9}) +([0-9]+) (.*)$')
+
+    def __init__(self, on_progress=None, on_line=None, on_item=None, encoding='utf-8'):
+        self.on_progress = on_progress
+        self.on_line = on_line
+        self.on_item = on_item
+        self.encoding = encoding
+        self.stats = {}
+        self.last_progress = None
+        self.num_lines = 0
+        self._buffer = b''
+        self._start_time = time.time()
+
+    @staticmethod
+    def parse_size(value):
+        # 1,234,567 or 1.23M
+        if not value:
+            return None
+        factor = RsyncOutputParser.SIZE_UNITS.get(value[-1].upper())
+        if factor is not None:
+            value = value[:-1]
+        else:
+            factor = 1
+        try:
+            return int(float(value.replace(',', '')) * factor)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def parse_rate(value):
+        # 1.23MB/s or 512.00kB/s
+        if not value.endswith('B/s'):
+            return None
+        return RsyncOutputParser.parse_size(value[:-3])
+
+    @staticmethod
+    def parse_duration(value):
+        elems = value.split(':')
+        try:
+            ret = 0
+            for e in elems:
+                ret = ret * 60 + int(e)
+        except ValueError:
+            ret = None
+        return ret
+
+    def _parse_progress(self, line):
+        #      1,234,567  12%    1.23MB/s    0:00:05 (xfr#3, to-chk=120/500)
+        elems = line.split()
+        if len(elems) < 4 or not elems[1].endswith('%'):
+            return None
+        bytes_transferred = RsyncOutputParser.parse_size(elems[0])
+        if bytes_transferred is None:
+            return None
+        try:
+            percent = int(elems[1][:-1])
+        except ValueError:
+            return None
+        rate = RsyncOutputParser.parse_rate(elems[2])
+        eta = RsyncOutputParser.parse_duration(elems[3])
+        files_transferred = 0
+        files_remaining = None
+        files_total = None
+        if len(elems) > 4:
+            for e in ' '.join(elems[4:]).strip('()').split(','):
+                e = e.strip()
+                if e.startswith('xfr#'):
+                    try:
+                        files_transferred = int(e[4:])
+                    except ValueError:
+                        pass
+                elif e.startswith('to-chk=') or e.startswith('ir-chk='):
+                    (remaining, _, total) = e[7:].partition('/')
+                    try:
+                        files_remaining = int(remaining)
+                        files_total = int(total)
+                    except ValueError:
+                        pass
+        return RsyncProgress(bytes_transferred, percent, rate, eta,
+                             files_transferred=files_transferred, files_remaining=files_remaining, files_total=files_total,
+                             elapsed=time.time() - self._start_time)
+
+    def _handle_line(self, line):
+        if not line:
+            return
+        self.num_lines += 1
+        progress = self._parse_progress(line)
+        if progress is not None:
+            self.last_progress = progress
+            if self.on_progress is not None:
+                self.on_progress(progress)
+            return
+        if self.on_item is not None:
+            m = RsyncOutputParser.ITEMIZE_LINE.match(line)
+            if m is not None:
+                # itemized lines still reach on_line, e.g. for the session log
+                self.on_item(m.group(1), int(m.group(2)), m.group(3))
+        if line.startswith(RsyncOutputParser.STATS_KEY_PREFIXES) and ':' in line:
+            Rsync.parse_stats_line(line, self.stats)
+        if self.on_line is not None:
+            self.on_line(line)
+
+    def feed(self, data):
+        lines = RsyncOutputParser.LINE_SEPARATOR.split(self._buffer + data)
+        # the last element is the incomplete current line
+        self._buffer = lines.pop()
+        for line in lines:
+            self._handle_line(line.decode(self.encoding, 'replace').strip())
+        if len(self._buffer) > RsyncOutputParser.MAX_LINE_LENGTH:
+            # a single overlong line must not exhaust the memory
+            self._buffer = self._buffer[-RsyncOutputParser.MAX_LINE_LENGTH:]
+
+    def close(self):
+        if self._buffer:
+            self._handle_line(self._buffer.decode(self.encoding, 'replace').strip())
+            self._buffer = b''
+
 class Rsync(object):
     def __init__(self, source, dest, include=None, exclude=None, linkDest=None,
                  recursive=True, relative=False,
@@ -90,9 +263,9 @@ class Rsync(object):
                  numericIds=True,
                  verbose=False, compress=True, links=True, dryrun=False,
                  delete=False, deleteExcluded=False, force=False, delayUpdates=False,
-                 listOnly=False, pruneEmptyDirs=False, stats=False,
+                 listOnly=False, pruneEmptyDirs=False, stats=False, progress=False, itemize=False,
                  rsh=None, bandwidthLimit=None,
-                 use_ssh=False, ssh_key=None,
+                 use_ssh=False, ssh_key=None, rsyncPath=None,
                  rsync_bin=RsyncDefaults.RSYNC_BIN):
         self._rsync_bin = rsync_bin
         self._source = source
@@ -120,14 +293,17 @@ class Rsync(object):
         self.rsh = rsh
         self.use_ssh = use_ssh
         self.ssh_key = ssh_key
+        self.rsyncPath = rsyncPath
         self.bandwidthLimit = bandwidthLimit
         self.listOnly = listOnly
         self.stats = stats
+        self.progress = progress
+        self.itemize = itemize
         self.pruneEmptyDirs = pruneEmptyDirs
         self._include = include
         self._exclude = exclude
 
-    def executeRaw(self, stdout=None, stderr=None, stderr_to_stdout=False):
+    def _prepare(self):
 
         if self.listOnly == False:
             if self._source is None or \
@@ -196,6 +372,10 @@ class Rsync(object):
             args.append('--list-only')
         if self.stats:
             args.append('--stats')
+        if self.progress:
+            args.append('--info=progress2')
+        if self.itemize:
+            args.append('--out-format=' + RsyncOutputParser.ITEMIZE_OUT_FORMAT)
         if self.numericIds:
             args.append('--numeric-ids')
         if self.pruneEmptyDirs:
@@ -210,6 +390,8 @@ class Rsync(object):
             if self.ssh_key:
                 rsh = rsh + ' -i ' + self.ssh_key
             args.append('--rsh=' + str(rsh))
+        if self.rsyncPath:
+            args.append('--rsync-path=' + str(self.rsyncPath))
         if self.bandwidthLimit:
             args.append('--bwlimit=' + str(self.bandwidthLimit))
 
@@ -273,18 +455,52 @@ class Rsync(object):
                 args.append(self._source)
         args.append(self._normalize_url(self._dest))
 
+        tmp_files = [ f for f in [tmp_include, tmp_exclude, tmp_source] if f ]
+        return ([self._rsync_bin] + args, tmp_files)
+
+    @staticmethod
+    def _remove_temp_files(tmp_files):
+        for f in tmp_files:
+            os.remove(f)
+
+    def executeRaw(self, stdout=None, stderr=None, stderr_to_stdout=False):
+        (args, tmp_files) = self._prepare()
+
         rsync_env = os.environ
         rsync_env['LANG'] = 'C'
-        (status_code, stdout_data, stderr_data) = runcmdAndGetData([self._rsync_bin] + args, stdout=stdout, stderr_to_stdout=stderr_to_stdout, env=rsync_env, verbose=self.verbose)
-
-        if tmp_include:
-            os.remove(tmp_include)
-        if tmp_exclude:
-            os.remove(tmp_exclude)
-        if tmp_source:
-            os.remove(tmp_source)
+        (status_code, stdout_data, stderr_data) = runcmdAndGetData(args, stdout=stdout, stderr_to_stdout=stderr_to_stdout, env=rsync_env, verbose=self.verbose)
+
+        Rsync._remove_temp_files(tmp_files)
         return (status_code, stdout_data, stderr_data)
 
+    def executeWithParser(self, parser, stderr_to_stdout=True, chunk_size=64 * 1024):
+        (args, tmp_files) = self._prepare()
+
+        rsync_env = dict(os.environ)
+        rsync_env['LANG'] = 'C'
+        if self.verbose:
+            print("runcmd " + ' '.join(args))
+        status_code = -1
+        try:
+            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT if stderr_to_stdout else None,
+                                 stdin=subprocess.DEVNULL, env=rsync_env)
+        except OSError as e:
+            p = None
+            parser.feed(('Failed to execute %s: %s\n' % (args[0], str(e))).encode())
+        if p:
+            fd = p.stdout.fileno()
+            while True:
+                data = os.read(fd, chunk_size)
+                if not data:
+                    break
+                parser.feed(data)
+            p.stdout.close()
+            status_code = p.wait()
+        parser.close()
+
+        Rsync._remove_temp_files(tmp_files)
+        return status_code
+
     def execute(self, stdout=None, stderr=None, stderr_to_stdout=False):
         (status_code, stdout_data, stderr_data) = self.executeRaw(stdout=stdout, stderr=stderr, stderr_to_stdout=stderr_to_stdout)
         return True if status_code == 0 else False
@@ -399,6 +615,67 @@ class Rsync(object):
                 pass
         return ret
 
+    @staticmethod
+    def parse_stats_line(line, ret_stats):
+        idx = line.find(':')
+        if idx > 0:
+            key = line[0:idx]
+            value = line[idx+1:].strip()
+            skip = False
+            if key == 'Number of files':
+                details = {}
+                # 18 (reg: 4, dir: 12, special: 2)
+                total = 0
+                start = value.find('(')
+                end = value.find(')')
+                if start > 0 and end > 0:
+                    total = Rsync.parse_number(value[0:start])
+                    for e in value[start+1:end].split(','):
+                        #print(e)
+                        idx = e.find(':')
+                        if idx > 0:
+                            k = e[0:idx].strip()
+                            v = Rsync.parse_number(e[idx+1:].strip())
+                            details[k] = v
+                else:
+                    total = Rsync.parse_number(value)
+                ret_stats['num_total_files'] = total
+                ret_stats['num_regular_files'] = details.get('reg', 0)
+                ret_stats['num_special_files'] = details.get('special', 0)
+                ret_stats['num_dirs'] = details.get('dir', 0)
+                skip = True
+            elif key == 'Total file size':
+                skip = True
+                ret_stats['total_file_size'] = Rsync.parse_number(value)
+            elif key == 'Total transferred file size':
+                skip = True
+                ret_stats['total_transferred_file_size'] = Rsync.parse_number(value)
+            elif key == 'File list size':
+                skip = True
+                ret_stats['file_list_size'] = Rsync.parse_number(value)
+            elif key.startswith('Total bytes'):
+                skip = True
+                if key == 'Total bytes received':
+                    ret_stats['total_bytes_received'] = Rsync.parse_number(value)
+                elif key == 'Total bytes sent':
+                    ret_stats['total_bytes_sent'] = Rsync.parse_number(value)
+                else:
+                    skip = False
+            elif key.startswith('Number of'):
+                skip = True
+                if key == 'Number of created files':
+                    ret_stats['num_created_files'] = Rsync.parse_number(value)
+                elif key == 'Number of deleted files':
+                    ret_stats['num_deleted_files'] = Rsync.parse_number(value)
+                elif key == 'Number of regular files transferred':
+                    ret_stats['num_regular_files_transferred'] = Rsync.parse_number(value)
+                else:
+                    skip = False
+
+            if not skip:
+                ret_stats[key] = value
+        return ret_stats
+
     @staticmethod
     def listdir(target_dir, use_ssh=False, ssh_key=None, recursive=False, stats=False, verbose=False):
         if target_dir[-1] != '/':
@@ -420,61 +697,7 @@ class Rsync(object):
                     continue
                 if parse_stats and stats:
                     #print(line)
-                    idx = line.find(':')
-                    if idx > 0:
-                        key = line[0:idx]
-                        value = line[idx+1:].strip()
-                        skip = False
-                        if key == 'Number of files':
-                            details = {}
-                            # 18 (reg: 4, dir: 12, special: 2)
-                            total = 0
-                            start = value.find('(')
-                            end = value.find(')')
-                            if start > 0 and end > 0:
-                                total = Rsync.parse_number(value[0:start])
-                                for e in value[start+1:end].split(','):
-                                    #print(e)
-                                    idx = e.find(':')
-                                    if idx > 0:
-                                        k = e[0:idx].strip()
-                                        v = Rsync.parse_number(e[idx+1:].strip())
-                                        details[k] = v
-                            ret_stats['num_total_files'] = total
-                            ret_stats['num_regular_files'] = details.get('reg', 0)
-                            ret_stats['num_special_files'] = details.get('special', 0)
-                            ret_stats['num_dirs'] = details.get('dir', 0)
-                            skip = True
-                        elif key == 'Total file size':
-                            skip = True
-                            ret_stats['total_file_size'] = Rsync.parse_number(value)
-                        elif key == 'Total transferred file size':
-                            skip = True
-                            ret_stats['total_transferred_file_size'] = Rsync.parse_number(value)
-                        elif key == 'File list size':
-                            skip = True
-                            ret_stats['file_list_size'] = Rsync.parse_number(value)
-                        elif key.startswith('Total bytes'):
-                            skip = True
-                            if key == 'Total bytes received':
-                                ret_stats['total_bytes_received'] = Rsync.parse_number(value)
-                            elif key == 'Total bytes sent':
-                                ret_stats['total_bytes_sent'] = Rsync.parse_number(value)
-                            else:
-                                skip = False
-                        elif key.startswith('Number of'):
-                            skip = True
-                            if key == 'Number of created files':
-                                ret_stats['num_created_files'] = Rsync.parse_number(value)
-                            elif key == 'Number of deleted files':
-                                ret_stats['num_deleted_files'] = Rsync.parse_number(value)
-                            elif 'Number of regular files transferred':
-                                ret_stats['num_regular_files_transferred'] = Rsync.parse_number(value)
-                            else:
-                                skip = False
-
-                        if not skip:
-                            ret_stats[key] = value
+                    Rsync.parse_stats_line(line, ret_stats)
                 else:
                     if line.startswith('receiving') or line.startswith('sent') or line.startswith('total size'):
                         continue
@@ -513,6 +736,42 @@ class Rsync(object):
         os.rmdir(empty_dir)
         return ret
 
+    @staticmethod
+    def rmdirs(target_dirs, force=True, use_ssh=False, ssh_key=None, rsync_path=None, verbose=False, dryrun=False):
+        """
+        Removes several directories which share the same parent directory
+        using a single rsync run (and therefore a single ssh session).
+        Returns a tuple of the result and the number of deleted files.
+        """
+        if not target_dirs:
+            return (True, 0)
+        parent_dir = None
+        includes = []
+        for target_dir in target_dirs:
+            target_parent, basename = os.path.split(target_dir.rstrip('/'))
+            if parent_dir is None:
+                parent_dir = target_parent
+            elif parent_dir != target_parent:
+                raise ValueError('%s is not located in %s' % (target_dir, parent_dir))
+            includes.append('%s/***' % basename)
+        if parent_dir[-1] != '/':
+            parent_dir += '/'
+        empty_dir = tempfile.mkdtemp()
+        if empty_dir[-1] != '/':
+            empty_dir += '/'
+        rdir = Rsync(source=empty_dir, dest=parent_dir, recursive=True, relative=False, use_ssh=use_ssh, ssh_key=ssh_key,
+                     delete=True, deleteExcluded=False, pruneEmptyDirs=False,
+                     include=includes, exclude='*', stats=True, rsyncPath=rsync_path,
+                     preservePermissions=False, preserveOwner=False, preserveGroup=False, preserveTimes=False,
+                     preserveDevices=False, preserveSpecials=False, perserveACL=False, preserveXAttrs=False,
+                     numericIds=False,
+                     force=force, verbose=verbose, dryrun=dryrun)
+        parser = RsyncOutputParser()
+        status_code = rdir.executeWithParser(parser)
+        os.rmdir(empty_dir)
+        num_deleted = parser.stats.get('num_deleted_files', 0) or 0
+        return (True if status_code == 0 else False, num_deleted)
+
 if __name__ == "__main__":
     #files = Rsync.listdir(sys.argv[1], use_ssh=True, ssh_key=sys.argv[2], verbose=True)
     #if files is not None:
@@ -8,6 +8,10 @@ import sys
 import tempfile
 import os.path
 import copy, uuid
+import atexit
+import shutil
+import threading
+import subprocess
 
 def _find_executable_impl(user_override, ssh_name, putty_name):
     if user_override:
@@ -44,14 +48,8 @@ def _find_scp_executable(scp=None):
 (SSH_COPY_ID_EXECUTABLE, SSH_COPY_ID_USE_PUTTY) = _find_ssh_copy_id_executable()
 (SCP_EXECUTABLE, SCP_USE_PUTTY) = _find_scp_executable()
 
-def ssh_runcmdAndGetData(server, args=[], script=None, keyfile=None, username=None, password=None,
-                         sudo_command=None, sudo_env=None, shell='/bin/sh',
-                         verbose=False, outputStdErr=False, outputStdOut=False, stdin=None, stdout=None, stderr=None, cwd=None, env=None,
-                         stderr_to_stdout=False,
-                         ssh_env=None, ssh_verbose=0,
-                         allocateTerminal=False, x11Forwarding=False, quote_char='\'',
-                         ssh_executable=SSH_EXECUTABLE, use_putty=SSH_USE_PUTTY):
-
+def _ssh_auth_args(keyfile=None, username=None, password=None, port=None,
+                   ssh_verbose=0, ssh_executable=SSH_EXECUTABLE, use_putty=SSH_USE_PUTTY):
     if use_putty:
         ssh_args = [ssh_executable, '-batch', '-noagent', '-a', '-x']
         if keyfile is None and password:
@@ -65,11 +63,28 @@ def ssh_runcmdAndGetData(server, args=[], script=None, keyfile=None, username=No
 
     if username:
         ssh_args.extend(['-l', username ])
+    if port:
+        ssh_args.extend(['-P' if use_putty else '-p', str(port) ])
     if keyfile:
         if isinstance(keyfile, SSHSessionKey):
             ssh_args.extend(['-i', keyfile.keyfile])
         else:
             ssh_args.extend(['-i', keyfile])
+    return ssh_args
+
+def ssh_runcmdAndGetData(server, args=[], script=None, keyfile=None, username=None, password=None,
+                         sudo_command=None, sudo_env=None, shell='/bin/sh',
+                         verbose=False, outputStdErr=False, outputStdOut=False, stdin=None, stdout=None, stderr=None, cwd=None, env=None,
+                         stderr_to_stdout=False,
+                         ssh_env=None, ssh_verbose=0,
+                         allocateTerminal=False, x11Forwarding=False, quote_char='\'',
+                         ssh_executable=SSH_EXECUTABLE, use_putty=SSH_USE_PUTTY,
+                         port=None, ssh_options=None):
+
+    ssh_args = _ssh_auth_args(keyfile=keyfile, username=username, password=password, port=port,
+                              ssh_verbose=ssh_verbose, ssh_executable=ssh_executable, use_putty=use_putty)
+    if ssh_options:
+        ssh_args.extend(ssh_options)
 
     if not use_putty:
         ssh_args.append( '-t' if allocateTerminal else '-T')
@@ -103,34 +118,51 @@ def ssh_runcmdAndGetData(server, args=[], script=None, keyfile=None, username=No
 
     else:
         tmpfile = '/tmp/arsoft_remote_ssh_%s.sh' % uuid.uuid4()
-        put_args = copy.deepcopy(ssh_args)
-        # do not allow anyone except ourself to execute (read/write) this script
-        put_args.append('umask 077; /bin/cat > ' + tmpfile)
-        cleanup_args = copy.deepcopy(ssh_args)
-        cleanup_args.append('/bin/rm -f ' + tmpfile)
-        exec_args = copy.deepcopy(ssh_args)
         if isinstance(args, str):
             script_args = args
         else:
             script_args = ' '.join(args) if args else ''
         if sudo_command:
-            exec_args.append('%s %s %s%s %s %s' % (sudo_env_str, sudo_command, env_str, shell, tmpfile, script_args))
+            exec_command = '%s %s %s%s %s %s' % (sudo_env_str, sudo_command, env_str, shell, tmpfile, script_args)
         else:
-            exec_args.append('%s%s %s %s' % (env_str, shell, tmpfile, script_args))
+            exec_command = '%s%s %s %s' % (env_str, shell, tmpfile, script_args)
 
         # convert any M$-newlines into the real-ones
         real_script = script.replace('\r\n', '\n')
+        if not real_script.endswith('\n'):
+            real_script += '\n'
+        if verbose:
+            print(real_script)
+
+        if stdin is None:
+            # upload the script over stdin, run it and remove it again in a
+            # single round trip. The script is not passed on the command line,
+            # so it neither shows up in the process list nor is limited in size.
+            # Do not allow anyone except ourself to execute (read/write) this script
+            ssh_args.append('(umask 077; /bin/cat > %(tmpfile)s) || exit $?; '
+                            '%(exec_command)s; RES=$?; /bin/rm -f %(tmpfile)s; exit $RES' % {
+                                'tmpfile': tmpfile, 'exec_command': exec_command })
+            return runcmdAndGetData(ssh_args, input=real_script,
+                                    verbose=verbose, outputStdErr=outputStdErr, outputStdOut=outputStdOut,
+                                    stderr_to_stdout=stderr_to_stdout,
+                                    stdout=stdout, stderr=stderr, cwd=cwd, env=ssh_env)
+
+        # the script needs stdin, so upload it separately
+        put_args = copy.deepcopy(ssh_args)
+        # do not allow anyone except ourself to execute (read/write) this script
+        put_args.append('umask 077; /bin/cat > ' + tmpfile)
+        cleanup_args = copy.deepcopy(ssh_args)
+        cleanup_args.append('/bin/rm -f ' + tmpfile)
+        exec_args = copy.deepcopy(ssh_args)
+        exec_args.append(exec_command)
 
         (put_sts, put_stdout, put_stderr) = runcmdAndGetData(put_args, input=real_script,
                                 verbose=verbose, cwd=cwd, env=ssh_env)
-
         if put_sts == 0:
-            if verbose:
-                print(real_script)
             (sts, stdout_data, stderr_data) = runcmdAndGetData(exec_args,
-                                verbose=verbose, outputStdErr=outputStdErr, outputStdOut=outputStdOut,
-                                stderr_to_stdout=stderr_to_stdout,
-                                stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd, env=ssh_env)
+                                    verbose=verbose, outputStdErr=outputStdErr, outputStdOut=outputStdOut,
+                                    stderr_to_stdout=stderr_to_stdout,
+                                    stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd, env=ssh_env)
         else:
             (sts, stdout_data, stderr_data) = (put_sts, put_stdout, put_stderr)
 
@@ -197,26 +229,13 @@ def ssh_create_temp_file(server, data, keyfile=None, username=None, password=Non
                          verbose=False, outputStdErr=False, outputStdOut=False, stdin=None, stdout=None, stderr=None, cwd=None, env=None,
                          ssh_env=None, ssh_verbose=0,
                          allocateTerminal=False, x11Forwarding=False,
-                         ssh_executable=SSH_EXECUTABLE, use_putty=SSH_USE_PUTTY):
-
-    if use_putty:
-        ssh_args = [ssh_executable, '-batch', '-noagent', '-a', '-x']
-        if keyfile is None and password:
-            ssh_args.extend(['-pw', password])
-    else:
-        ssh_args = [ssh_executable, '-a', '-o', 'BatchMode=yes']
+                         ssh_executable=SSH_EXECUTABLE, use_putty=SSH_USE_PUTTY,
+                         port=None, ssh_options=None):
 
-    while ssh_verbose > 0:
-        ssh_args.append('-v')
-        ssh_verbose = ssh_verbose - 1
-
-    if username:
-        ssh_args.extend(['-l', username ])
-    if keyfile:
-        if isinstance(keyfile, SSHSessionKey):
-            ssh_args.extend(['-i', keyfile.keyfile])
-        else:
-            ssh_args.extend(['-i', keyfile])
+    ssh_args = _ssh_auth_args(keyfile=keyfile, username=username, password=password, port=port,
+                              ssh_verbose=ssh_verbose, ssh_executable=ssh_executable, use_putty=use_putty)
+    if ssh_options:
+        ssh_args.extend(ssh_options)
 
     if not use_putty:
         ssh_args.append( '-t' if allocateTerminal else '-T')
@@ -379,8 +398,119 @@ class ConnectionTempFile(object):
     def close(self):
         return self._cxn.delete_temp_file(self)
 
+class SSHControlMasterPool(object):
+    """
+    Shares one OpenSSH master connection (ControlMaster) per user, host and
+    port between all SSHConnection objects of this process, so only the
+    first command pays for the SSH handshake. A master is stopped when the
+    last connection using it is closed, and all remaining ones at exit.
+    ControlPersist lets a master which is left behind (e.g. after a crash)
+    terminate by itself once it has been idle for a while.
+    """
+    CONTROL_PERSIST = 60
+
+    class Master(object):
+        def __init__(self, control_path):
+            self.control_path = control_path
+            self.refcount = 0
+            self.lock = threading.Lock()
+            self.ssh_args = None
+            self.failed_args = None
+
+    def __init__(self, control_persist=CONTROL_PERSIST):
+        self.control_persist = control_persist
+        self._lock = threading.Lock()
+        self._masters = {}
+        self._directory = None
+        self._next_id = 0
+
+    def _control_path(self):
+        # keep the path short, unix socket names are limited to 108 bytes
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='arsoft-ssh-')
+        self._next_id += 1
+        return os.path.join(self._directory, '%i' % self._next_id)
+
+    @staticmethod
+    def _control_args(ssh_args, control_path, command):
+        return ssh_args + ['-o', 'ControlPath=' + control_path, '-O', command]
+
+    def _start(self, master, ssh_args, hostname, verbose=False):
+        args = ssh_args + ['-M', '-N', '-f', '-o', 'ControlPath=' + master.control_path,
+                           '-o', 'ControlPersist=%i' % self.control_persist, hostname]
+        # older OpenSSH versions keep stdout and stderr of the backgrounded
+        # master open, so do not capture them or this waits until the master exits
+        (sts, stdoutdata, stderrdata) = runcmdAndGetData(args, verbose=verbose, stdin=subprocess.DEVNULL,
+                                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if sts != 0:
+            return False
+        (sts, stdoutdata, stderrdata) = runcmdAndGetData(self._control_args(ssh_args, master.control_path, 'check') + [hostname], verbose=verbose)
+        return True if sts == 0 else False
+
+    def _stop(self, master, hostname, verbose=False):
+        if master.ssh_args is not None and os.path.exists(master.control_path):
+            runcmdAndGetData(self._control_args(master.ssh_args, master.control_path, 'exit') + [hostname], verbose=verbose)
+        master.ssh_args = None
+
+    def acquire(self, key, ssh_args, verbose=False):
+        """
+        Returns the ssh options to use the master connection for key, which
+        is (username, hostname, port), starting the master if required. On
+        failure None is returned and the caller should connect directly.
+        """
+        with self._lock:
+            master = self._masters.get(key)
+            if master is None:
+                master = self._masters[key] = SSHControlMasterPool.Master(self._control_path())
+            master.refcount += 1
+        with master.lock:
+            if master.ssh_args is not None and not os.path.exists(master.control_path):
+                # the master has gone away (idle timeout or killed)
+                master.ssh_args = None
+            if master.ssh_args is None and master.failed_args != ssh_args:
+                if self._start(master, ssh_args, key[1], verbose=verbose):
+                    master.ssh_args = ssh_args
+                    master.failed_args = None
+                else:
+                    master.failed_args = ssh_args
+            if master.ssh_args is None:
+                ret = None
+            else:
+                ret = ['-o', 'ControlMaster=no', '-o', 'ControlPath=' + master.control_path]
+        if ret is None:
+            self.release(key, verbose=verbose)
+        return ret
+
+    def release(self, key, verbose=False):
+        with self._lock:
+            master = self._masters.get(key)
+            if master is None:
+                return
+            master.refcount -= 1
+            if master.refcount > 0:
+                return
+            del self._masters[key]
+        with master.lock:
+            self._stop(master, key[1], verbose=verbose)
+
+    def close_all(self):
+        with self._lock:
+            masters = self._masters
+            self._masters = {}
+            directory = self._directory
+            self._directory = None
+        for (key, master) in masters.items():
+            with master.lock:
+                self._stop(master, key[1])
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+ssh_control_master_pool = SSHControlMasterPool()
+atexit.register(ssh_control_master_pool.close_all)
+
 class SSHConnection(object):
-    def __init__(self, url=None, hostname=None, port=None, username=None, password=None, keyfile=None, verbose=False):
+    def __init__(self, url=None, hostname=None, port=None, username=None, password=None, keyfile=None, verbose=False,
+                 use_control_master=True, pool=None):
         if url is None:
             self.hostname = hostname
             self.port = port
@@ -395,6 +525,9 @@ class SSHConnection(object):
         self.sudo_session = None
         self.verbose = verbose
         self._temp_files = []
+        self._pool = (pool if pool is not None else ssh_control_master_pool) if use_control_master and not SSH_USE_PUTTY else None
+        self._pool_key = None
+        self._pool_options = None
 
     def __del__(self):
         for tmp in self._temp_files:
@@ -407,14 +540,43 @@ class SSHConnection(object):
     def close(self):
         if self.sudo_session:
             self.sudo_session.close()
-        if self.keyfile:
+        if isinstance(self.keyfile, SSHSessionKey):
             self.keyfile.close()
+        self._release_control_master()
+
+    @property
+    def _port_arg(self):
+        # leave the default port to the ssh configuration
+        return self.port if self.port != 22 else None
+
+    def _release_control_master(self):
+        if self._pool_key is not None:
+            self._pool.release(self._pool_key, verbose=self.verbose)
+            self._pool_key = None
+            self._pool_options = None
+
+    def _ssh_options(self):
+        if self._pool is None:
+            return None
+        ssh_args = _ssh_auth_args(keyfile=self.keyfile, username=self.username, port=self._port_arg)
+        if self._pool_key is not None:
+            if self._pool_options is not None and self._pool_options[0] == ssh_args:
+                return self._pool_options[1]
+            # the credentials have changed, e.g. a session key is used now
+            self._release_control_master()
+        key = (self.username, self.hostname, self.port)
+        options = self._pool.acquire(key, ssh_args, verbose=self.verbose)
+        if options is not None:
+            self._pool_key = key
+            self._pool_options = (ssh_args, options)
+        return options
 
     def create_temp_file(self, data, mode=0o600):
         ret = None
         tmpfile = ssh_create_temp_file(self.hostname, data,
                                         sudo_command=None, sudo_env=None,
-                                        keyfile=self.keyfile, username=self.username, verbose=self.verbose)
+                                        keyfile=self.keyfile, username=self.username, verbose=self.verbose,
+                                        port=self._port_arg, ssh_options=self._ssh_options())
         if tmpfile:
             ret = ConnectionTempFile(self, tmpfile)
             self._temp_files.append(ret)
@@ -426,7 +588,8 @@ class SSHConnection(object):
             cleanup_args = ['/bin/rm', '-f', tmpfile.name]
             (cleanup_sts, cleanup_stdout, cleanup_stderr) = ssh_runcmdAndGetData(self.hostname, cleanup_args,
                                                                                 sudo_command=None, sudo_env=None,
-                                                                                keyfile=self.keyfile, username=self.username, verbose=self.verbose)
+                                                                                keyfile=self.keyfile, username=self.username, verbose=self.verbose,
+                                                                                port=self._port_arg, ssh_options=self._ssh_options())
             if cleanup_sts == 0:
                 tmpfile.name = None
         return ret
@@ -449,9 +612,9 @@ class SSHConnection(object):
             used_stdout = sys.stdout if stdout is None else stdout
             used_stderr = sys.stderr if stderr is None else stderr
         else:
-            used_stdin = None
-            used_stdout = None
-            used_stderr = None
+            used_stdin = stdin
+            used_stdout = stdout
+            used_stderr = stderr
         sudo_command = None
         sudo_env = None
         if sudo:
@@ -470,7 +633,8 @@ class SSHConnection(object):
                                                      sudo_command=sudo_command, sudo_env=sudo_env,
                                                      allocateTerminal=allocateTerminal, x11Forwarding=x11Forwarding,
                                                      quote_char=quote_char,
-                                                     keyfile=self.keyfile, username=self.username, verbose=self.verbose)
+                                                     keyfile=self.keyfile, username=self.username, verbose=self.verbose,
+                                                     port=self._port_arg, ssh_options=self._ssh_options())
 
     def copy_id(self, public_keyfile,
                 outputStdErr=False, outputStdOut=False, stdin=None, stdout=None, stderr=None, cwd=None, env=None,
@@ -700,9 +864,9 @@ class LocalConnection(object):
             used_stdout = sys.stdout if stdout is None else stdout
             used_stderr = sys.stderr if stderr is None else stderr
         else:
-            used_stdin = None
-            used_stdout = None
-            used_stderr = None
+            used_stdin = stdin
+            used_stdout = stdout
+            used_stderr = stderr
 
         if not sudo or isRoot():
             return runcmdAndGetData(args, script=script, verbose=self.verbose, outputStdErr=outputStdErr, outputStdOut=outputStdOut,
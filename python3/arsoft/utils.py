@@ -6,6 +6,7 @@ import os, stat, shutil
 import pwd
 import grp
 import subprocess
+import threading
 import sys
 import platform
 import datetime
@@ -70,11 +71,7 @@ def runcmd(args=[], verbose=False, stdin=None, input=None, executable=None, cwd=
     return sts
 
 
-def runcmdAndGetData(args=[], script=None, verbose=False, outputStdErr=False, outputStdOut=False,
-                     executable=None, shell='/bin/sh',
-                     stdin=None, stdout=None, stderr=None, stderr_to_stdout=False, input=None, cwd=None, env=None,
-                     runAsUser=None, su='/bin/su'):
-
+def _command_args(args=[], script=None, shell='/bin/sh', runAsUser=None, su='/bin/su'):
     script_tmpfile = None
     if script is None:
         if args:
@@ -88,11 +85,44 @@ def runcmdAndGetData(args=[], script=None, verbose=False, outputStdErr=False, ou
         try:
             script_tmpfile = tempfile.NamedTemporaryFile()
             script_tmpfile.write(script.encode())
+            script_tmpfile.flush()
         except IOError:
             script_tmpfile = None
 
         all_args = [str(shell)]
         all_args.append(script_tmpfile.name)
+    return (all_args, script_tmpfile)
+
+def _command_env(env=None, env_update=None):
+    # returns a new environment for the child and leaves os.environ alone
+    if not env_update:
+        return env
+    ret = dict(os.environ if env is None else env)
+    for (key, value) in env_update.items():
+        if value is None:
+            ret.pop(key, None)
+        else:
+            ret[key] = str(value)
+    return ret
+
+def _feed_stdin(stdin, input):
+    try:
+        if input:
+            stdin.write(input.encode() if isinstance(input, str) else input)
+    except (BrokenPipeError, OSError):
+        pass
+    finally:
+        try:
+            stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+def runcmdAndGetData(args=[], script=None, verbose=False, outputStdErr=False, outputStdOut=False,
+                     executable=None, shell='/bin/sh',
+                     stdin=None, stdout=None, stderr=None, stderr_to_stdout=False, input=None, cwd=None, env=None,
+                     runAsUser=None, su='/bin/su', env_update=None):
+
+    (all_args, script_tmpfile) = _command_args(args, script=script, shell=shell, runAsUser=runAsUser, su=su)
 
     if input is not None:
         stdin_param = subprocess.PIPE
@@ -104,6 +134,8 @@ def runcmdAndGetData(args=[], script=None, verbose=False, outputStdErr=False, ou
         stdout_param = stdout if stdout is not None else subprocess.PIPE
     if stderr_to_stdout:
         stderr_param = subprocess.STDOUT
+    elif stderr is not None:
+        stderr_param = stderr
     else:
         if stdout is not None and hasattr(stdout, '__call__'):
             stderr_param = subprocess.PIPE
@@ -114,10 +146,16 @@ def runcmdAndGetData(args=[], script=None, verbose=False, outputStdErr=False, ou
                 ' 0<%s 1>%s 2>%s' % (stdin_param, stdout_param, stderr_param)
                     )
 
-    p = subprocess.Popen(all_args, executable=executable, stdout=stdout_param, stderr=stderr_param, stdin=stdin_param, shell=False, cwd=cwd, env=env)
+    p = subprocess.Popen(all_args, executable=executable, stdout=stdout_param, stderr=stderr_param, stdin=stdin_param, shell=False, cwd=cwd, env=_command_env(env, env_update))
     if p:
         if stdout is not None and hasattr(stdout, '__call__'):
             encoding = 'CP1252' if platform.system() == 'Windows' else 'utf-8'
+            feeder = None
+            if stdin_param is subprocess.PIPE:
+                # write the input from a thread, so a large input cannot
+                # block while the process waits for its output to be read
+                feeder = threading.Thread(target=_feed_stdin, args=(p.stdin, input))
+                feeder.start()
             while True:
                 line = ""
                 try:
@@ -133,6 +171,8 @@ def runcmdAndGetData(args=[], script=None, verbose=False, outputStdErr=False, ou
                 line = line.rstrip('\n\r')
                 stdout(line)
             sts = p.wait()
+            if feeder is not None:
+                feeder.join()
             stdoutdata = None
             stderrdata = None
         else:
@@ -194,6 +234,103 @@ def rmtree(directory):
 
     shutil.rmtree(directory, onerror=remove_readonly)
 
+_RMTREE_DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+
+def _rmtree_listdir_fd(fd):
+    with os.scandir(fd) as it:
+        return [ (entry.name, entry.is_dir(follow_symlinks=False)) for entry in it ]
+
+def _rmtree_listdir_or_close(fd):
+    # the descriptor is not on the stack yet, so close it if listing fails
+    try:
+        return _rmtree_listdir_fd(fd)
+    except:
+        os.close(fd)
+        raise
+
+def _rmtree_retry_writable(func, dir_fd, name):
+    try:
+        func(name, dir_fd=dir_fd)
+    except PermissionError:
+        # make the parent directory writable and try again
+        st = os.fstat(dir_fd)
+        os.fchmod(dir_fd, st.st_mode | stat.S_IRWXU)
+        func(name, dir_fd=dir_fd)
+
+def _rmtree_opendir(dir_fd, name):
+    try:
+        return os.open(name, _RMTREE_DIR_FLAGS, dir_fd=dir_fd)
+    except PermissionError:
+        os.chmod(name, stat.S_IRWXU, dir_fd=dir_fd, follow_symlinks=False)
+        return os.open(name, _RMTREE_DIR_FLAGS, dir_fd=dir_fd)
+
+def rmtree_fast(directory):
+    """
+    Removes the given directory tree like rmtree, but walks the tree using
+    directory file descriptors and unlinks all entries relative to them.
+    This avoids path lookups and stat calls for every entry.
+    Returns the number of removed inodes (files and directories).
+    """
+    ret = 0
+    fd = os.open(directory, _RMTREE_DIR_FLAGS)
+    stack = [ (fd, _rmtree_listdir_or_close(fd), None) ]
+    try:
+        while stack:
+            (fd, entries, name) = stack[-1]
+            descend = False
+            while entries:
+                (entry_name, is_dir) = entries.pop()
+                if is_dir:
+                    child_fd = _rmtree_opendir(fd, entry_name)
+                    stack.append( (child_fd, _rmtree_listdir_or_close(child_fd), entry_name) )
+                    descend = True
+                    break
+                else:
+                    _rmtree_retry_writable(os.unlink, fd, entry_name)
+                    ret += 1
+            if descend:
+                continue
+            stack.pop()
+            os.close(fd)
+            if stack:
+                _rmtree_retry_writable(os.rmdir, stack[-1][0], name)
+            else:
+                os.rmdir(directory)
+            ret += 1
+    finally:
+        for (fd, entries, name) in stack:
+            os.close(fd)
+    return ret
+
+IOPRIO_CLASS_NAMES = { 'realtime': 1, 'best-effort': 2, 'idle': 3 }
+
+def set_process_priority(nice=None, io_class=None, io_level=None, pid=None, ionice='/usr/bin/ionice'):
+    """
+    Adjusts the CPU and I/O scheduling priority of the given process (or
+    of the current process). The I/O priority is changed using ionice.
+    """
+    ret = True
+    if pid is None:
+        pid = os.getpid()
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, pid) + int(nice))
+        except OSError:
+            ret = False
+    if io_class is not None:
+        if isinstance(io_class, str):
+            io_class = IOPRIO_CLASS_NAMES.get(io_class, io_class)
+        args = [ionice, '-c', str(io_class)]
+        if io_level is not None:
+            args.extend(['-n', str(io_level)])
+        args.extend(['-p', str(pid)])
+        try:
+            if subprocess.call(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0:
+                ret = False
+        except OSError:
+            ret = False
+    return ret
+
 def walk_filetree(directory, operation=None, recursive=True):
     ret = True
     for f in os.listdir(directory):